@@ -4,7 +4,9 @@ from aws_cdk import core
 
 from squid_app.vpc_stack import VPCStack
 from squid_app.squid_stack import SquidStack
+from squid_app.squid_image_stack import SquidImageStack
 from squid_app.test_instance_stack import TestInstanceStack
+from squid_app.transit_gateway_stack import TransitGatewayStack
 
 app = core.App()
 
@@ -12,17 +14,74 @@ app = core.App()
 account = app.node.try_get_context('account')
 region = app.node.try_get_context('region')
 vpc_cidr = app.node.try_get_context('vpc_cidr')
+max_azs = app.node.try_get_context('max_azs') or 2
+squid_image = app.node.try_get_context('squid_image')
+egress_mode = app.node.try_get_context('egress_mode') or "vpc"
+spoke_vpcs = app.node.try_get_context('spoke_vpcs') or []
+load_generators = app.node.try_get_context('load_generators') or 0
+load_generator_instance_type = app.node.try_get_context('load_generator_instance_type') or "c5.large"
+load_test_profile = app.node.try_get_context('load_test_profile') or "default"
+
+# Get the optional squid context values, the squid stack defaults are used for the ones that are not set
+squid_context_keys = [
+    'failover_dry_run',
+    'failover_target_strategy',
+    'health_check',
+    'health_probe_url',
+    'instance_type',
+    'min_capacity',
+    'max_capacity',
+    'scaling_metric',
+    'scaling_target',
+    'bump_ca_key_type',
+    'sslcrtd_children',
+    'ssl_cert_cache_mb',
+    'log_analytics_max_domains',
+    'firewall',
+    'warm_pool',
+    'cache_volume',
+    'cache_volume_gb',
+    'config_canary_minutes',
+    'access_log_pipeline',
+    'access_log_sample_rate',
+    'fair_share_classes',
+]
+squid_options = {key: app.node.try_get_context(key) for key in squid_context_keys
+    if app.node.try_get_context(key) is not None}
 
 # Set the env context variable to use the appropriate account and region
 env = core.Environment(account=account, region=region)
 
 # Create the VPC stack using the context values 
-vpc_stack = VPCStack(app, "vpc", env=env, vpc_cidr=vpc_cidr)
+vpc_stack = VPCStack(app, "vpc", env=env, vpc_cidr=vpc_cidr, max_azs=max_azs)
+
+# Centralized egress: the squid instances of the VPC also serve the spoke VPCs attached to a Transit Gateway
+test_vpc = vpc_stack.vpc
+if egress_mode == "transit-gateway":
+    tgw_stack = TransitGatewayStack(app, "transit-gateway", env=env, inspection_vpc=vpc_stack.vpc, spoke_vpcs=spoke_vpcs)
+    squid_options['client_cidrs'] = tgw_stack.spoke_cidrs
+    # The test instance and the load generators go through the Transit Gateway from the first spoke VPC created
+    if tgw_stack.spoke_vpcs:
+        test_vpc = tgw_stack.spoke_vpcs[0]
+elif egress_mode != "vpc":
+    raise ValueError(f"Unknown egress mode: {egress_mode}")
+
+# Use a pre-built squid image: either built with EC2 Image Builder or an existing AMI
+if squid_image == "build":
+    squid_image_stack = SquidImageStack(app, "squid-image", env=env, vpc=vpc_stack.vpc)
+    squid_options['ami_id'] = squid_image_stack.ami_id
+elif squid_image and squid_image != "stock":
+    squid_options['ami_id'] = squid_image
 
 # Create the squid stack in the VPC
-SquidStack(app, "squid", env=env, vpc=vpc_stack.vpc)
+SquidStack(app, "squid", env=env, vpc=vpc_stack.vpc, **squid_options)
 
-# Create the stack that deploys a test instance
-TestInstanceStack(app, "test-instance", env=env, vpc=vpc_stack.vpc)
+# Create the stack that deploys a test instance, and the load generators when load_generators is set
+# The load test results are published with the squid instance type and the profile under test as dimensions
+TestInstanceStack(app, "test-instance", env=env, vpc=test_vpc,
+    load_generators=load_generators,
+    load_generator_instance_type=load_generator_instance_type,
+    load_test_dimensions={"SquidInstanceType": squid_options.get('instance_type', "t3.nano"),
+        "Profile": load_test_profile})
 
-app.synth()
\ No newline at end of file
+app.synth()
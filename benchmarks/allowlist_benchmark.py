@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Measure the cost of the Squid allowlist for 1k, 10k and 100k domains, raw and compiled.
+#
+# For every list size, a raw allowlist with duplicates and subdomains of wildcard entries is
+# generated and compiled. The benchmark reports the compile time and the number of entries.
+# When a squid binary is available (for example on a Squid instance), it also measures:
+# - parse: the time of "squid -k parse" with the allowlist in a dstdomain ACL
+# - reconfigure: the time from "squid -k reconfigure" until Squid accepts connections again
+# - match throughput: forward proxy requests per second, answered with a 403 by Squid after the
+#   ACL lookup so that no upstream traffic is generated
+#
+# Usage: python benchmarks/allowlist_benchmark.py [--sizes 1000 10000 100000] [--squid /usr/sbin/squid]
+
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from squid_app.allowlist_compiler import compile_allowlist, write_allowlist
+
+SQUID_CONF = """
+http_port 127.0.0.1:{port}
+pid_filename {work_dir}/squid.pid
+cache_log {work_dir}/cache.log
+access_log none
+cache deny all
+shutdown_lifetime 1 seconds
+coredump_dir {work_dir}
+acl allowed_sites dstdomain "{allowlist}"
+http_access deny !allowed_sites
+http_access deny all
+"""
+
+
+# Generate a raw allowlist: wildcard parents, some of their subdomains, exact domains and duplicates
+def generate_allowlist(size, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    parents = [f"service{index}.example{index % 97}.com" for index in range(size // 4)]
+    for parent in parents:
+        lines.append(f".{parent}")
+    while len(lines) < size:
+        choice = rng.random()
+        if choice < 0.3:
+            lines.append(f"api{rng.randrange(100)}.{rng.choice(parents)}")
+        elif choice < 0.4:
+            lines.append(rng.choice(lines).upper())
+        else:
+            lines.append(f"host{rng.randrange(size * 10)}.domain{rng.randrange(size)}.org")
+    rng.shuffle(lines)
+    return lines
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class SquidRunner:
+    def __init__(self, squid, allowlist):
+        self.squid = squid
+        self.work_dir = tempfile.mkdtemp(prefix="squid-bench-")
+        self.port = free_port()
+        self.conf = os.path.join(self.work_dir, "squid.conf")
+        self.process = None
+        with open(self.conf, "w") as conf_h:
+            conf_h.write(SQUID_CONF.format(port=self.port, work_dir=self.work_dir, allowlist=allowlist))
+
+    def _run(self, *args):
+        subprocess.run([self.squid, "-f", self.conf] + list(args), check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _accepting_count(self):
+        try:
+            with open(os.path.join(self.work_dir, "cache.log")) as log_h:
+                return log_h.read().count("Accepting HTTP Socket connections")
+        except FileNotFoundError:
+            return 0
+
+    def _wait_accepting(self, count, timeout=120):
+        deadline = time.monotonic() + timeout
+        while self._accepting_count() <= count:
+            if time.monotonic() > deadline:
+                raise RuntimeError("squid did not accept connections")
+            time.sleep(0.01)
+
+    def parse(self):
+        start = time.monotonic()
+        self._run("-k", "parse")
+        return time.monotonic() - start
+
+    def start(self):
+        self.process = subprocess.Popen([self.squid, "-f", self.conf, "-N"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._wait_accepting(0)
+
+    def reconfigure(self):
+        count = self._accepting_count()
+        start = time.monotonic()
+        self._run("-k", "reconfigure")
+        self._wait_accepting(count)
+        return time.monotonic() - start
+
+    def request(self, domain):
+        with socket.create_connection(("127.0.0.1", self.port), timeout=5) as sock:
+            sock.sendall(f"GET http://{domain}/ HTTP/1.1\r\nHost: {domain}\r\nConnection: close\r\n\r\n".encode())
+            while sock.recv(65536):
+                pass
+
+    def match_throughput(self, domains, requests, concurrency):
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(self.request, (domains[index % len(domains)] for index in range(requests))))
+        return requests / (time.monotonic() - start)
+
+    def stop(self):
+        if self.process:
+            self._run("-k", "shutdown")
+            self.process.wait(timeout=60)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def benchmark_squid(squid, allowlist, lookups, requests, concurrency):
+    runner = SquidRunner(squid, allowlist)
+    try:
+        parse = runner.parse()
+        runner.start()
+        reconfigure = runner.reconfigure()
+        throughput = runner.match_throughput(lookups, requests, concurrency)
+    finally:
+        runner.stop()
+    return parse, reconfigure, throughput
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Squid allowlist")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--squid", default=shutil.which("squid") or "/usr/sbin/squid")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    has_squid = os.path.exists(args.squid)
+    if not has_squid:
+        print(f"{args.squid} not found, only the compiler is benchmarked")
+
+    work_dir = tempfile.mkdtemp(prefix="allowlist-bench-")
+    try:
+        for size in args.sizes:
+            raw = generate_allowlist(size)
+            start = time.monotonic()
+            compiled, stats = compile_allowlist(raw)
+            compile_time = time.monotonic() - start
+            print(f"{size} entries: compiled to {stats['compiled']} in {compile_time * 1000:.0f} ms "
+                f"({stats['duplicates']} duplicates, {stats['covered']} covered by a wildcard)")
+            if not has_squid:
+                continue
+
+            # Requests for a mix of allowed and denied domains
+            lookups = [domain.lstrip(".") for domain in compiled[:500]] + \
+                [f"denied{index}.example.net" for index in range(500)]
+            raw_path = os.path.join(work_dir, f"raw-{size}.txt")
+            with open(raw_path, "w") as raw_h:
+                raw_h.write("".join(f"{line.lower()}\n" for line in raw))
+            compiled_path = write_allowlist(compiled, os.path.join(work_dir, f"compiled-{size}.txt"))[0]
+            for name, path in (("raw", raw_path), ("compiled", compiled_path)):
+                parse, reconfigure, throughput = benchmark_squid(args.squid, path, lookups,
+                    args.requests, args.concurrency)
+                print(f"  {name:8} parse {parse * 1000:.0f} ms, reconfigure {reconfigure * 1000:.0f} ms, "
+                    f"{throughput:.0f} requests/s")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
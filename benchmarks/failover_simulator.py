@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+# Simulate squid failovers against the failover Lambda function, without an AWS account.
+#
+# The real lambda-handler.handler runs against fake Auto Scaling, CloudWatch and EC2 clients that
+# model N AZs: one squid ASG per AZ tagged with RouteTableIds, its squid-alarm_<asg> alarm and the
+# route tables of the AZ. Every fake API call sleeps for its simulated latency multiplied by
+# --time-scale, so the concurrency of the route planner is measured as it would run in AWS.
+#
+# Each scenario replays a sequence of ALARM/OK SNS deliveries (flapping, simultaneous failures,
+# duplicate and stale deliveries...) and reports the API calls, the simulated time until the routes converged
+# to their final state, and the final route of every route table.
+#
+# The health probes of a failed ASG set its instances to Unhealthy before its alarm goes to ALARM: they are
+# replaced right away by a new instance in Pending:Wait. The boot time of the replacement is not simulated,
+# use the delivery offsets of the scenarios for it.
+#
+# The invocations are coordinated through an in-memory failover state table, like the DynamoDB
+# table of the stack, unless --no-coordination is given.
+#
+# Usage: python benchmarks/failover_simulator.py [--azs 3] [--route-tables-per-az 2] [--scenario flapping]
+
+import argparse
+import collections
+import contextlib
+import copy
+import datetime
+import importlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  '..', 'squid_app', 'squid_config_files', 'lambda'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+TOPIC_ARN = 'arn:aws:sns:us-east-1:111111111111:squid-alarm-topic'
+
+# Simulated latency of the API calls, in seconds
+LATENCIES = {
+  'DescribeAutoScalingGroups': 0.15,
+  'DescribeLifecycleHooks': 0.1,
+  'CompleteLifecycleAction': 0.1,
+  'DescribeAlarms': 0.1,
+  'GetMetricData': 0.1,
+  'DescribeRouteTables': 0.2,
+  'CreateRoute': 0.3,
+  'ReplaceRoute': 0.3,
+  'CreateTags': 0.15,
+  'UpdateItem': 0.01,
+  'BatchGetItem': 0.01
+}
+THROTTLED_OPERATIONS = ('CreateRoute', 'ReplaceRoute', 'CreateTags')
+PAGE_SIZE = 50
+
+
+def camel_case(name):
+  return ''.join(part.capitalize() for part in name.split('_'))
+
+
+# State of the simulated AWS account, shared by the fake clients
+class FakeAws:
+  def __init__(self, azs, route_tables_per_az, instances_per_asg, time_scale, throttle_rate, seed=0):
+    self.time_scale = time_scale
+    self.throttle_rate = throttle_rate
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.calls = collections.Counter()
+    self.asgs = collections.OrderedDict()
+    self.alarms = collections.OrderedDict()
+    self.route_tables = collections.OrderedDict()
+    self.route_writes = {}
+    self.clock = None
+    self._instance_count = collections.Counter()
+
+    for az in range(1, azs + 1):
+      asg_name = 'squid-asg-%d' % az
+      route_table_ids = ['rtb-%d%s' % (az, chr(ord('a') + index)) for index in range(route_tables_per_az)]
+      self.asgs[asg_name] = {
+        'AutoScalingGroupName': asg_name,
+        'Instances': [self._new_instance(asg_name, 'InService') for _ in range(instances_per_asg)],
+        'Tags': [{'Key': 'RouteTableIds', 'Value': ','.join(route_table_ids)}]
+      }
+      self.alarms[asg_name] = {
+        'AlarmName': 'squid-alarm_%s' % asg_name,
+        'StateValue': 'OK',
+        'AlarmActions': [TOPIC_ARN]
+      }
+      instance_ids = sorted(instance['InstanceId'] for instance in self.asgs[asg_name]['Instances'])
+      for index, route_table_id in enumerate(route_table_ids):
+        self.route_tables[route_table_id] = {
+          'RouteTableId': route_table_id,
+          'Routes': [{'DestinationCidrBlock': '0.0.0.0/0', 'InstanceId': instance_ids[index % len(instance_ids)],
+            'State': 'active'}],
+          'Tags': [{'Key': 'AutoScalingGroupName', 'Value': asg_name}]
+        }
+
+  def _new_instance(self, asg_name, lifecycle_state):
+    self._instance_count[asg_name] += 1
+    return {
+      'InstanceId': 'i-%s-%d' % (asg_name.rsplit('-', 1)[1], self._instance_count[asg_name]),
+      'HealthStatus': 'Healthy',
+      'LifecycleState': lifecycle_state
+    }
+
+  def call(self, operation):
+    with self.lock:
+      self.calls[operation] += 1
+      throttled = operation in THROTTLED_OPERATIONS and self.random.random() < self.throttle_rate
+    time.sleep(LATENCIES.get(operation, 0.1) * self.time_scale)
+    if throttled:
+      raise ClientError({'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded.'}}, operation)
+
+  # The ASG replaces its unhealthy instances with new ones, waiting for their launch lifecycle action
+  def replace_instances(self, asg_name):
+    asg = self.asgs[asg_name]
+    asg['Instances'] = [self._new_instance(asg_name, 'Pending:Wait') for _ in asg['Instances']]
+
+  def instance_asg(self, instance_id):
+    for asg_name, asg in self.asgs.items():
+      if any(instance['InstanceId'] == instance_id for instance in asg['Instances']):
+        return asg_name
+    return None
+
+  def default_route(self, route_table_id):
+    for route in self.route_tables[route_table_id]['Routes']:
+      if route['DestinationCidrBlock'] == '0.0.0.0/0':
+        return route
+    return None
+
+  def write_route(self, route_table_id, instance_id):
+    route = self.default_route(route_table_id)
+    if route is None:
+      route = {'DestinationCidrBlock': '0.0.0.0/0', 'State': 'active'}
+      self.route_tables[route_table_id]['Routes'].append(route)
+    route['InstanceId'] = instance_id
+    self.route_writes[route_table_id] = self.clock()
+
+
+class FakePaginator:
+  def __init__(self, aws, operation, pages):
+    self.aws = aws
+    self.operation = operation
+    self.pages = pages
+
+  def paginate(self, **parameters):
+    for page in self.pages(**parameters):
+      self.aws.call(self.operation)
+      yield copy.deepcopy(page)
+
+
+def paged(key, items):
+  items = list(items)
+  for index in range(0, max(len(items), 1), PAGE_SIZE):
+    yield {key: items[index:index + PAGE_SIZE]}
+
+
+class FakeAutoScaling:
+  def __init__(self, aws):
+    self.aws = aws
+
+  def get_paginator(self, name):
+    return FakePaginator(self.aws, camel_case(name),
+      lambda **parameters: paged('AutoScalingGroups', self.aws.asgs.values()))
+
+  def describe_lifecycle_hooks(self, AutoScalingGroupName):
+    self.aws.call('DescribeLifecycleHooks')
+    return {'LifecycleHooks': [
+      {'LifecycleHookName': '%s-launch-hook' % AutoScalingGroupName,
+        'LifecycleTransition': 'autoscaling:EC2_INSTANCE_LAUNCHING'},
+      {'LifecycleHookName': '%s-terminate-hook' % AutoScalingGroupName,
+        'LifecycleTransition': 'autoscaling:EC2_INSTANCE_TERMINATING'}]}
+
+  def complete_lifecycle_action(self, LifecycleHookName, AutoScalingGroupName, LifecycleActionResult, InstanceId):
+    self.aws.call('CompleteLifecycleAction')
+    with self.aws.lock:
+      for instance in self.aws.asgs[AutoScalingGroupName]['Instances']:
+        if instance['InstanceId'] == InstanceId and instance['LifecycleState'] == 'Pending:Wait':
+          instance['LifecycleState'] = 'InService'
+          return {}
+    raise ClientError({'Error': {'Code': 'ValidationError', 'Message': 'No active Lifecycle Action'}},
+      'CompleteLifecycleAction')
+
+
+class FakeCloudWatch:
+  def __init__(self, aws):
+    self.aws = aws
+
+  # NetworkOut of an instance grows with the route tables it serves, the request rate of an ASG with its
+  # route tables, and the probe latency is random
+  def get_metric_data(self, MetricDataQueries, StartTime, EndTime):
+    self.aws.call('GetMetricData')
+    results = []
+    with self.aws.lock:
+      for query in MetricDataQueries:
+        metric = query['MetricStat']['Metric']
+        value = metric['Dimensions'][0]['Value']
+        if metric['MetricName'] == 'NetworkOut':
+          load = 50e6 * sum(1 for route_table_id in self.aws.route_tables
+            if self.aws.default_route(route_table_id)['InstanceId'] == value)
+        elif metric['MetricName'] == 'RequestRate':
+          load = 100.0 * sum(1 for route_table_id in self.aws.route_tables
+            if self.aws.instance_asg(self.aws.default_route(route_table_id)['InstanceId']) == value)
+        else:
+          load = self.aws.random.uniform(5, 20)
+        results.append({'Id': query['Id'], 'Values': [load * self.aws.random.uniform(0.8, 1.2)]})
+    return {'MetricDataResults': results}
+
+  def get_paginator(self, name):
+    return FakePaginator(self.aws, camel_case(name),
+      lambda AlarmNamePrefix, ActionPrefix=None: paged('MetricAlarms', [alarm for alarm in self.aws.alarms.values()
+        if alarm['AlarmName'].startswith(AlarmNamePrefix)]))
+
+
+class FakeEc2:
+  def __init__(self, aws):
+    self.aws = aws
+
+  def get_paginator(self, name):
+    def pages(Filters):
+      route_table_ids = Filters[0]['Values']
+      return paged('RouteTables', [route_table for route_table_id, route_table in self.aws.route_tables.items()
+        if route_table_id in route_table_ids])
+    return FakePaginator(self.aws, camel_case(name), pages)
+
+  def create_route(self, RouteTableId, DestinationCidrBlock, InstanceId):
+    self.aws.call('CreateRoute')
+    with self.aws.lock:
+      if self.aws.default_route(RouteTableId):
+        raise ClientError({'Error': {'Code': 'RouteAlreadyExists', 'Message': 'Route exists'}}, 'CreateRoute')
+      self.aws.write_route(RouteTableId, InstanceId)
+
+  def replace_route(self, RouteTableId, DestinationCidrBlock, InstanceId):
+    self.aws.call('ReplaceRoute')
+    with self.aws.lock:
+      if not self.aws.default_route(RouteTableId):
+        raise ClientError({'Error': {'Code': 'InvalidRoute.NotFound', 'Message': 'No route'}}, 'ReplaceRoute')
+      self.aws.write_route(RouteTableId, InstanceId)
+
+  def create_tags(self, Resources, Tags):
+    self.aws.call('CreateTags')
+    with self.aws.lock:
+      for route_table_id in Resources:
+        route_table = self.aws.route_tables[route_table_id]
+        keys = {tag['Key'] for tag in Tags}
+        route_table['Tags'] = [tag for tag in route_table['Tags'] if tag['Key'] not in keys] + list(Tags)
+
+
+# Stands in for the ApiCallCounter of the handler, the calls are counted by the fake clients
+class SimulatedApiCalls:
+  def __init__(self, aws):
+    self.aws = aws
+
+  def reset(self):
+    pass
+
+  @property
+  def total(self):
+    return sum(self.aws.calls.values())
+
+  def summary(self):
+    return ', '.join('%s=%d' % (name, count) for name, count in sorted(self.aws.calls.items()))
+
+
+# In-memory failover state table, with the conditional writes of the DynamoDB state store
+class FakeStateStore:
+  def __init__(self, aws):
+    self.aws = aws
+    self.lease = None
+    self.transition_times = {}
+
+  def acquire_lease(self, owner, now_ms, expires_ms):
+    self.aws.call('UpdateItem')
+    with self.aws.lock:
+      if self.lease is None or self.lease[1] < now_ms or self.lease[0] == owner:
+        self.lease = (owner, expires_ms)
+        return True
+      return False
+
+  def renew_lease(self, owner, expires_ms):
+    self.aws.call('UpdateItem')
+    with self.aws.lock:
+      if self.lease and self.lease[0] == owner:
+        self.lease = (owner, expires_ms)
+        return True
+      return False
+
+  def release_lease(self, owner):
+    self.aws.call('UpdateItem')
+    with self.aws.lock:
+      if self.lease and self.lease[0] == owner:
+        self.lease = None
+
+  def last_transition_times(self, asg_names):
+    self.aws.call('BatchGetItem')
+    with self.aws.lock:
+      return {asg_name: self.transition_times[asg_name] for asg_name in asg_names if asg_name in self.transition_times}
+
+  def record_transition(self, transition):
+    self.aws.call('UpdateItem')
+    with self.aws.lock:
+      if self.transition_times.get(transition.asg_name, -1) < transition.time:
+        self.transition_times[transition.asg_name] = transition.time
+
+
+# Simulated time of the scenario start, in the format of the StateChangeTime of the alarm notifications
+EPOCH = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+
+def state_change_time(seconds):
+  return (EPOCH + datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + '+0000'
+
+def sns_event(states, offset):
+  return {'Records': [{'Sns': {'Message': json.dumps({
+    'AlarmName': 'squid-alarm_%s' % state[0],
+    'NewStateValue': state[1],
+    'StateChangeTime': state_change_time(state[2] if len(state) > 2 else offset)
+  })}} for state in states]}
+
+
+# A scenario is a list of deliveries: (offset in simulated seconds, [(asg name, new alarm state), ...])
+# Deliveries with the same offset run as concurrent Lambda invocations. A state may have a third element,
+# the simulated time of the alarm state change when it is older than the delivery (late or repeated delivery)
+SCENARIOS = collections.OrderedDict([
+  ('single-failure', [(0, [('squid-asg-1', 'ALARM')])]),
+  ('failure-and-recovery', [(0, [('squid-asg-1', 'ALARM')]), (60, [('squid-asg-1', 'OK')])]),
+  ('flapping', [(0, [('squid-asg-1', 'ALARM')]), (10, [('squid-asg-1', 'OK')]),
+    (20, [('squid-asg-1', 'ALARM')]), (30, [('squid-asg-1', 'OK')])]),
+  ('simultaneous-failures-batched', [(0, [('squid-asg-1', 'ALARM'), ('squid-asg-2', 'ALARM')])]),
+  ('simultaneous-failures-concurrent', [(0, [('squid-asg-1', 'ALARM')]), (0, [('squid-asg-2', 'ALARM')])]),
+  ('duplicate-delivery', [(0, [('squid-asg-1', 'ALARM')]), (1, [('squid-asg-1', 'ALARM', 0)])]),
+  ('stale-redelivery', [(0, [('squid-asg-1', 'ALARM')]), (10, [('squid-asg-1', 'OK')]),
+    (20, [('squid-asg-1', 'ALARM', 0)])]),
+  ('out-of-order-batch', [(0, [('squid-asg-1', 'ALARM')]), (10, [('squid-asg-1', 'OK', 10), ('squid-asg-1', 'ALARM', 0)])]),
+  ('all-failed', [(0, [('squid-asg-%d' % az, 'ALARM')]) for az in (1, 2, 3)])
+])
+
+
+# The routes have converged when each route table points to an instance of its own ASG if the alarm of the
+# ASG is OK, or else to an instance of another ASG whose alarm is OK
+def check_routes(aws):
+  problems = []
+  healthy_asgs = {name for name, alarm in aws.alarms.items() if alarm['StateValue'] == 'OK'}
+  for asg_name, asg in aws.asgs.items():
+    route_table_ids = asg['Tags'][0]['Value'].split(',')
+    for route_table_id in route_table_ids:
+      target_asg = aws.instance_asg(aws.default_route(route_table_id)['InstanceId'])
+      if asg_name in healthy_asgs and target_asg != asg_name:
+        problems.append('%s should route to %s, routes to %s' % (route_table_id, asg_name, target_asg))
+      elif asg_name not in healthy_asgs and healthy_asgs and target_asg not in healthy_asgs:
+        problems.append('%s routes to the failed ASG %s' % (route_table_id, target_asg))
+  return problems
+
+
+# Run the deliveries of an offset as concurrent invocations and return their simulated durations
+def run_deliveries(handler_module, aws, deliveries, offset, args):
+  batch = [states for delivery_offset, states in deliveries if delivery_offset == offset]
+  # CloudWatch changes the alarm states before SNS delivers the notifications, late deliveries leave them unchanged
+  for states in batch:
+    for state in states:
+      changed = state[2] if len(state) > 2 else offset
+      if changed >= aws.alarm_changes.get(state[0], -1):
+        if state[1] == 'ALARM' and aws.alarms[state[0]]['StateValue'] != 'ALARM':
+          aws.replace_instances(state[0])
+        aws.alarms[state[0]]['StateValue'] = state[1]
+        aws.alarms[state[0]]['StateUpdatedTimestamp'] = EPOCH + datetime.timedelta(seconds=changed)
+        aws.alarm_changes[state[0]] = changed
+  # Wait until the offset of the deliveries, in simulated time
+  time.sleep(max(0, offset - aws.clock()) * args.time_scale)
+
+  def invoke(states):
+    invocation_start = aws.clock()
+    handler_module.handler(sns_event(states, offset), None)
+    return aws.clock() - invocation_start
+
+  with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+    return list(executor.map(invoke, batch))
+
+
+def run_scenario(handler_module, deliveries, args):
+  aws = FakeAws(args.azs, args.route_tables_per_az, args.instances_per_asg, args.time_scale, args.throttle_rate)
+  handler_module.as_client = FakeAutoScaling(aws)
+  handler_module.cw_client = FakeCloudWatch(aws)
+  handler_module.ec2_client = FakeEc2(aws)
+  handler_module.api_calls = SimulatedApiCalls(aws)
+  handler_module.strategy = handler_module.target_strategy(args.strategy)
+  aws.alarm_changes = {}
+  if args.no_coordination:
+    handler_module.coordinator = handler_module.NoCoordination()
+  else:
+    handler_module.coordinator = handler_module.FailoverCoordinator(FakeStateStore(aws),
+      poll_interval=0.1 * args.time_scale)
+  # The backoff delay of throttled calls is scaled like the API latencies
+  handler_module.route_planner = handler_module.RoutePlanner(handler_module.ec2_client,
+    max_workers=args.concurrency, base_delay=0.1 * args.time_scale)
+  start = time.monotonic()
+  aws.clock = lambda: (time.monotonic() - start) / args.time_scale
+
+  offsets = sorted({offset for offset, _ in deliveries})
+  invocation_times = []
+  # The logs of the handler are only printed with --verbose
+  output = sys.stdout if args.verbose else io.StringIO()
+  with contextlib.redirect_stdout(output):
+    for offset in offsets:
+      invocation_times += run_deliveries(handler_module, aws, deliveries, offset, args)
+
+  # Simulated time of the last route change, from the first and from the last delivery
+  last_write = max(list(aws.route_writes.values()) + [offsets[0]])
+  convergence = (last_write - offsets[0], max(0, last_write - offsets[-1]))
+  return aws, invocation_times, convergence, check_routes(aws)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Simulate squid failovers against the failover Lambda function')
+  parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='default: all the scenarios')
+  parser.add_argument('--azs', type=int, default=3)
+  parser.add_argument('--route-tables-per-az', type=int, default=2)
+  parser.add_argument('--instances-per-asg', type=int, default=1)
+  parser.add_argument('--concurrency', type=int, default=8, help='route updates applied in parallel')
+  parser.add_argument('--strategy', default='spread', help='failover target strategy (TARGET_STRATEGY)')
+  parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of the route calls throttled')
+  parser.add_argument('--time-scale', type=float, default=0.1, help='real seconds per simulated second')
+  parser.add_argument('--no-coordination', action='store_true',
+    help='process every delivery without lease nor de-duplication, as without STATE_TABLE')
+  parser.add_argument('--verbose', action='store_true', help='print the logs of the handler')
+  args = parser.parse_args()
+
+  handler_module = importlib.import_module('lambda-handler')
+  for name in args.scenario or SCENARIOS:
+    deliveries = [(offset, states) for offset, states in SCENARIOS[name]
+      if all(int(state[0].rsplit('-', 1)[1]) <= args.azs for state in states)]
+    aws, invocation_times, convergence, problems = run_scenario(handler_module, deliveries, args)
+    print('%s: %d invocation(s), routes converged %.2f s after the first delivery (%.2f s after the last), '
+      'invocations %s s' % (name, len(invocation_times), convergence[0], convergence[1],
+      ', '.join('%.2f' % seconds for seconds in invocation_times)))
+    print('  %d API calls: %s' % (sum(aws.calls.values()),
+      ', '.join('%s=%d' % (operation, count) for operation, count in sorted(aws.calls.items()))))
+    for route_table_id in aws.route_tables:
+      instance_id = aws.default_route(route_table_id)['InstanceId']
+      print('  %s -> %s (%s)' % (route_table_id, instance_id, aws.instance_asg(instance_id) or 'terminated'))
+    for problem in problems:
+      print('  NOT CONVERGED: %s' % problem)
+
+if __name__ == '__main__':
+  main()
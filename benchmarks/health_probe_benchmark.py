@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Measure how long the squid health probe takes to detect a failed squid.
+#
+# A fake squid listens on local forward and intercept ports. After a warm-up, the fake
+# squid either crashes (stops listening) or hangs (accepts connections without answering)
+# and the time until the probe reports the failure is recorded.
+#
+# Usage: python benchmarks/health_probe_benchmark.py [--runs 5] [--interval 0.5]
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  '..', 'squid_app', 'squid_config_files', 'health_probe'))
+
+from squid_health_probe import SquidHealthProbe
+
+
+class FakeSquid:
+  def __init__(self):
+    self.hung = False
+    self.servers = []
+    self.ports = {}
+
+  async def start(self):
+    for name, handler in (('forward', self._forward), ('http', self._intercept_http),
+        ('https', self._intercept_https)):
+      server = await asyncio.start_server(handler, '127.0.0.1', 0)
+      self.servers.append(server)
+      self.ports[name] = server.sockets[0].getsockname()[1]
+
+  async def _hang(self, writer):
+    while self.hung:
+      await asyncio.sleep(1)
+    writer.close()
+
+  async def _forward(self, reader, writer):
+    if self.hung:
+      return await self._hang(writer)
+    await reader.readuntil(b'\r\n\r\n')
+    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+    await writer.drain()
+    writer.close()
+
+  async def _intercept_http(self, reader, writer):
+    if self.hung:
+      return await self._hang(writer)
+    await reader.readuntil(b'\r\n\r\n')
+    writer.write(b'HTTP/1.1 409 Conflict\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+    await writer.drain()
+    writer.close()
+
+  # Squid terminates peeked TLS connections that are not intercepted
+  async def _intercept_https(self, reader, writer):
+    if self.hung:
+      return await self._hang(writer)
+    await reader.read(1024)
+    writer.close()
+
+  def crash(self):
+    for server in self.servers:
+      server.close()
+
+  def hang(self):
+    self.hung = True
+
+  def stop(self):
+    self.hung = False
+    self.crash()
+
+
+async def measure(fault, interval, timeout, failure_threshold, warmup):
+  squid = FakeSquid()
+  await squid.start()
+  detected = asyncio.Event()
+  probe = SquidHealthProbe(
+    forward_port=squid.ports['forward'],
+    http_port=squid.ports['http'],
+    https_port=squid.ports['https'],
+    probe_url='http://allowed.example.com/',
+    probe_domain='allowed.example.com',
+    interval=interval,
+    forward_interval=interval,
+    timeout=timeout,
+    failure_threshold=failure_threshold,
+    on_failure=lambda results: detected.set()
+  )
+  task = asyncio.ensure_future(probe.run())
+  await asyncio.sleep(warmup)
+  if probe.failed:
+    raise RuntimeError('probe failed before the fault was injected')
+
+  fault_at = time.monotonic()
+  getattr(squid, fault)()
+  await detected.wait()
+  detection = time.monotonic() - fault_at
+
+  task.cancel()
+  squid.stop()
+  latencies = [result.latency_ms for results in probe.drain() for result in results if result.success]
+  return detection, statistics.median(latencies) if latencies else 0.0
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the squid health probe detection time')
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--interval', type=float, default=0.5)
+  parser.add_argument('--timeout', type=float, default=0.4)
+  parser.add_argument('--failure-threshold', type=int, default=3)
+  parser.add_argument('--warmup', type=float, default=2.0)
+  args = parser.parse_args()
+
+  loop = asyncio.get_event_loop()
+  print('interval=%.2fs timeout=%.2fs failure_threshold=%d' % (args.interval, args.timeout, args.failure_threshold))
+  for fault in ('crash', 'hang'):
+    detections = []
+    latencies = []
+    for _ in range(args.runs):
+      detection, latency = loop.run_until_complete(
+        measure(fault, args.interval, args.timeout, args.failure_threshold, args.warmup))
+      detections.append(detection)
+      latencies.append(latency)
+    print('%-5s detection: median %.2fs, max %.2fs (healthy probe latency median %.1f ms)' % (
+      fault, statistics.median(detections), max(detections), statistics.median(latencies)))
+
+if __name__ == '__main__':
+  main()
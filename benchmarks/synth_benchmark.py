@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Measure the synthesis of the CDK app for more AZs and more copies of the Squid deployment.
+#
+# For every number of AZs and of copies, an app with a VPC stack and a Squid stack per copy is built
+# and synthesized in-process, in a temporary output directory. The availability zones are set in
+# the context, so that no AWS credentials are needed. The benchmark reports:
+# - build: the time to create the constructs of the app
+# - synth: the time of app.synth(), including the asset staging
+# - the size and the number of resources of the Squid templates
+# With --cold, the template files and the staged config files are not reused across the apps of a run.
+#
+# Usage: python benchmarks/synth_benchmark.py [--azs 2 3 6] [--copies 1 5] [--cold]
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from aws_cdk import core
+
+from squid_app import squid_config_staging
+from squid_app.squid_stack import SquidStack
+from squid_app.vpc_stack import VPCStack
+
+ACCOUNT = '123456789012'
+REGION = 'us-east-1'
+AVAILABILITY_ZONES = [f'{REGION}{zone}' for zone in 'abcdef']
+
+
+def build_app(outdir, azs, copies):
+    app = core.App(outdir=outdir, context={
+        f'availability-zones:account={ACCOUNT}:region={REGION}': AVAILABILITY_ZONES,
+    })
+    env = core.Environment(account=ACCOUNT, region=REGION)
+    for copy in range(1, copies + 1):
+        vpc_stack = VPCStack(app, f'vpc-{copy}', env=env, vpc_cidr=f'10.{copy}.0.0/16', max_azs=azs)
+        SquidStack(app, f'squid-{copy}', env=env, vpc=vpc_stack.vpc)
+    return app
+
+
+def run(azs, copies, cold):
+    if cold:
+        squid_config_staging.read_template.cache_clear()
+        squid_config_staging._stage_config_files.cache_clear()
+    outdir = tempfile.mkdtemp(prefix='squid-synth-')
+    try:
+        start = time.perf_counter()
+        app = build_app(outdir, azs, copies)
+        built = time.perf_counter()
+        app.synth()
+        synthesized = time.perf_counter()
+
+        template_bytes = resources = 0
+        for path in glob.glob(os.path.join(outdir, 'squid-*.template.json')):
+            with open(path) as template_h:
+                template = template_h.read()
+            template_bytes += len(template)
+            resources += len(json.loads(template)['Resources'])
+        return built - start, synthesized - built, template_bytes // copies, resources // copies
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the synthesis of the Squid CDK app')
+    parser.add_argument('--azs', type=int, nargs='+', default=[2, 3, 6])
+    parser.add_argument('--copies', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--cold', action='store_true', help='do not reuse the template and config files')
+    args = parser.parse_args()
+
+    # The asset paths of the app are relative to the repository root
+    os.chdir(ROOT)
+    os.environ.setdefault('JSII_SILENCE_WARNING_DEPRECATED_NODE_VERSION', '1')
+
+    print('%4s %6s %9s %9s %14s %16s' % ('azs', 'copies', 'build s', 'synth s', 'bytes/stack', 'resources/stack'))
+    for azs in args.azs:
+        if azs > len(AVAILABILITY_ZONES):
+            raise ValueError(f'At most {len(AVAILABILITY_ZONES)} AZs')
+        for copies in args.copies:
+            build_time, synth_time, template_bytes, resources = run(azs, copies, args.cold)
+            print('%4d %6d %9.2f %9.2f %14d %16d' % (azs, copies, build_time, synth_time, template_bytes, resources))
+
+if __name__ == '__main__':
+    main()
@@ -22,15 +22,25 @@ setuptools.setup(
         "aws-cdk.core",
         "aws_cdk.aws_s3",
         "aws_cdk.aws_s3_deployment",
+        "aws_cdk.aws_s3_assets",
+        "aws_cdk.aws_s3_notifications",
+        "aws_cdk.aws_secretsmanager",
+        "aws_cdk.aws_logs",
+        "aws_cdk.aws_logs_destinations",
         "aws_cdk.aws_ec2",
         "aws_cdk.aws_autoscaling",
         "aws_cdk.aws_autoscaling_hooktargets",
         "aws_cdk.aws_iam",
+        "aws_cdk.aws_imagebuilder",
         "aws_cdk.aws_lambda",
         "aws_cdk.aws_cloudwatch",
         "aws_cdk.aws_cloudwatch_actions",
         "aws_cdk.aws_sns",
-        "aws_cdk.aws_sns_subscriptions"
+        "aws_cdk.aws_dynamodb",
+        "aws_cdk.aws_sns_subscriptions",
+        "aws_cdk.aws_ssm",
+        "aws_cdk.aws_stepfunctions",
+        "aws_cdk.aws_stepfunctions_tasks"
     ],
 
     python_requires=">=3.6",
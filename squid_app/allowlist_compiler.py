@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# Compile the Squid allowlist (allowed_domains.txt)
+#
+# The allowlist is loaded in a dstdomain and a ssl::server_name ACL. A leading dot allows the
+# domain and all its subdomains (".example.com"), otherwise only the exact domain is allowed.
+# Squid warns about and ignores entries that overlap, so the compiler normalizes the entries,
+# removes the duplicates and the domains covered by a wildcard parent, and fails on invalid entries.
+#
+# Usage: python squid_app/allowlist_compiler.py allowed_domains.txt -o compiled.txt [--split 10000]
+
+import argparse
+import os
+import re
+import sys
+
+LABEL_RE = re.compile(r'^[a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9_])?$')
+
+
+class AllowlistError(ValueError):
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("Invalid allowlist entries:\n" + "\n".join(
+            f"  line {line_number}: {entry!r}: {reason}" for line_number, entry, reason in errors))
+
+
+# Return the entry in the form used by Squid, or raise ValueError
+def normalize_domain(entry):
+    domain = entry.strip().lower().rstrip(".")
+    # "*.example.com" is a common way to write ".example.com"
+    if domain.startswith("*."):
+        domain = domain[1:]
+    wildcard = domain.startswith(".")
+    name = domain.lstrip(".")
+    if not name:
+        raise ValueError("empty domain")
+    if "/" in name or ":" in name:
+        raise ValueError("not a domain, remove the scheme, port and path")
+    try:
+        name = name.encode("idna").decode("ascii")
+    except UnicodeError as error:
+        raise ValueError(f"invalid internationalized domain: {error}")
+    if len(name) > 253:
+        raise ValueError("domain longer than 253 characters")
+    for label in name.split("."):
+        if not LABEL_RE.match(label):
+            raise ValueError(f"invalid label {label!r}")
+    return f".{name}" if wildcard else name
+
+
+# Return True if the domain (".example.com" or "example.com") is allowed by one of the wildcard parents
+def covered_by_wildcard(domain, wildcards):
+    labels = domain.lstrip(".").split(".")
+    # An exact domain is also covered by a wildcard on the same domain
+    start = 1 if domain.startswith(".") else 0
+    for index in range(start, len(labels)):
+        if ".".join(labels[index:]) in wildcards:
+            return True
+    return False
+
+
+# Sort on the reversed labels to group the subdomains of a domain
+def domain_sort_key(domain):
+    return domain.lstrip(".").split(".")[::-1]
+
+
+# Compile the allowlist lines, return the sorted list of entries and the compile statistics
+def compile_allowlist(lines):
+    domains = set()
+    errors = []
+    entries = 0
+    for line_number, line in enumerate(lines, start=1):
+        entry = line.split("#", 1)[0].strip()
+        if not entry:
+            continue
+        entries += 1
+        try:
+            domains.add(normalize_domain(entry))
+        except ValueError as error:
+            errors.append((line_number, entry, str(error)))
+    if errors:
+        raise AllowlistError(errors)
+
+    wildcards = {domain[1:] for domain in domains if domain.startswith(".")}
+    compiled = sorted((domain for domain in domains if not covered_by_wildcard(domain, wildcards)),
+        key=domain_sort_key)
+    stats = {
+        "entries": entries,
+        "duplicates": entries - len(domains),
+        "covered": len(domains) - len(compiled),
+        "compiled": len(compiled)
+    }
+    return compiled, stats
+
+
+# Write the compiled entries to path, or to several numbered files when there are more than split entries
+# Return the paths of the files written
+def write_allowlist(domains, path, split=None):
+    if not split or len(domains) <= split:
+        chunks = [domains]
+        paths = [path]
+    else:
+        chunks = [domains[index:index + split] for index in range(0, len(domains), split)]
+        stem, extension = os.path.splitext(path)
+        paths = [f"{stem}.{count}{extension}" for count in range(1, len(chunks) + 1)]
+    for chunk_path, chunk in zip(paths, chunks):
+        with open(chunk_path, "w") as allowlist_h:
+            allowlist_h.write("".join(f"{domain}\n" for domain in chunk))
+    return paths
+
+
+# Compile the allowlist file source into destination
+def compile_allowlist_file(source, destination, split=None):
+    with open(source, "r") as allowlist_h:
+        domains, stats = compile_allowlist(allowlist_h)
+    return write_allowlist(domains, destination, split), stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the Squid allowlist")
+    parser.add_argument("source", help="allowlist to compile, one domain per line")
+    parser.add_argument("-o", "--output", required=True, help="compiled allowlist")
+    parser.add_argument("--split", type=int, help="maximum number of entries per file, "
+        "the files must then all be referenced on the ACL lines of squid.conf")
+    args = parser.parse_args()
+
+    try:
+        paths, stats = compile_allowlist_file(args.source, args.output, args.split)
+    except AllowlistError as error:
+        sys.exit(str(error))
+    print("{entries} entries, {duplicates} duplicates, {covered} covered by a wildcard, "
+        "{compiled} compiled".format(**stats))
+    print("Written: " + ", ".join(paths))
+
+
+if __name__ == "__main__":
+    main()
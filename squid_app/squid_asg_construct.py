@@ -1,17 +1,81 @@
 from aws_cdk import (
     aws_s3 as s3,
     aws_s3_deployment as s3_deployment,
+    aws_s3_assets as s3_assets,
     aws_ec2 as ec2,
     aws_autoscaling as autoscaling,
     aws_autoscaling_hooktargets as hooktargets,
+    aws_cloudwatch as cloudwatch,
     aws_iam as iam,
+    aws_secretsmanager as secretsmanager,
     aws_sns as sns,
+    aws_ssm as ssm,
     core
 )
+import uuid
+
+from squid_app.squid_cache_profile import cache_profile, render_cache_conf, render_cache_volume_setup
+from squid_app.squid_fair_share import FAIR_SHARE_FILE, fair_share_profile, render_fair_share_conf, render_fair_share_json
+from squid_app.squid_config_staging import read_template, ssl_bump_conf, stage_config_files
+from squid_app.squid_tuning_profile import (
+    render_kernel_tuning,
+    render_network_setup,
+    render_squid_conf,
+    tuning_profile
+)
+
+# Commands that create the key of the SSL Bump CA
+CA_KEY_COMMANDS = {
+    "ecdsa": "openssl ecparam -name prime256v1 -genkey -noout -out squid.key",
+    "rsa": "openssl genrsa -out squid.key 2048"
+}
+
+# State of the standby instances kept in the warm pool of each ASG
+WARM_POOL_STATES = {
+    "stopped": autoscaling.PoolState.STOPPED,
+    "running": autoscaling.PoolState.RUNNING
+}
+
+# Pipelines of the access logs: all the lines in CloudWatch Logs, or compressed batches in S3
+# with only the denied requests, the errors and a sample of the other requests in CloudWatch Logs
+ACCESS_LOG_PIPELINES = ("cloudwatch", "s3")
 
 class SquidAsgConstruct(core.Construct):
-    def __init__(self, scope: core.Construct, id: str, vpc: ec2.Vpc, region: str) -> None:
+    def __init__(self, scope: core.Construct, id: str, vpc: ec2.Vpc, region: str,
+        health_probe_url: str = "http://checkip.amazonaws.com/",
+        instance_type: str = "t3.nano",
+        min_capacity: int = 1,
+        max_capacity: int = 1,
+        scaling_metric: str = None,
+        scaling_target: float = None,
+        ami_id: str = None,
+        bump_ca_key_type: str = "ecdsa",
+        sslcrtd_children: int = 8,
+        ssl_cert_cache_mb: int = 16,
+        firewall: str = "iptables",
+        warm_pool: str = "none",
+        cache_volume: str = "none",
+        cache_volume_gb: int = 50,
+        access_log_pipeline: str = "cloudwatch",
+        access_log_sample_rate: float = 0.01,
+        access_log_max_domains: int = 100,
+        fair_share_classes: list = None,
+        client_cidrs: list = None) -> None:
         super().__init__(scope, id)
+
+        # Squid workers, file descriptors and kernel settings for the instance type
+        profile = tuning_profile(instance_type, firewall=firewall)
+        # Response cache sized for the instance type, on an EBS or instance store volume
+        cache = cache_profile(profile, volume=cache_volume, volume_gb=cache_volume_gb)
+        # Bandwidth pools, connection caps and priority classes of the clients
+        fair_share = fair_share_profile(profile, fair_share_classes)
+
+        if bump_ca_key_type not in CA_KEY_COMMANDS:
+            raise ValueError(f"Unknown bump CA key type: {bump_ca_key_type}")
+        if warm_pool != "none" and warm_pool not in WARM_POOL_STATES:
+            raise ValueError(f"Unknown warm pool state: {warm_pool}")
+        if access_log_pipeline not in ACCESS_LOG_PIPELINES:
+            raise ValueError(f"Unknown access log pipeline: {access_log_pipeline}")
         
          # create an IAM role to attach to the squid instances
         squid_iam_role = iam.Role(self,"squid-role", 
@@ -27,70 +91,162 @@ class SquidAsgConstruct(core.Construct):
             )
         )
 
+        # Allow the health probe to find its ASG and to trigger the failover as soon as squid stops answering
+        # Scaled out instances complete their own launch lifecycle action as they don't get an alarm state change
+        squid_iam_role.add_to_policy(statement= iam.PolicyStatement(effect=iam.Effect.ALLOW,
+            actions=['autoscaling:DescribeAutoScalingInstances',
+                'autoscaling:DescribeAutoScalingGroups',
+                'autoscaling:DescribeLifecycleHooks',
+                'autoscaling:CompleteLifecycleAction',],
+            resources=['*']
+            )
+        )
+
+        # Upload the health probe script that is installed on the squid instances
+        health_probe_asset = s3_assets.Asset(self,"health-probe",
+            path='./squid_app/squid_config_files/health_probe/squid_health_probe.py'
+        )
+        health_probe_asset.grant_read(squid_iam_role)
+
+        # Upload the script that downloads the configuration release of the instance
+        config_release_asset = s3_assets.Asset(self,"config-release",
+            path='./squid_app/squid_config_files/config_push/config_release.py'
+        )
+        config_release_asset.grant_read(squid_iam_role)
+
+        # Bucket of the access logs shipped by the instances, and the log shipper installed on the instances
+        self.access_log_bucket = None
+        access_log_bucket_name = ""
+        log_shipper_s3_url = ""
+        if access_log_pipeline == "s3":
+            self.access_log_bucket = s3.Bucket(self,"squid-access-logs",
+                encryption=s3.BucketEncryption.S3_MANAGED,
+                block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+                lifecycle_rules=[s3.LifecycleRule(transitions=[s3.Transition(
+                    storage_class=s3.StorageClass.INFREQUENT_ACCESS,
+                    transition_after=core.Duration.days(30))])]
+            )
+            self.access_log_bucket.grant_put(squid_iam_role)
+            access_log_bucket_name = self.access_log_bucket.bucket_name
+            log_shipper_asset = s3_assets.Asset(self,"log-shipper",
+                path='./squid_app/squid_config_files/access_logs',
+                exclude=["__pycache__"]
+            )
+            log_shipper_asset.grant_read(squid_iam_role)
+            log_shipper_s3_url = log_shipper_asset.s3_object_url
+
+        # Secret holding the SSL Bump CA shared by all the Squid instances
+        # The first instance that finds no CA version for the key type creates it, the other instances load it
+        bump_ca_secret = secretsmanager.Secret(self,"squid-bump-ca",
+            description="SSL Bump CA of the Squid instances")
+        bump_ca_secret.grant_read(squid_iam_role)
+        bump_ca_secret.grant_write(squid_iam_role)
+        bump_ca_version = str(uuid.uuid5(uuid.NAMESPACE_URL, f"squid-bump-ca/{bump_ca_key_type}"))
+
         # Create bucket to hold Squid config and whitelist files
-        squid_config_bucket = s3.Bucket(self,"squid-config",
-                                encryption = s3.BucketEncryption.KMS_MANAGED)
+        # The object versions make up the configuration releases, the old versions are kept for 90 days
+        self.squid_config_bucket = squid_config_bucket = s3.Bucket(self,"squid-config",
+                                encryption = s3.BucketEncryption.KMS_MANAGED,
+                                versioned=True,
+                                lifecycle_rules=[s3.LifecycleRule(
+                                    noncurrent_version_expiration=core.Duration.days(90))])
+
+        # Configuration release run by all the instances, and release under test on the canary instance
+        # Both hold the object version of each configuration file, they are set by the configuration rollout
+        self.config_release_parameter = ssm.StringParameter(self,"config-release-parameter",
+            description="Squid configuration release of the instances",
+            string_value="{}",
+            tier=ssm.ParameterTier.INTELLIGENT_TIERING)
+        self.config_canary_parameter = ssm.StringParameter(self,"config-canary-parameter",
+            description="Squid configuration release of the canary instance",
+            string_value="{}",
+            tier=ssm.ParameterTier.INTELLIGENT_TIERING)
+        for parameter in (self.config_release_parameter, self.config_canary_parameter):
+            parameter.grant_read(squid_iam_role)
 
-        # Upload config and whiteliest files to S3 bucket
+        # Generated Squid settings, and the fair share classes read by the health probe
+        conf_d = {"ssl_bump.conf": ssl_bump_conf(sslcrtd_children, ssl_cert_cache_mb),
+            "tuning.conf": render_squid_conf(profile),
+            "cache.conf": render_cache_conf(cache),
+            "fair_share.conf": render_fair_share_conf(fair_share)}
+        if fair_share.classes:
+            conf_d["fair_share.json"] = render_fair_share_json(fair_share)
+
+        # Upload config and whiteliest files to S3 bucket, the whitelist is compiled when the app is synthesized
         s3_deployment.BucketDeployment(self,"config",
             destination_bucket=squid_config_bucket,
-            sources=[s3_deployment.Source.asset(path='./squid_app/squid_config_files/config_files_s3')]
+            sources=[s3_deployment.Source.asset(path=stage_config_files('./squid_app/squid_config_files/config_files_s3',
+                conf_d=conf_d))]
         )
 
         # Provide access to EC2 instance role to read and write to bucket
         squid_config_bucket.grant_read_write(identity=squid_iam_role)
 
-        # Set the AMI to the latest Amazon Linux 2
-        amazon_linux_2_ami = ec2.MachineImage.latest_amazon_linux(
-            generation=ec2.AmazonLinuxGeneration.AMAZON_LINUX_2,
-            edition=ec2.AmazonLinuxEdition.STANDARD,
-            virtualization=ec2.AmazonLinuxVirt.HVM,
-            storage=ec2.AmazonLinuxStorage.GENERAL_PURPOSE
-        )
+        if ami_id:
+            # Use a pre-built Squid image: the user data only configures and starts Squid
+            squid_ami = ec2.MachineImage.generic_linux({region: ami_id})
+            image_type = "prebuilt"
+            install_script = "# Squid, the CloudWatch Agent and the health probe runtime are pre-installed in the Squid image"
+        else:
+            # Set the AMI to the latest Amazon Linux 2 and install Squid from the user data
+            squid_ami = ec2.MachineImage.latest_amazon_linux(
+                generation=ec2.AmazonLinuxGeneration.AMAZON_LINUX_2,
+                edition=ec2.AmazonLinuxEdition.STANDARD,
+                virtualization=ec2.AmazonLinuxVirt.HVM,
+                storage=ec2.AmazonLinuxStorage.GENERAL_PURPOSE
+            )
+            image_type = "stock"
+            install_script = read_template("./squid_app/squid_config_files/user_data/squid_install.sh")
 
-        if vpc.public_subnets:
-            # Squid ASGs with desired capacity as 1 Instance in each of the AZs 
-            self.squid_asgs = []
-            for count, az in enumerate(vpc.availability_zones, start=1):
-                asg = autoscaling.AutoScalingGroup(self,f"asg-{count}",vpc=vpc,
-                    instance_type=ec2.InstanceType("t3.nano"),
-                    desired_capacity=1,
-                    max_capacity=1,
-                    min_capacity=1,
-                    machine_image=amazon_linux_2_ami,
-                    role=squid_iam_role,
-                    vpc_subnets=ec2.SubnetSelection(
-                        availability_zones=[az],
-                        one_per_az=True,
-                        subnet_type=ec2.SubnetType.PUBLIC
-                        ),
-                    health_check=autoscaling.HealthCheck.ec2(grace=core.Duration.minutes(5)),
-                    resource_signal_count=1,
-                    resource_signal_timeout=core.Duration.minutes(10)
-                )
+        # Volume of the disk cache
+        cache_block_devices = None
+        if cache.volume == "ebs":
+            cache_block_devices = [ec2.BlockDevice(device_name="/dev/sdb",
+                volume=ec2.BlockDeviceVolume.ebs(cache.volume_gb,
+                    volume_type=ec2.EbsDeviceVolumeType.GP3))]
+        elif cache.volume == "instance-store":
+            cache_block_devices = [ec2.BlockDevice(device_name="/dev/sdb",
+                volume=ec2.BlockDeviceVolume.ephemeral(0))]
 
-                cfn_asg : autoscaling.CfnAutoScalingGroup = asg.node.default_child 
-                asg_logical_id = cfn_asg.logical_id
-
-                # User data: Required parameters in user data script
-                user_data_mappings = {"__S3BUCKET__": squid_config_bucket.bucket_name,
-                                    "__ASG__": asg_logical_id,
-                                    "__CW_ASG__": "${aws:AutoScalingGroupName}"
-                                    }
-                # Replace parameters with values in the user data
-                with open("./squid_app/squid_config_files/user_data/squid_user_data.sh", 'r') as user_data_h:
-                    # Use a substitution
-                    user_data_sub = core.Fn.sub(user_data_h.read(), user_data_mappings)
-
-                # Add User data to Launch Config of the autoscaling group
-                asg.add_user_data(user_data_sub)
-                
-                # Security group attached to the ASG Squid instances
-                # Outbound: All allowed
-                # Inboud: Allowed from VPC CIDR on ports 80, 443)
+        if vpc.public_subnets:
+            # User data: Required parameters in user data script
+            # The user data is the same in all the AZs: the instances find their ASG when they boot
+            user_data_mappings = {"__S3BUCKET__": squid_config_bucket.bucket_name,
+                                "__INSTALL__": install_script,
+                                "__IMAGE_TYPE__": image_type,
+                                "__HEALTH_PROBE_S3_URL__": health_probe_asset.s3_object_url,
+                                "__HEALTH_PROBE_URL__": health_probe_url,
+                                "__CONFIG_RELEASE_S3_URL__": config_release_asset.s3_object_url,
+                                "__RELEASE_PARAMETER__": self.config_release_parameter.parameter_name,
+                                "__CANARY_PARAMETER__": self.config_canary_parameter.parameter_name,
+                                "__HEALTH_PROBE_OPTIONS__": " ".join(
+                                    (["--cache-metrics"] if cache.volume != "none" else []) +
+                                    ([f"--fair-share {FAIR_SHARE_FILE}"] if fair_share.classes else [])),
+                                "__CA_SECRET__": bump_ca_secret.secret_arn,
+                                "__CA_VERSION__": bump_ca_version,
+                                "__CA_KEY_COMMAND__": CA_KEY_COMMANDS[bump_ca_key_type],
+                                "__CERT_CACHE_MB__": str(ssl_cert_cache_mb),
+                                "__KERNEL_TUNING__": render_kernel_tuning(profile),
+                                "__NETWORK_SETUP__": render_network_setup(profile),
+                                "__CACHE_VOLUME_SETUP__": render_cache_volume_setup(cache),
+                                "__ACCESS_LOG_PIPELINE__": access_log_pipeline,
+                                "__ACCESS_LOG_BUCKET__": access_log_bucket_name,
+                                "__ACCESS_LOG_SAMPLE_RATE__": str(access_log_sample_rate),
+                                "__ACCESS_LOG_MAX_DOMAINS__": str(access_log_max_domains),
+                                "__LOG_SHIPPER_S3_URL__": log_shipper_s3_url
+                                }
+            # Replace parameters with values in the user data
+            user_data = ec2.UserData.for_linux()
+            user_data.add_commands(core.Fn.sub(read_template("./squid_app/squid_config_files/user_data/squid_user_data.sh"),
+                user_data_mappings))
 
-                asg.connections.allow_from(other=ec2.Peer.ipv4(vpc.vpc_cidr_block),
-                    port_range=ec2.Port(
+            # Security group attached to the Squid instances of all the ASGs
+            # Outbound: All allowed
+            # Inboud: Allowed from VPC CIDR and from the client CIDRs (spoke VPCs) on ports 80, 443)
+            squid_security_group = ec2.SecurityGroup(self,"squid-sg", vpc=vpc, allow_all_outbound=True)
+            for cidr in [vpc.vpc_cidr_block] + (client_cidrs or []):
+                squid_security_group.add_ingress_rule(peer=ec2.Peer.ipv4(cidr),
+                    connection=ec2.Port(
                         protocol=ec2.Protocol.TCP,
                         string_representation="HTTP from VPC",
                         from_port=80,
@@ -98,8 +254,8 @@ class SquidAsgConstruct(core.Construct):
                     )
                 )
 
-                asg.connections.allow_from(other=ec2.Peer.ipv4(vpc.vpc_cidr_block),
-                    port_range=ec2.Port(
+                squid_security_group.add_ingress_rule(peer=ec2.Peer.ipv4(cidr),
+                    connection=ec2.Port(
                         protocol=ec2.Protocol.TCP,
                         string_representation="HTTPS from VPC",
                         from_port=443,
@@ -107,33 +263,108 @@ class SquidAsgConstruct(core.Construct):
                     )
                 )
 
+            # Launch template shared by the ASGs of all the AZs
+            launch_template = ec2.LaunchTemplate(self,"squid-launch-template",
+                instance_type=ec2.InstanceType(instance_type),
+                machine_image=squid_ami,
+                role=squid_iam_role,
+                user_data=user_data,
+                block_devices=cache_block_devices,
+                security_group=squid_security_group
+            )
+
+            # Lifecycle hook topic shared by the ASGs, and role of the hooks to publish to it
+            # The failover Lambda function rebalances the routes on the terminating hooks and on the launch notifications
+            self.lifecycle_hook_topic = lifecycle_hook_topic = sns.Topic(self,"squid-asg-lifecycle-hook-topic",
+                display_name="Squid ASG Lifecycle Hook topic")
+            lifecycle_hook_target = hooktargets.TopicHook(lifecycle_hook_topic)
+            lifecycle_hook_role = iam.Role(self,"lifecycle-hook-role",
+                assumed_by=iam.ServicePrincipal("autoscaling.amazonaws.com"))
+
+            # Squid ASGs with min_capacity to max_capacity instances in each of the AZs 
+            self.squid_asgs = []
+            for count, az in enumerate(vpc.availability_zones, start=1):
+                # Route tables of the isolated and/or private subnets in the availability zone
+                non_public_subnets_in_az = []
+                if vpc.private_subnets:
+                    non_public_subnets_in_az += vpc.select_subnets(availability_zones=[az],
+                        subnet_type=ec2.SubnetType.PRIVATE).subnets
+                if vpc.isolated_subnets:
+                    non_public_subnets_in_az = vpc.select_subnets(availability_zones=[az],
+                        subnet_type=ec2.SubnetType.ISOLATED).subnets + non_public_subnets_in_az
+
+                # Each instance serves whole route tables: the instances over the number of route tables of the AZ
+                # serve none and are warm standbys, which take over the route tables of a failed or terminating
+                # instance of the AZ and are failover targets for the other AZs
+                asg = autoscaling.AutoScalingGroup(self,f"asg-{count}",vpc=vpc,
+                    launch_template=launch_template,
+                    desired_capacity=min_capacity,
+                    max_capacity=max_capacity,
+                    min_capacity=min_capacity,
+                    vpc_subnets=ec2.SubnetSelection(
+                        availability_zones=[az],
+                        one_per_az=True,
+                        subnet_type=ec2.SubnetType.PUBLIC
+                        ),
+                    health_check=autoscaling.HealthCheck.ec2(grace=core.Duration.minutes(5)),
+                    resource_signal_count=min_capacity,
+                    resource_signal_timeout=core.Duration.minutes(10),
+                    # Instances that went in service, once Squid accepts connections
+                    notifications=[autoscaling.NotificationConfiguration(topic=lifecycle_hook_topic,
+                        scaling_events=autoscaling.ScalingEvents(autoscaling.ScalingEvent.INSTANCE_LAUNCH))]
+                )
+
+                # Keep a pre-initialized standby instance per AZ: a failed instance is replaced by an instance
+                # that already ran the user data, which only has to start (stopped pool) or nothing (running pool)
+                if warm_pool != "none":
+                    asg.add_warm_pool(min_size=1, pool_state=WARM_POOL_STATES[warm_pool])
+
+                # Scale out the squid instances of the AZ on network throughput or on squid request rate
+                if max_capacity > min_capacity:
+                    if scaling_metric == "network":
+                        asg.scale_on_outgoing_bytes(f"scale-on-network-{count}",
+                            target_bytes_per_second=scaling_target or 50 * 1024 * 1024
+                        )
+                    elif scaling_metric == "requests":
+                        # Request rate of each instance, published by the squid health probe
+                        asg.scale_to_track_metric(f"scale-on-requests-{count}",
+                            metric=cloudwatch.Metric(metric_name="RequestRate",
+                                namespace="Squid",
+                                dimensions=dict(AutoScalingGroupName=asg.auto_scaling_group_name),
+                                statistic="Average",
+                                period=core.Duration.minutes(1)
+                            ),
+                            target_value=scaling_target or 500
+                        )
+                    else:
+                        raise ValueError(f"Unknown scaling metric: {scaling_metric}")
+                
                 # Create ASG Lifecycle hook to enable updating of route table using Lambda when instance launches and is marked Healthy
+                # With a warm pool, the hook also holds the instances entering the pool until their user data completed
 
                 autoscaling.LifecycleHook(self,f"asg-hook-{count}",
                     auto_scaling_group=asg,
                     lifecycle_transition=autoscaling.LifecycleTransition.INSTANCE_LAUNCHING,
-                    notification_target=hooktargets.TopicHook(sns.Topic(self,f"squid-asg-{count}-lifecycle-hook-topic", 
-                        display_name=f"Squid ASG {count} Lifecycle Hook topic")
-                    ),
+                    notification_target=lifecycle_hook_target,
+                    role=lifecycle_hook_role,
                     default_result=autoscaling.DefaultResult.ABANDON,
                     heartbeat_timeout=core.Duration.minutes(5)
                 )
 
+                # Hold the instances terminated by a scale in or a replacement until the Lambda function moved their routes
+                # If the function fails, the instance terminates at the end of the heartbeat timeout
+                autoscaling.LifecycleHook(self,f"asg-terminate-hook-{count}",
+                    auto_scaling_group=asg,
+                    lifecycle_transition=autoscaling.LifecycleTransition.INSTANCE_TERMINATING,
+                    notification_target=lifecycle_hook_target,
+                    role=lifecycle_hook_role,
+                    default_result=autoscaling.DefaultResult.CONTINUE,
+                    heartbeat_timeout=core.Duration.minutes(2)
+                )
+
                 # Tag ASG with the route table IDs used by the isolated and/or private subnets in the availability zone
                 # This tag will be used by the Squid Lambda function to identify route tables to update when alarm changes from ALARM to OK
-
-                private_subnets_in_az = []
-                isolated_subnets_in_az = []
                 route_table_ids = ''
-                
-                if vpc.private_subnets:
-                    private_subnets_in_az = vpc.select_subnets(availability_zones=[az],
-                        subnet_type=ec2.SubnetType.PRIVATE).subnets
-                if vpc.isolated_subnets:
-                    isolated_subnets_in_az = vpc.select_subnets(availability_zones=[az],
-                        subnet_type=ec2.SubnetType.ISOLATED).subnets
-                
-                non_public_subnets_in_az = isolated_subnets_in_az + private_subnets_in_az
 
                 # Loop through all non public subnets in AZ to identify route table and create a tag value string
                 for subnet in non_public_subnets_in_az:
@@ -150,6 +381,13 @@ class SquidAsgConstruct(core.Construct):
                 )
 
                 self.squid_asgs.append(asg)
+
+            # Allow the health probe to set its own instance to Unhealthy when squid stops answering
+            squid_iam_role.add_to_policy(statement= iam.PolicyStatement(effect=iam.Effect.ALLOW,
+                actions=['autoscaling:SetInstanceHealth',],
+                resources=[asg.auto_scaling_group_arn for asg in self.squid_asgs]
+                )
+            )
         
         else:
             raise ValueError("No public subnets in VPC")
\ No newline at end of file
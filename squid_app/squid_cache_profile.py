@@ -0,0 +1,136 @@
+# Response caching profile of a Squid instance, generated from its tuning profile
+#
+# This module does not depend on the CDK so that the profiles can be checked on their own:
+#   python -c "from squid_app.squid_cache_profile import *; from squid_app.squid_tuning_profile import *; print(render_cache_conf(cache_profile(tuning_profile('c5d.2xlarge'), 'instance-store')))"
+#
+# Only the plain HTTP traffic is cached: the HTTPS traffic is spliced by SSL Bump, so Squid never sees its content,
+# and the cache rules deny every request that is not an http:// URL.
+
+import collections
+import re
+
+from squid_app.squid_tuning_profile import SquidTuningProfile, INSTANCE_TYPE_RE
+
+SquidCacheProfile = collections.namedtuple('SquidCacheProfile', [
+    'volume',
+    'volume_gb',
+    'cache_mem_mb',
+    'maximum_object_size_in_memory_kb',
+    'maximum_object_size_mb',
+    'store_type'
+])
+
+CACHE_VOLUMES = ("none", "ebs", "instance-store")
+
+# Sizes of a gp3 volume, in GiB
+MIN_EBS_VOLUME_GB = 1
+MAX_EBS_VOLUME_GB = 16384
+
+# Directory of the disk cache, the cache volume is mounted there
+CACHE_DIR = "/var/spool/squid"
+
+# Share of the cache volume used by the disk cache, the rest is left to the file system and the swap state
+DISK_CACHE_SHARE = 0.8
+
+# Families with NVMe instance store volumes: the "d" variants (c5d, m5ad, r6gd...) and the storage optimized families
+INSTANCE_STORE_FAMILY_RE = re.compile(r'^([a-z]+\d+[a-z]*d[a-z]*|i\d+[a-z]*|d\d+[a-z]*)$')
+
+# Refresh patterns of the package repositories and registries: the package files and content addressed blobs never
+# change once published, while the repository metadata changes with every publication and is always revalidated
+REFRESH_PATTERNS = [
+    r"-i /repodata/repomd\.xml$ 0 0% 0 refresh-ims",
+    r"-i /repodata/ 0 0% 60 refresh-ims",
+    r"-i /(InRelease|Release|Release\.gpg|Packages|Sources)(\.(gz|bz2|xz|lzma))?$ 0 0% 0 refresh-ims",
+    r"-i /dists/.*/by-hash/ 129600 100% 129600 override-expire",
+    r"-i \.(rpm|deb|udeb|apk|drpm)$ 129600 100% 129600 override-expire ignore-no-store ignore-private",
+    r"-i \.(whl|jar|pom|gem|nupkg|crate|tgz|tar\.gz|tar\.bz2|tar\.xz|zip)$ 43200 100% 129600 refresh-ims",
+    r"-i /v2/.*/blobs/sha256:[0-9a-f]{64}$ 129600 100% 129600 override-expire ignore-no-store ignore-private",
+    r"-i /v2/.*/manifests/ 0 0% 0",
+    r"^ftp: 1440 20% 10080",
+    r"-i (/cgi-bin/|\?) 0 0% 0",
+    r". 0 20% 4320"
+]
+
+
+def cache_profile(tuning: SquidTuningProfile, volume: str = "none", volume_gb: int = 50) -> SquidCacheProfile:
+    if volume not in CACHE_VOLUMES:
+        raise ValueError(f"Unknown cache volume: {volume}")
+    if volume == "instance-store":
+        family = INSTANCE_TYPE_RE.match(tuning.instance_type).group("family")
+        if not INSTANCE_STORE_FAMILY_RE.match(family):
+            raise ValueError(f"The instance type {tuning.instance_type} has no instance store volume")
+    if volume == "ebs" and (isinstance(volume_gb, bool) or not isinstance(volume_gb, int) or
+            not MIN_EBS_VOLUME_GB <= volume_gb <= MAX_EBS_VOLUME_GB):
+        raise ValueError(f"Invalid cache volume size: {volume_gb!r}, "
+            f"use {MIN_EBS_VOLUME_GB} to {MAX_EBS_VOLUME_GB} GiB")
+
+    # The memory left to Squid, the certificate generators and the kernel grows with the instance
+    cache_mem_mb = min(16384, max(32, tuning.memory_mib // (8 if tuning.memory_mib < 4096 else 4)))
+
+    return SquidCacheProfile(
+        volume=volume,
+        volume_gb=volume_gb if volume == "ebs" else None,
+        cache_mem_mb=cache_mem_mb,
+        # Keep the small objects in memory, such as the repository metadata
+        maximum_object_size_in_memory_kb=min(65536, max(512, cache_mem_mb * 1024 // 64)),
+        # Container image layers and large packages
+        maximum_object_size_mb=4096,
+        # SMP workers only share a rock store, aufs is faster for a single worker
+        store_type="rock" if tuning.workers > 1 else "aufs"
+    )
+
+
+# Squid settings, included from conf.d
+def render_cache_conf(profile: SquidCacheProfile) -> str:
+    if profile.volume == "none":
+        return "\n".join([
+            "# Generated by the CDK app, see squid_cache_profile.py",
+            "cache deny all",
+            ""
+        ])
+    return "\n".join([
+        "# Generated by the CDK app, see squid_cache_profile.py",
+        # Only the plain HTTP requests are cached: not the CONNECT tunnels nor the HTTPS requests
+        "acl cache_plain_http proto HTTP",
+        "cache deny !cache_plain_http",
+        f"cache_mem {profile.cache_mem_mb} MB",
+        f"maximum_object_size_in_memory {profile.maximum_object_size_in_memory_kb} KB",
+        f"maximum_object_size {profile.maximum_object_size_mb} MB",
+        # Written on the instance from the size of the cache volume
+        "include /etc/squid/cache_dir.conf",
+        "cache_replacement_policy heap LFUDA",
+        "memory_replacement_policy heap GDSF",
+        # Many hosts pull the same files at the same time: a single request goes upstream
+        "collapsed_forwarding on",
+        # Finish the downloads aborted by the clients, so that the next client gets a hit
+        "quick_abort_min -1 KB",
+        "range_offset_limit 64 MB",
+    ] + [f"refresh_pattern {pattern}" for pattern in REFRESH_PATTERNS] + [""])
+
+
+# Script run on every boot: formats the cache volume when it is blank (new EBS volume, or instance store
+# volume after a stop), mounts it and writes the cache_dir sized from the volume
+def render_cache_volume_setup(profile: SquidCacheProfile) -> str:
+    if profile.volume == "none":
+        return "# Response caching is disabled"
+    if profile.store_type == "rock":
+        cache_dir = f"cache_dir rock {CACHE_DIR} $cache_size_mb max-size={profile.maximum_object_size_mb * 1024 * 1024}"
+    else:
+        cache_dir = f"cache_dir aufs {CACHE_DIR} $cache_size_mb 16 256"
+    return "\n".join([
+        # The cache volume is the only disk without a mounted file system
+        "cache_device=`lsblk -dpno NAME,TYPE | awk '$2 == \"disk\" {print $1}' | while read disk; do lsblk -no MOUNTPOINT $disk | grep -q . || echo $disk; done | head -1`",
+        "if [ -n \"$cache_device\" ]; then",
+        "  blkid $cache_device || mkfs.xfs -f $cache_device",
+        f"  mkdir -p {CACHE_DIR}",
+        f"  mountpoint -q {CACHE_DIR} || mount -o noatime $cache_device {CACHE_DIR}",
+        "fi",
+        f"chown squid:squid {CACHE_DIR}",
+        f"if mountpoint -q {CACHE_DIR}; then",
+        f"  cache_size_mb=`df -m --output=size {CACHE_DIR} | tail -1 | awk '{{print int($1 * {DISK_CACHE_SHARE})}}'`",
+        "else",
+        "  # Without cache volume, a small disk cache is kept on the root volume",
+        "  cache_size_mb=1024",
+        "fi",
+        f"echo \"{cache_dir}\" > /etc/squid/cache_dir.conf"
+    ])
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Batch the Squid access log records into compressed objects for S3, and pick the records kept in CloudWatch Logs.
+#
+# The objects hold gzip'd JSON lines, one record per line, under Hive style partitions of the request date and
+# of the AZ of the instance, so that Athena only scans the partitions of a query:
+#   <prefix>date=2024-01-31/az=us-east-1a/<instance id>-<time of the first record>-<inode>-<offset>.json.gz
+# where <inode> and <offset> are the inode of the log file and the offset of the first line of the batch.
+#
+# Usage: python access_log_batcher.py /var/log/squid/access.log --output-dir /tmp/batches [--sample-rate 0.01]
+
+import argparse
+import collections
+import gzip
+import json
+import os
+import random
+import sys
+import time
+
+from access_log_parser import parse_line
+
+# Compression level of the objects: the default level 9 costs about twice the CPU for a few percent of size
+COMPRESS_LEVEL = 6
+
+
+# Return the JSON line of a record
+def record_line(record, instance_id):
+  document = record._asdict()
+  document['instance_id'] = instance_id
+  return json.dumps(document, separators=(',', ':'))
+
+
+class AccessLogBatcher:
+  # A batch is full after max_records records, or max_age seconds after its first record when max_age is set
+  def __init__(self, instance_id, availability_zone, prefix='access-logs/', max_records=100000, max_age=60.0,
+      clock=time.monotonic):
+    self.instance_id = instance_id
+    self.availability_zone = availability_zone
+    self.prefix = prefix
+    self.max_records = max_records
+    self.max_age = max_age
+    self.clock = clock
+    self._partitions = collections.OrderedDict()
+    self._records = 0
+    self._started = None
+
+  def __len__(self):
+    return self._records
+
+  def add(self, record):
+    date = time.strftime('%Y-%m-%d', time.gmtime(record.timestamp))
+    if not self._records:
+      self._started = self.clock()
+    self._partitions.setdefault(date, []).append((record.timestamp, record_line(record, self.instance_id)))
+    self._records += 1
+
+  def full(self):
+    return self._records >= self.max_records or (self.max_age is not None and
+      self._records > 0 and self.clock() - self._started >= self.max_age)
+
+  # Return the (key, gzip'd body) of the objects of the batch, one per partition, and start a new batch
+  # source is the {'inode', 'offset'} of the first line of the batch in the log file. The key only depends
+  # on the source and on the first record, so that a batch read again from the same position after a restart
+  # overwrites the objects uploaded before, even when it ends at another line
+  def drain(self, source=None):
+    objects = []
+    for date, lines in self._partitions.items():
+      first_time = time.strftime('%Y%m%dT%H%M%S', time.gmtime(lines[0][0]))
+      key = '%sdate=%s/az=%s/%s-%s-%d-%d.json.gz' % (self.prefix, date, self.availability_zone, self.instance_id,
+        first_time, source['inode'], source['offset'])
+      body = gzip.compress(('\n'.join(line for _, line in lines) + '\n').encode(), compresslevel=COMPRESS_LEVEL)
+      objects.append((key, body))
+    self._partitions = collections.OrderedDict()
+    self._records = 0
+    self._started = None
+    return objects
+
+
+# Keep the denied requests, the errors and a sample of the other requests in CloudWatch Logs
+class CloudWatchSampler:
+  def __init__(self, sample_rate=0.01, rng=random.random):
+    self.sample_rate = sample_rate
+    self.rng = rng
+
+  def keep(self, record):
+    return record.denied or record.status >= 500 or self.rng() < self.sample_rate
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Batch the Squid access log into gzip\'d JSON objects')
+  parser.add_argument('files', nargs='*', help='access log files, the standard input if not set')
+  parser.add_argument('--output-dir', required=True, help='directory of the objects, with the S3 key as path')
+  parser.add_argument('--instance-id', default='local')
+  parser.add_argument('--availability-zone', default='local')
+  parser.add_argument('--max-records', type=int, default=100000)
+  parser.add_argument('--sample-rate', type=float, default=0.01)
+  args = parser.parse_args()
+
+  batcher = AccessLogBatcher(args.instance_id, args.availability_zone, max_records=args.max_records, max_age=None)
+  sampler = CloudWatchSampler(args.sample_rate)
+  objects = []
+  lines = raw_bytes = sampled = skipped = 0
+  for path in args.files or ['-']:
+    log_h = sys.stdin if path == '-' else open(path, 'r')
+    with log_h:
+      inode = os.fstat(log_h.fileno()).st_ino
+      source = {'inode': inode, 'offset': 0}
+      offset = 0
+      for line in log_h:
+        lines += 1
+        raw_bytes += len(line)
+        offset += len(line.encode())
+        record = parse_line(line)
+        if record is None:
+          skipped += 1
+          continue
+        sampled += sampler.keep(record)
+        batcher.add(record)
+        if len(batcher) >= args.max_records:
+          objects.extend(batcher.drain(source))
+          source = {'inode': inode, 'offset': offset}
+      # A batch holds the lines of a single file
+      objects.extend(batcher.drain(source))
+
+  for key, body in objects:
+    path = os.path.join(args.output_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as object_h:
+      object_h.write(body)
+  compressed_bytes = sum(len(body) for _, body in objects)
+  print('%d lines, %d bytes in %d objects of %d bytes (%.1f%%), %d lines kept in CloudWatch Logs, %d skipped' % (
+    lines, raw_bytes, len(objects), compressed_bytes, 100.0 * compressed_bytes / max(1, raw_bytes), sampled, skipped))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Parse the Squid access log and roll it up per minute, per domain, per status and per instance.
+#
+# The log lines use the "squid" logformat of squid.conf:
+#   %ts.%03tu %6tr %>a %Ss/%03>Hs %<st %rm %ru %ssl::>sni %Sh/%<a %mt
+# The rollups hold the latency samples (for p50/p95/p99), the bytes, and the request, deny and error counts,
+# and are emitted as CloudWatch Embedded Metric Format (EMF) documents.
+#
+# Usage: python access_log_parser.py /var/log/squid/access.log [--instance-id i-0123] [--emf]
+
+import argparse
+import collections
+import datetime
+import json
+import re
+import sys
+from urllib.parse import urlsplit
+
+LOG_LINE = re.compile(
+  r'^(?P<timestamp>\d+(\.\d+)?)\s+(?P<elapsed>\d+)\s+(?P<client>\S+)\s+'
+  r'(?P<result>[^/\s]+)/(?P<status>\d+)\s+(?P<bytes>\d+)\s+(?P<method>\S+)\s+(?P<url>\S+)\s+'
+  r'(?P<sni>\S+)\s+(?P<hierarchy>[^/\s]+)/(?P<peer>\S+)\s+(?P<mime>\S+)'
+)
+
+# EMF accepts at most 100 values per metric in a document
+MAX_EMF_VALUES = 100
+
+AccessLogRecord = collections.namedtuple('AccessLogRecord',
+  ['timestamp', 'elapsed_ms', 'client', 'result', 'status', 'bytes', 'method', 'domain', 'denied',
+    'url', 'hierarchy', 'peer', 'mime'])
+
+# PutMetricData accepts at most 150 distinct values per metric datum and 1000 datums per call
+MAX_METRIC_VALUES = 150
+
+
+# Return the domain of the request: the TLS SNI when there is one, otherwise the host of the URL
+def request_domain(method, url, sni):
+  if sni != '-':
+    return sni.lower()
+  if method == 'CONNECT':
+    return url.rsplit(':', 1)[0].strip('[]').lower()
+  return (urlsplit(url).hostname or '-').lower()
+
+# Return the record of a log line, or None if the line is not in the squid logformat
+def parse_line(line):
+  match = LOG_LINE.match(line)
+  if not match:
+    return None
+  fields = match.groupdict()
+  status = int(fields['status'])
+  return AccessLogRecord(
+    timestamp=float(fields['timestamp']),
+    elapsed_ms=int(fields['elapsed']),
+    client=fields['client'],
+    result=fields['result'],
+    status=status,
+    bytes=int(fields['bytes']),
+    method=fields['method'],
+    domain=request_domain(fields['method'], fields['url'], fields['sni']),
+    # Requests denied by http_access, and 403 answers that Squid sent without contacting a server
+    denied='DENIED' in fields['result'] or (status == 403 and fields['hierarchy'] == 'HIER_NONE'),
+    url=fields['url'],
+    hierarchy=fields['hierarchy'],
+    peer=fields['peer'],
+    mime=fields['mime']
+  )
+
+
+class RollupStats:
+  def __init__(self):
+    self.latencies = []
+    self.bytes = 0
+    self.requests = 0
+    self.denied = 0
+    self.errors = 0
+
+  def add(self, record):
+    self.latencies.append(record.elapsed_ms)
+    self.bytes += record.bytes
+    self.requests += 1
+    self.denied += record.denied
+    # Requests that Squid or the server failed to answer
+    self.errors += record.status >= 500
+
+  def merge(self, other):
+    self.latencies.extend(other.latencies)
+    self.bytes += other.bytes
+    self.requests += other.requests
+    self.denied += other.denied
+    self.errors += other.errors
+
+  def percentile(self, percent):
+    latencies = sorted(self.latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+
+class AccessLogRollup:
+  # max_domains bounds the number of Domain metrics, the least requested domains are rolled up as "other"
+  def __init__(self, max_domains=100):
+    self.max_domains = max_domains
+    self.rollups = collections.defaultdict(RollupStats)
+    self.skipped = 0
+
+  def add_line(self, line, instance_id):
+    record = parse_line(line)
+    if record is None:
+      self.skipped += 1
+      return
+    self.add(record, instance_id)
+
+  def add(self, record, instance_id):
+    minute = int(record.timestamp // 60) * 60
+    self.rollups[(minute, 'Domain', record.domain)].add(record)
+    self.rollups[(minute, 'Status', str(record.status))].add(record)
+    self.rollups[(minute, 'InstanceId', instance_id)].add(record)
+
+  # Return the rollups sorted by minute, dimension and value, with the domains over max_domains merged
+  def items(self):
+    domain_requests = collections.Counter()
+    for (minute, dimension, value), stats in self.rollups.items():
+      if dimension == 'Domain':
+        domain_requests[value] += stats.requests
+    top_domains = {domain for domain, _ in domain_requests.most_common(self.max_domains)}
+
+    merged = collections.defaultdict(RollupStats)
+    for (minute, dimension, value), stats in self.rollups.items():
+      if dimension == 'Domain' and value not in top_domains:
+        value = 'other'
+      merged[(minute, dimension, value)].merge(stats)
+    return sorted(merged.items())
+
+  # Return the EMF documents of the rollups
+  # The latency samples are sent as value arrays, so that CloudWatch computes the percentiles
+  # across all the documents of the minute
+  def emf_documents(self, namespace='Squid/AccessLog'):
+    documents = []
+    for (minute, dimension, value), stats in self.items():
+      for index in range(0, len(stats.latencies), MAX_EMF_VALUES):
+        metrics = [{'Name': 'Latency', 'Unit': 'Milliseconds'}]
+        document = {
+          dimension: value,
+          'Latency': stats.latencies[index:index + MAX_EMF_VALUES]
+        }
+        # The counters are sent once per rollup
+        if index == 0:
+          metrics += [
+            {'Name': 'Requests', 'Unit': 'Count'},
+            {'Name': 'Bytes', 'Unit': 'Bytes'},
+            {'Name': 'Denied', 'Unit': 'Count'},
+            {'Name': 'Errors', 'Unit': 'Count'}
+          ]
+          document.update({'Requests': stats.requests, 'Bytes': stats.bytes, 'Denied': stats.denied,
+            'Errors': stats.errors})
+        document['_aws'] = {
+          'Timestamp': minute * 1000,
+          'CloudWatchMetrics': [{
+            'Namespace': namespace,
+            'Dimensions': [[dimension]],
+            'Metrics': metrics
+          }]
+        }
+        documents.append(document)
+    return documents
+
+  # Return the metric data of the rollups for PutMetricData, with the same metrics as the EMF documents
+  # The latency samples are sent as values and counts, so that CloudWatch computes the same percentiles
+  def metric_data(self):
+    metric_data = []
+    for (minute, dimension, value), stats in self.items():
+      timestamp = datetime.datetime.fromtimestamp(minute, datetime.timezone.utc)
+      dimensions = [{'Name': dimension, 'Value': value}]
+      latencies = sorted(collections.Counter(stats.latencies).items())
+      for index in range(0, len(latencies), MAX_METRIC_VALUES):
+        metric_data.append({'MetricName': 'Latency', 'Dimensions': dimensions, 'Timestamp': timestamp,
+          'Values': [latency for latency, _ in latencies[index:index + MAX_METRIC_VALUES]],
+          'Counts': [count for _, count in latencies[index:index + MAX_METRIC_VALUES]],
+          'Unit': 'Milliseconds'})
+      for name, metric_value, unit in (('Requests', stats.requests, 'Count'), ('Bytes', stats.bytes, 'Bytes'),
+          ('Denied', stats.denied, 'Count'), ('Errors', stats.errors, 'Count')):
+        metric_data.append({'MetricName': name, 'Dimensions': dimensions, 'Timestamp': timestamp,
+          'Value': metric_value, 'Unit': unit})
+    return metric_data
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Roll up the Squid access log per minute')
+  parser.add_argument('files', nargs='*', help='access log files, the standard input if not set')
+  parser.add_argument('--instance-id', default='local')
+  parser.add_argument('--max-domains', type=int, default=100)
+  parser.add_argument('--emf', action='store_true', help='print the EMF documents instead of a table')
+  args = parser.parse_args()
+
+  rollup = AccessLogRollup(max_domains=args.max_domains)
+  for path in args.files or ['-']:
+    log_h = sys.stdin if path == '-' else open(path, 'r')
+    with log_h:
+      for line in log_h:
+        rollup.add_line(line, args.instance_id)
+
+  if args.emf:
+    for document in rollup.emf_documents():
+      print(json.dumps(document))
+  else:
+    print('%-20s %-10s %-40s %8s %8s %8s %8s %12s %8s %8s' % (
+      'minute', 'dimension', 'value', 'requests', 'p50 ms', 'p95 ms', 'p99 ms', 'bytes', 'denied', 'errors'))
+    for (minute, dimension, value), stats in rollup.items():
+      print('%-20d %-10s %-40s %8d %8d %8d %8d %12d %8d %8d' % (minute, dimension, value[:40], stats.requests,
+        stats.percentile(50), stats.percentile(95), stats.percentile(99), stats.bytes, stats.denied, stats.errors))
+  if rollup.skipped:
+    print('%d lines not in the squid logformat skipped' % rollup.skipped, file=sys.stderr)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,27 @@
+import base64
+import gzip
+import json
+import os
+
+from access_log_parser import AccessLogRollup
+
+max_domains = int(os.environ.get('MAX_DOMAINS', '100'))
+namespace = os.environ.get('METRIC_NAMESPACE', 'Squid/AccessLog')
+
+# Roll up the Squid access log events sent by the CloudWatch Logs subscription filter
+# The rollups are printed in Embedded Metric Format, CloudWatch extracts the metrics from the Lambda logs
+def handler(event, context):
+  data = json.loads(gzip.decompress(base64.b64decode(event['awslogs']['data'])))
+  if data['messageType'] != 'DATA_MESSAGE':
+    return
+
+  # The log stream name is the instance ID of the Squid instance
+  rollup = AccessLogRollup(max_domains=max_domains)
+  for log_event in data['logEvents']:
+    rollup.add_line(log_event['message'], data['logStream'])
+
+  documents = rollup.emf_documents(namespace=namespace)
+  for document in documents:
+    print(json.dumps(document))
+  print('Rolled up %d log events from %s into %d EMF documents, %d lines skipped' % (
+    len(data['logEvents']), data['logStream'], len(documents), rollup.skipped))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# Ship the Squid access log to S3 in compressed batches, and only keep the denied requests, the errors and a
+# sample of the other requests in CloudWatch Logs.
+#
+# The shipper follows the access log across rotations, batches the records with access_log_batcher.py and
+# uploads the batches to S3. It publishes the Squid/AccessLog metrics of the log analytics function itself,
+# and appends the records kept in CloudWatch Logs to a file that the CloudWatch Agent ships.
+# The position in the access log is saved once a batch is uploaded: after a restart, the first batch that
+# was not uploaded is read again from the same position, and its objects overwrite the ones uploaded before.
+#
+# Usage: python3 squid_log_shipper.py --bucket <bucket> [--access-log /var/log/squid/access.log] [--sample-rate 0.01]
+
+import argparse
+import json
+import os
+import signal
+import time
+import urllib.request
+
+from access_log_batcher import AccessLogBatcher, CloudWatchSampler
+from access_log_parser import AccessLogRollup, parse_line
+
+IMDS_URL = 'http://169.254.169.254/latest'
+
+# PutMetricData accepts up to 1 MB per call: a latency datum holds up to 150 values
+METRIC_DATA_PER_CALL = 100
+
+# Objects kept for the next upload when S3 is unavailable, the oldest objects are dropped beyond
+MAX_PENDING_OBJECTS = 100
+
+
+# Follow a log file across rotations: the renamed file is read to the end before the new file is opened
+class LogTail:
+  # position is the {'inode', 'offset'} of the first line not shipped yet, saved by a previous run
+  def __init__(self, path, position=None):
+    self.path = path
+    self._saved_position = position or {}
+    self._file = None
+    self._inode = None
+    self._partial = b''
+
+  def _open(self, offset=None):
+    try:
+      log_file = open(self.path, 'rb')
+    except FileNotFoundError:
+      return False
+    self._file = log_file
+    self._inode = os.fstat(log_file.fileno()).st_ino
+    if offset is None:
+      # Resume from the saved position, unless the file was rotated since
+      offset = self._saved_position.get('offset', 0) if self._saved_position.get('inode') == self._inode else 0
+    log_file.seek(min(offset, os.fstat(log_file.fileno()).st_size))
+    self._partial = b''
+    return True
+
+  def _rotated(self):
+    try:
+      return os.stat(self.path).st_ino != self._inode
+    except FileNotFoundError:
+      # Squid creates the new file when it writes the next line
+      return False
+
+  # Return the complete lines written since the last call
+  def read_lines(self, max_bytes=1 << 20):
+    if self._file is None and not self._open():
+      return []
+    # The file was truncated in place
+    if os.fstat(self._file.fileno()).st_size < self._file.tell():
+      self._file.seek(0)
+      self._partial = b''
+    chunk = self._file.read(max_bytes)
+    if not chunk and self._rotated():
+      self._file.close()
+      self._file = None
+      if not self._open(offset=0):
+        return []
+      chunk = self._file.read(max_bytes)
+    lines = (self._partial + chunk).split(b'\n')
+    self._partial = lines.pop()
+    return [line.decode('utf-8', 'replace') for line in lines]
+
+  def position(self):
+    if self._file is None:
+      return self._saved_position
+    return {'inode': self._inode, 'offset': self._file.tell() - len(self._partial)}
+
+
+class LogShipper:
+  def __init__(self, tail, batcher, sampler, s3_client, bucket, cw_client, namespace='Squid/AccessLog',
+      max_domains=100, sampled_log='/var/log/squid/access-sampled.log', sampled_log_max_bytes=50 << 20,
+      state_file=None):
+    self.tail = tail
+    self.batcher = batcher
+    self.sampler = sampler
+    self.s3_client = s3_client
+    self.bucket = bucket
+    self.cw_client = cw_client
+    self.namespace = namespace
+    self.max_domains = max_domains
+    self.sampled_log = sampled_log
+    self.sampled_log_max_bytes = sampled_log_max_bytes
+    self.state_file = state_file
+    self.rollup = AccessLogRollup(max_domains=max_domains)
+    self.sampled_lines = []
+    # (key, body, position) of the objects not uploaded yet, the position is the one to save once the object
+    # is uploaded: set on the last object of each batch
+    self.pending_objects = []
+    # Position of the first line of the current batch, the objects of the batch are named after it
+    self.batch_start = None
+    self.skipped = 0
+
+  # Read the new lines of the access log, and ship the batch when it is full
+  def poll(self):
+    while True:
+      start = self.tail.position()
+      lines = self.tail.read_lines()
+      position = self.tail.position()
+      if position.get('inode') != start.get('inode'):
+        # A batch holds the lines of a single file: the lines were read from the start of a new file
+        if len(self.batcher):
+          self.flush(start)
+        start = {'inode': position['inode'], 'offset': 0}
+        self.batch_start = None
+      if self.batch_start is None:
+        self.batch_start = start
+      for line in lines:
+        record = parse_line(line)
+        if record is None:
+          self.skipped += 1
+          continue
+        self.batcher.add(record)
+        self.rollup.add(record, self.batcher.instance_id)
+        if self.sampler.keep(record):
+          self.sampled_lines.append(line)
+      if self.batcher.full():
+        self.flush()
+      if not lines:
+        return
+
+  # Ship the batch, position is the position in the access log after its last line
+  def flush(self, position=None):
+    if position is None:
+      position = self.tail.position()
+    records = len(self.batcher)
+    objects = self.batcher.drain(self.batch_start)
+    self.batch_start = None
+    self.pending_objects.extend((key, body, None) for key, body in objects[:-1])
+    self.pending_objects.extend((key, body, position) for key, body in objects[-1:])
+    if len(self.pending_objects) > MAX_PENDING_OBJECTS:
+      print('S3 unavailable, %d batches dropped' % (len(self.pending_objects) - MAX_PENDING_OBJECTS), flush=True)
+      self.pending_objects = self.pending_objects[-MAX_PENDING_OBJECTS:]
+    if not objects and not self.pending_objects:
+      self.save_position(position)
+    uploaded = self.upload()
+    self.publish_metrics()
+    self.write_sampled_lines()
+    print('Shipped %d records in %d objects, %d objects pending, %d lines skipped' % (
+      records, uploaded, len(self.pending_objects), self.skipped), flush=True)
+
+  # Upload the pending objects in order, and save the position of each batch once all its objects are uploaded
+  def upload(self):
+    uploaded = 0
+    while self.pending_objects:
+      key, body, position = self.pending_objects[0]
+      try:
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body,
+          ContentType='application/x-ndjson', ContentEncoding='gzip')
+      except Exception as e:
+        print('Failed to upload %s: %r' % (key, e), flush=True)
+        break
+      self.pending_objects.pop(0)
+      uploaded += 1
+      if position is not None:
+        self.save_position(position)
+    return uploaded
+
+  def save_position(self, position):
+    if self.state_file:
+      with open(self.state_file, 'w') as state_h:
+        json.dump(position, state_h)
+
+  def publish_metrics(self):
+    metric_data = self.rollup.metric_data()
+    self.rollup = AccessLogRollup(max_domains=self.max_domains)
+    for start in range(0, len(metric_data), METRIC_DATA_PER_CALL):
+      try:
+        self.cw_client.put_metric_data(Namespace=self.namespace,
+          MetricData=metric_data[start:start + METRIC_DATA_PER_CALL])
+      except Exception as e:
+        print('Failed to publish access log metrics: %r' % e, flush=True)
+
+  # Append the records kept in CloudWatch Logs to the file shipped by the CloudWatch Agent,
+  # the file is rotated when it reaches sampled_log_max_bytes
+  def write_sampled_lines(self):
+    if not self.sampled_lines:
+      return
+    try:
+      if os.path.getsize(self.sampled_log) >= self.sampled_log_max_bytes:
+        os.replace(self.sampled_log, self.sampled_log + '.1')
+    except FileNotFoundError:
+      pass
+    with open(self.sampled_log, 'a') as sampled_h:
+      sampled_h.write('\n'.join(self.sampled_lines) + '\n')
+    self.sampled_lines = []
+
+
+def instance_metadata(path):
+  token_request = urllib.request.Request(IMDS_URL + '/api/token', method='PUT',
+    headers={'X-aws-ec2-metadata-token-ttl-seconds': '300'})
+  token = urllib.request.urlopen(token_request, timeout=2).read().decode()
+  request = urllib.request.Request(IMDS_URL + '/' + path, headers={'X-aws-ec2-metadata-token': token})
+  return urllib.request.urlopen(request, timeout=2).read().decode()
+
+def main():
+  parser = argparse.ArgumentParser(description='Ship the Squid access log to S3')
+  parser.add_argument('--bucket', required=True)
+  parser.add_argument('--prefix', default='access-logs/')
+  parser.add_argument('--access-log', default='/var/log/squid/access.log')
+  parser.add_argument('--sampled-log', default='/var/log/squid/access-sampled.log',
+    help='file of the records kept in CloudWatch Logs')
+  parser.add_argument('--state-file', default='/var/lib/squid-log-shipper/position.json')
+  parser.add_argument('--sample-rate', type=float, default=0.01,
+    help='share of the allowed requests kept in CloudWatch Logs, the denied requests and the errors are all kept')
+  parser.add_argument('--max-records', type=int, default=100000, help='records per batch')
+  parser.add_argument('--max-age', type=float, default=60.0, help='seconds between batches')
+  parser.add_argument('--max-domains', type=int, default=100)
+  parser.add_argument('--poll-interval', type=float, default=1.0)
+  args = parser.parse_args()
+
+  import boto3
+
+  identity = json.loads(instance_metadata('dynamic/instance-identity/document'))
+  s3_client = boto3.client('s3', region_name=identity['region'])
+  cw_client = boto3.client('cloudwatch', region_name=identity['region'])
+
+  try:
+    with open(args.state_file) as state_h:
+      position = json.load(state_h)
+  except (OSError, ValueError):
+    position = None
+  os.makedirs(os.path.dirname(args.state_file), exist_ok=True)
+
+  shipper = LogShipper(
+    LogTail(args.access_log, position),
+    AccessLogBatcher(identity['instanceId'], identity['availabilityZone'], prefix=args.prefix,
+      max_records=args.max_records, max_age=args.max_age),
+    CloudWatchSampler(args.sample_rate),
+    s3_client, args.bucket, cw_client,
+    max_domains=args.max_domains,
+    sampled_log=args.sampled_log,
+    state_file=args.state_file
+  )
+
+  # Ship the current batch before stopping
+  stopping = []
+  signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+  print('Shipping %s to s3://%s/%s' % (args.access_log, args.bucket, args.prefix), flush=True)
+  while not stopping:
+    shipper.poll()
+    time.sleep(args.poll_interval)
+  shipper.poll()
+  shipper.flush()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,17 @@
+import json
+import boto3
+import os
+
+sfn_client = boto3.client('stepfunctions')
+
+# Start a rollout of the configuration when a config file changes in S3.
+# The rollout tests the new object versions on a canary instance before it promotes them to all the instances.
+def handler(event, context):
+  keys = [record['s3']['object']['key'] for record in event['Records']]
+  print('Changed configuration objects: %s' % ', '.join(keys))
+
+  response = sfn_client.start_execution(
+    stateMachineArn=os.environ['STATE_MACHINE_ARN'],
+    input=json.dumps({'keys': keys})
+  )
+  print('Started rollout %s' % response['executionArn'])
@@ -0,0 +1,280 @@
+import json
+import boto3
+import os
+import statistics
+import time
+
+from botocore.exceptions import ClientError
+
+from config_release import NO_RELEASE, latest_release, load_parameter, make_release, store_parameter
+
+as_client = boto3.client('autoscaling')
+cw_client = boto3.client('cloudwatch')
+s3_client = boto3.client('s3')
+sfn_client = boto3.client('stepfunctions')
+ssm_client = boto3.client('ssm')
+
+bucket = os.environ['CONFIG_BUCKET']
+release_parameter = os.environ['RELEASE_PARAMETER']
+canary_parameter = os.environ['CANARY_PARAMETER']
+asg_names = os.environ['ASG_NAMES'].split(',')
+
+# Minutes during which the canary instance runs the new release before it is compared with the baseline,
+# the release is promoted right away when it is 0
+canary_minutes = int(os.environ.get('CANARY_MINUTES', '10'))
+# The access log metrics of a minute are published shortly after the minute ends
+metrics_delay_seconds = int(os.environ.get('METRICS_DELAY_SECONDS', '120'))
+# Requests of the canary instance below which there is not enough traffic to compare it with the baseline
+min_requests = int(os.environ.get('MIN_REQUESTS', '100'))
+# The release is rolled back when the p50 or p99 latency of the canary exceeds the one of the baseline
+# by more than this percentage and margin, or when its error rate exceeds the one of the baseline by more
+# than this number of percentage points
+max_latency_increase = float(os.environ.get('MAX_LATENCY_INCREASE', '25'))
+latency_margin_ms = float(os.environ.get('LATENCY_MARGIN_MS', '20'))
+max_error_rate_increase = float(os.environ.get('MAX_ERROR_RATE_INCREASE', '1'))
+
+# Checks of the refresh command of the canary instance before it is considered failed
+max_command_checks = 30
+
+class RollbackError(Exception):
+  pass
+
+def send_refresh_command(comment, **targets):
+  response = ssm_client.send_command(
+    DocumentName='AWS-RunShellScript',
+    Comment=comment,
+    Parameters={'commands': ['/etc/squid/squid-conf-refresh.sh']},
+    MaxConcurrency='100%',
+    MaxErrors='100%',
+    TimeoutSeconds=120,
+    **targets
+  )
+  print('Sent command %s: %s' % (response['Command']['CommandId'], comment))
+  return response['Command']['CommandId']
+
+# Print the outcome of the rollout in Embedded Metric Format
+def print_rollout_metric(outcome):
+  print(json.dumps({
+    '_aws': {
+      'Timestamp': int(time.time() * 1000),
+      'CloudWatchMetrics': [{
+        'Namespace': 'Squid',
+        'Dimensions': [['Outcome']],
+        'Metrics': [{'Name': 'ConfigRollout', 'Unit': 'Count'}]
+      }]
+    },
+    'Outcome': outcome,
+    'ConfigRollout': 1
+  }))
+
+# Only the latest rollout goes on, and one rollout at a time: a change made of several files creates
+# an execution per file, the executions started before the latest one end without doing anything
+def prepare(rollout):
+  running = []
+  for page in sfn_client.get_paginator('list_executions').paginate(
+      stateMachineArn=rollout['state_machine'], statusFilter='RUNNING'):
+    running.extend(page['executions'])
+  started = {execution['executionArn']: execution['startDate'] for execution in running}
+  own_start = started.get(rollout['execution'])
+  if own_start and any(start > own_start for start in started.values()):
+    return dict(rollout, status='superseded')
+  if own_start and any(start < own_start for start in started.values()):
+    return dict(rollout, status='busy')
+
+  release = load_parameter(ssm_client, release_parameter)
+  latest = latest_release(s3_client, bucket)
+  if latest['id'] == release.get('id'):
+    print('Release %s already promoted' % latest['id'])
+    return dict(rollout, status='unchanged')
+
+  rollout = dict(rollout, release=latest, previous_release=release)
+  # Before the first promotion, the instances already run the latest object versions
+  if not release.get('objects') or canary_minutes == 0:
+    return dict(rollout, status='promote')
+  return dict(rollout, status='canary')
+
+# Deploy the release to a single instance, the other instances keep the promoted release
+def start_canary(rollout):
+  instance_ids = []
+  for page in as_client.get_paginator('describe_auto_scaling_groups').paginate(AutoScalingGroupNames=asg_names):
+    for asg in page['AutoScalingGroups']:
+      instance_ids.extend(instance['InstanceId'] for instance in asg['Instances']
+        if instance['LifecycleState'] == 'InService' and instance['HealthStatus'] == 'Healthy')
+  if not instance_ids:
+    print('No instance in service to test release %s on' % rollout['release']['id'])
+    return dict(rollout, status='promote')
+
+  # The canary instance changes from one release to the next
+  instance_ids.sort()
+  canary_instance_id = instance_ids[int(rollout['release']['id'], 16) % len(instance_ids)]
+  store_parameter(ssm_client, canary_parameter, {
+    'instance_id': canary_instance_id,
+    'release': rollout['release'],
+    'execution': rollout['execution']
+  })
+  command_id = send_refresh_command('Canary of configuration release %s' % rollout['release']['id'],
+    InstanceIds=[canary_instance_id])
+  return dict(rollout, status='pending', canary_instance_id=canary_instance_id,
+    baseline_instance_ids=[instance_id for instance_id in instance_ids if instance_id != canary_instance_id],
+    command_id=command_id, command_checks=0)
+
+# Wait for the canary instance to load the release: the refresh script fails when the configuration does not parse
+def check_canary(rollout):
+  rollout = dict(rollout, command_checks=rollout['command_checks'] + 1)
+  try:
+    invocation = ssm_client.get_command_invocation(CommandId=rollout['command_id'],
+      InstanceId=rollout['canary_instance_id'])
+  except ClientError as e:
+    # The invocation does not exist for a short time after the command is sent
+    print('Refresh command of %s not found: %s' % (rollout['canary_instance_id'], e))
+    invocation = {'Status': 'Pending', 'StandardOutputContent': ''}
+
+  if invocation['Status'] in ('Pending', 'InProgress', 'Delayed'):
+    if rollout['command_checks'] < max_command_checks:
+      return dict(rollout, status='pending')
+    print('Refresh command of %s still %s' % (rollout['canary_instance_id'], invocation['Status']))
+    return dict(rollout, status='failed')
+  if invocation['Status'] != 'Success' or rollout['release']['id'] not in invocation['StandardOutputContent']:
+    print('Canary %s failed to load release %s: %s %s' % (rollout['canary_instance_id'], rollout['release']['id'],
+      invocation['Status'], invocation.get('StandardErrorContent', '')))
+    return dict(rollout, status='failed')
+
+  # The comparison window starts with the first full minute of access log metrics
+  now = int(time.time())
+  window_start = (now // 60 + 1) * 60
+  window_end = window_start + canary_minutes * 60
+  print('Canary %s runs release %s, compared with the baseline from %d to %d' % (
+    rollout['canary_instance_id'], rollout['release']['id'], window_start, window_end))
+  return dict(rollout, status='applied', window_start=window_start, window_end=window_end,
+    wait_seconds=window_end + metrics_delay_seconds - now)
+
+# Return the requests, errors, p50 and p99 latency of each instance over the window from the access log metrics
+def instance_stats(instance_ids, start, end):
+  queries = []
+  for index, instance_id in enumerate(instance_ids):
+    for name, metric_name, stat in (('p50', 'Latency', 'p50'), ('p99', 'Latency', 'p99'),
+        ('requests', 'Requests', 'Sum'), ('errors', 'Errors', 'Sum')):
+      queries.append({
+        'Id': 'm%d_%s' % (index, name),
+        'MetricStat': {
+          'Metric': {'Namespace': 'Squid/AccessLog', 'MetricName': metric_name,
+            'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}]},
+          'Period': end - start,
+          'Stat': stat
+        }
+      })
+
+  stats = {instance_id: {'requests': 0, 'errors': 0} for instance_id in instance_ids}
+  # GetMetricData accepts up to 500 queries per call
+  for offset in range(0, len(queries), 500):
+    for page in cw_client.get_paginator('get_metric_data').paginate(MetricDataQueries=queries[offset:offset + 500],
+        StartTime=start, EndTime=end):
+      for result in page['MetricDataResults']:
+        if result['Values']:
+          index, name = result['Id'][1:].split('_', 1)
+          stats[instance_ids[int(index)]][name] = result['Values'][0]
+  return stats
+
+# Compare the canary instance with the baseline: the other instances over the same window, or the canary
+# instance itself over the previous window when the other instances got too few requests
+def evaluate(rollout):
+  canary_instance_id = rollout['canary_instance_id']
+  start, end = rollout['window_start'], rollout['window_end']
+  stats = instance_stats([canary_instance_id] + rollout['baseline_instance_ids'], start, end)
+  canary = stats.pop(canary_instance_id)
+  baseline = [instance for instance in stats.values() if instance['requests'] >= min_requests]
+  if not baseline:
+    baseline = [instance for instance in
+      instance_stats([canary_instance_id], 2 * start - end, start).values() if instance['requests'] >= min_requests]
+  print('Canary: %s, baseline: %s' % (json.dumps(canary), json.dumps(baseline)))
+
+  if canary['requests'] < min_requests or not baseline:
+    print('Not enough requests to compare the canary with the baseline, release %s promoted' % (
+      rollout['release']['id']))
+    return dict(rollout, status='promote')
+
+  reasons = []
+  error_rate = 100.0 * canary['errors'] / canary['requests']
+  baseline_error_rate = 100.0 * sum(instance['errors'] for instance in baseline) / sum(
+    instance['requests'] for instance in baseline)
+  if error_rate > baseline_error_rate + max_error_rate_increase:
+    reasons.append('error rate %.2f%% for %.2f%%' % (error_rate, baseline_error_rate))
+  for name in ('p50', 'p99'):
+    # Percentiles do not add up across instances: the baseline is the median of the instances
+    values = [instance[name] for instance in baseline if name in instance]
+    if name not in canary or not values:
+      continue
+    baseline_latency = statistics.median(values)
+    if canary[name] > baseline_latency * (1 + max_latency_increase / 100) + latency_margin_ms:
+      reasons.append('%s latency %.0f ms for %.0f ms' % (name, canary[name], baseline_latency))
+
+  if reasons:
+    print('Release %s rolled back: %s' % (rollout['release']['id'], ', '.join(reasons)))
+    return dict(rollout, status='rollback', reasons=reasons)
+  return dict(rollout, status='promote')
+
+# Make the release the one of all the instances
+def promote(rollout):
+  store_parameter(ssm_client, release_parameter, rollout['release'])
+  store_parameter(ssm_client, canary_parameter, json.loads(NO_RELEASE))
+  send_refresh_command('Configuration release %s' % rollout['release']['id'],
+    Targets=[{'Key': 'tag:aws:autoscaling:groupName', 'Values': asg_names}])
+  print_rollout_metric('Promoted')
+  return dict(rollout, status='promoted')
+
+# Put the canary instance back on the promoted release, and the bucket back on the content of the promoted release.
+# The versions of the promoted release are copied over the changed keys, and the keys added by the failed release
+# get a delete marker: the versions of the failed release stay in the bucket history.
+def rollback(rollout):
+  store_parameter(ssm_client, canary_parameter, json.loads(NO_RELEASE))
+  if rollout.get('canary_instance_id'):
+    send_refresh_command('Rollback of configuration release %s' % rollout['release']['id'],
+      InstanceIds=[rollout['canary_instance_id']])
+
+  release, previous_release = rollout['release'], rollout['previous_release']
+  objects = dict(previous_release['objects'])
+  delete_markers = dict(previous_release['delete_markers'])
+  changed = sorted(key for key in set(release['objects']) | set(previous_release['objects'])
+    if release['objects'].get(key) != previous_release['objects'].get(key))
+  not_restored = []
+  for key in changed:
+    try:
+      if key in previous_release['objects']:
+        response = s3_client.copy_object(Bucket=bucket, Key=key,
+          CopySource={'Bucket': bucket, 'Key': key, 'VersionId': previous_release['objects'][key]})
+        objects[key] = response['VersionId']
+        print('Restored version %s of %s as %s' % (previous_release['objects'][key], key, response['VersionId']))
+      else:
+        response = s3_client.delete_object(Bucket=bucket, Key=key)
+        delete_markers[key] = response.get('VersionId')
+        print('Deleted %s, added by the release' % key)
+    except ClientError as e:
+      print('%s not restored: %s' % (key, e))
+      not_restored.append(key)
+  print_rollout_metric('RolledBack')
+
+  # The instances keep the promoted release, and the next rollout finds the changes that were not undone
+  if not_restored:
+    raise RollbackError('Configuration files not restored: %s' % ', '.join(not_restored))
+
+  # The restored versions have the content of the promoted release: once recorded as the promoted release,
+  # the rollouts started by the S3 events of the rollback itself find nothing to roll out
+  restored = make_release(objects, delete_markers)
+  store_parameter(ssm_client, release_parameter, restored)
+  return dict(rollout, status='rolled-back', restored_release=restored,
+    failed_versions={key: release['objects'][key] for key in changed if key in release['objects']})
+
+actions = {
+  'prepare': prepare,
+  'start_canary': start_canary,
+  'check_canary': check_canary,
+  'evaluate': evaluate,
+  'promote': promote,
+  'rollback': rollback
+}
+
+# Steps of the configuration rollout state machine: each step gets the rollout state and returns it updated
+def handler(event, context):
+  print(json.dumps(event))
+  rollout = dict(event['rollout'], execution=event['execution'], state_machine=event['state_machine'])
+  return actions[event['action']](rollout)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Releases of the Squid configuration: the object versions of the config bucket that the instances run.
+#
+# A release maps the key of each configuration file to its version in the versioned bucket. The promoted release
+# is kept in an SSM parameter, and the release under test on the canary instance in another one, with the ID of
+# the canary instance. The rollout function builds the releases from the latest object versions, and the
+# squid-conf-refresh.sh script of the instances downloads the release of the instance:
+#   python3 config_release.py fetch --bucket <bucket> --release-parameter <name> --canary-parameter <name> \
+#     --instance-id i-0123 --directory /var/lib/squid-config/staging
+
+import argparse
+import hashlib
+import json
+import os
+
+# The SSM parameters hold an empty object until the first release is promoted
+NO_RELEASE = '{}'
+
+
+# Return a release of the given object versions
+# delete_markers holds the version of the delete marker of each deleted key, so that the deletion can be undone
+def make_release(objects, delete_markers=None):
+  digest = hashlib.sha256(json.dumps(objects, sort_keys=True).encode()).hexdigest()
+  return {'id': digest[:16], 'objects': objects, 'delete_markers': delete_markers or {}}
+
+# Return the release of the latest object versions of the bucket
+def latest_release(s3_client, bucket):
+  objects = {}
+  delete_markers = {}
+  for page in s3_client.get_paginator('list_object_versions').paginate(Bucket=bucket):
+    for version in page.get('Versions', []):
+      if version['IsLatest']:
+        objects[version['Key']] = version['VersionId']
+    for marker in page.get('DeleteMarkers', []):
+      if marker['IsLatest']:
+        delete_markers[marker['Key']] = marker['VersionId']
+  return make_release(objects, delete_markers)
+
+def load_parameter(ssm_client, name):
+  return json.loads(ssm_client.get_parameter(Name=name)['Parameter']['Value'])
+
+def store_parameter(ssm_client, name, value):
+  ssm_client.put_parameter(Name=name, Value=json.dumps(value, sort_keys=True, separators=(',', ':')),
+    Type='String', Overwrite=True, Tier='Intelligent-Tiering')
+
+# Return the release that the given instance runs: the release under test on the canary instance,
+# the promoted release on the other instances, or the latest object versions before the first promotion
+def instance_release(release, canary, instance_id, latest):
+  if canary.get('instance_id') == instance_id:
+    return canary['release']
+  if release.get('objects'):
+    return release
+  return latest()
+
+# Download the objects of a release to a directory and remove the files that are not part of it, like
+# aws s3 sync --delete. The versions already downloaded are recorded next to the directory and not downloaded again.
+def download_release(s3_client, bucket, release, directory):
+  versions_file = directory.rstrip('/') + '.versions.json'
+  try:
+    with open(versions_file) as versions_h:
+      downloaded = json.load(versions_h)
+  except (OSError, ValueError):
+    downloaded = {}
+
+  for key, version_id in sorted(release['objects'].items()):
+    path = os.path.join(directory, key)
+    if downloaded.get(key) == version_id and os.path.exists(path):
+      continue
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    s3_client.download_file(bucket, key, path, ExtraArgs={'VersionId': version_id})
+    downloaded[key] = version_id
+
+  for root, _, files in os.walk(directory):
+    for name in files:
+      path = os.path.join(root, name)
+      if os.path.relpath(path, directory) not in release['objects']:
+        os.remove(path)
+
+  with open(versions_file, 'w') as versions_h:
+    json.dump({key: version_id for key, version_id in downloaded.items() if key in release['objects']}, versions_h)
+
+def main():
+  parser = argparse.ArgumentParser(description='Download the Squid configuration release of an instance')
+  subparsers = parser.add_subparsers(dest='command')
+  fetch = subparsers.add_parser('fetch', help='download the release of the instance and print its ID')
+  fetch.add_argument('--bucket', required=True)
+  fetch.add_argument('--release-parameter', required=True)
+  fetch.add_argument('--canary-parameter', required=True)
+  fetch.add_argument('--instance-id', required=True)
+  fetch.add_argument('--directory', required=True)
+  fetch.add_argument('--region')
+  args = parser.parse_args()
+  if args.command != 'fetch':
+    parser.error('the fetch command is required')
+
+  import boto3
+
+  s3_client = boto3.client('s3', region_name=args.region)
+  ssm_client = boto3.client('ssm', region_name=args.region)
+  release = instance_release(
+    load_parameter(ssm_client, args.release_parameter),
+    load_parameter(ssm_client, args.canary_parameter),
+    args.instance_id,
+    lambda: latest_release(s3_client, args.bucket))
+  os.makedirs(args.directory, exist_ok=True)
+  download_release(s3_client, args.bucket, release, args.directory)
+  print(release['id'])
+
+if __name__ == '__main__':
+  main()
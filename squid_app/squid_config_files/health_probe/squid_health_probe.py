@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# Data-plane health probe for the squid instances.
+#
+# Probes the intercept ports (3129/3130) every probe interval and the forward port (3128)
+# through an allowed domain, publishes high resolution success and latency metrics along
+# with the squid request rate, and sets its own instance to Unhealthy as soon as consecutive
+# probes fail: the ASG replaces the instance, and the failover Lambda moves its routes to the
+# other instances. The squid alarm of the ASG only goes to ALARM when no instance of the ASG
+# answers, so one failed instance does not fail over the AZ. With --cache-metrics, it also publishes the cache hit ratios, the
+# bandwidth served from the cache and the median service times of the hits and the misses.
+# With --fair-share, it publishes the throttle counters of each fair share class: the clients held
+# by the bandwidth pools and by the connection caps of their class.
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import re
+import ssl
+import time
+import urllib.parse
+import urllib.request
+
+PROBE_NAMESPACE = 'Squid'
+IMDS_URL = 'http://169.254.169.254/latest'
+
+
+class ProbeResult:
+  def __init__(self, port, success, latency_ms, timestamp=None, error=None):
+    self.port = port
+    self.success = success
+    self.latency_ms = latency_ms
+    self.timestamp = timestamp or time.time()
+    self.error = error
+
+  def __repr__(self):
+    return 'ProbeResult(port=%d, success=%s, latency_ms=%.1f, error=%s)' % (
+      self.port, self.success, self.latency_ms, self.error)
+
+
+# A hung squid still accepts TCP connections through the kernel backlog, so every probe
+# requires an answer from squid itself before the timeout
+async def probe_forward(host, port, url, timeout):
+  parsed = urllib.parse.urlsplit(url)
+  reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+  try:
+    writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n' % (url, parsed.netloc)).encode())
+    await writer.drain()
+    headers = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+  finally:
+    writer.close()
+  status_line, _, header_block = headers.decode('latin-1').partition('\r\n')
+  # Squid answers with its own error page when the upstream can't be reached
+  if not status_line.startswith('HTTP/') or 'x-squid-error:' in header_block.lower():
+    raise ConnectionError('forward probe failed: %s' % status_line)
+
+async def probe_intercept_http(host, port, domain, timeout):
+  reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+  try:
+    writer.write(('GET / HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n' % domain).encode())
+    await writer.drain()
+    # Without a NAT entry squid either answers with an error page or closes the
+    # connection after the original destination lookup: both show the port is served
+    await asyncio.wait_for(reader.readline(), timeout)
+  finally:
+    writer.close()
+
+async def probe_intercept_https(host, port, domain, timeout):
+  context = ssl.create_default_context()
+  context.check_hostname = False
+  context.verify_mode = ssl.CERT_NONE
+  try:
+    _, writer = await asyncio.wait_for(
+      asyncio.open_connection(host, port, ssl=context, server_hostname=domain), timeout)
+    writer.close()
+  except (ssl.SSLError, ConnectionResetError, asyncio.IncompleteReadError):
+    # Squid answered the client hello: a peeked connection that is not intercepted
+    # is terminated by squid, which shows the port is served
+    pass
+
+
+class SquidHealthProbe:
+  def __init__(self, host='127.0.0.1', forward_port=3128, http_port=3129, https_port=3130,
+      probe_url='http://checkip.amazonaws.com/', probe_domain='checkip.amazonaws.com',
+      interval=0.5, forward_interval=5.0, timeout=0.4, failure_threshold=3, on_failure=None):
+    self.host = host
+    self.forward_port = forward_port
+    self.http_port = http_port
+    self.https_port = https_port
+    self.probe_url = probe_url
+    self.probe_domain = probe_domain
+    self.interval = interval
+    self.forward_interval = forward_interval
+    self.timeout = timeout
+    self.failure_threshold = failure_threshold
+    self.on_failure = on_failure
+    self.consecutive_failures = 0
+    self.failed = False
+    self.cycles = []
+    self._last_forward_probe = 0
+
+  async def _timed(self, port, probe, *args):
+    started = time.monotonic()
+    try:
+      await probe(self.host, port, *args, self.timeout)
+      return ProbeResult(port, True, (time.monotonic() - started) * 1000)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+      return ProbeResult(port, False, (time.monotonic() - started) * 1000, error=repr(e))
+
+  # Run one probe cycle and return its results
+  async def probe_once(self):
+    probes = [
+      self._timed(self.http_port, probe_intercept_http, self.probe_domain),
+      self._timed(self.https_port, probe_intercept_https, self.probe_domain)
+    ]
+    # The forward probe goes out to the internet, so it runs less often
+    if time.monotonic() - self._last_forward_probe >= self.forward_interval:
+      self._last_forward_probe = time.monotonic()
+      probes.append(self._timed(self.forward_port, probe_forward, self.probe_url))
+    results = await asyncio.gather(*probes)
+    self.cycles.append(results)
+
+    if all(result.success for result in results):
+      self.consecutive_failures = 0
+      self.failed = False
+    else:
+      self.consecutive_failures += 1
+      if self.consecutive_failures >= self.failure_threshold and not self.failed:
+        self.failed = True
+        if self.on_failure:
+          self.on_failure([result for result in results if not result.success])
+    return results
+
+  async def run(self, duration=None):
+    started = time.monotonic()
+    while duration is None or time.monotonic() - started < duration:
+      cycle_started = time.monotonic()
+      await self.probe_once()
+      await asyncio.sleep(max(0, self.interval - (time.monotonic() - cycle_started)))
+
+  # Return and clear the results of the probe cycles run since the last call, one list per cycle
+  def drain(self):
+    cycles, self.cycles = self.cycles, []
+    return cycles
+
+
+# Read a page of the squid cache manager, which squid serves to localhost on the forward port
+async def fetch_mgr_page(host, port, page, timeout):
+  reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+  try:
+    writer.write(('GET /squid-internal-mgr/%s HTTP/1.0\r\nHost: %s:%d\r\n\r\n' % (page, host, port)).encode())
+    await writer.drain()
+    response = await asyncio.wait_for(reader.read(), timeout)
+  finally:
+    writer.close()
+  headers, _, body = response.decode('latin-1').partition('\r\n\r\n')
+  if not headers.startswith('HTTP/') or headers.split(' ', 2)[1] != '200':
+    raise ConnectionError('cache manager page %s not available: %s' % (page, headers.split('\r\n')[0]))
+  return body
+
+# Parse the 'name = value' lines of the counters page
+def parse_mgr_counters(text):
+  counters = {}
+  for line in text.splitlines():
+    name, separator, value = line.partition('=')
+    if separator:
+      try:
+        counters[name.strip()] = float(value.strip())
+      except ValueError:
+        pass
+  return counters
+
+
+# 5 minutes median service times of the info page, in seconds
+MEDIAN_SERVICE_TIME_RE = re.compile(r'^\s*(Cache Hits|Cache Misses):\s+([\d.]+)\s+[\d.]+', re.MULTILINE)
+
+def parse_mgr_service_times(text):
+  return {name: float(value) for name, value in MEDIAN_SERVICE_TIME_RE.findall(text)}
+
+
+# Levels of the buckets of the delay pools page, per pool: the aggregate buckets and the client buckets
+# With SMP workers, the page holds the pools of every worker
+def parse_mgr_delay(text):
+  pools = {}
+  pool = section = None
+  for line in text.splitlines():
+    line = line.strip()
+    name, _, value = line.partition(':')
+    if name == 'Pool':
+      pool = pools.setdefault(int(value), {'aggregate': [], 'clients': []})
+      section = None
+    elif pool is None:
+      continue
+    elif line in ('Aggregate:', 'Network:', 'Individual:'):
+      section = name
+      aggregate_max = None
+    elif section == 'Aggregate' and name == 'Max':
+      aggregate_max = int(value)
+    elif section == 'Aggregate' and name == 'Current' and aggregate_max:
+      pool['aggregate'].append((int(value), aggregate_max))
+    elif section == 'Individual' and name.startswith('Current'):
+      # Current [Network 2]: 15:3000 16:-20
+      pool['clients'].extend(int(level) for level in re.findall(r'\S+:(-?\d+)', value))
+  return pools
+
+# Established connections of the clients page, one (address, connections) per client and per worker
+CLIENT_RE = re.compile(r'^Address:\s+(\S+)\s*$.*?^Currently established connections:\s+(\d+)', re.MULTILINE | re.DOTALL)
+
+def parse_mgr_client_list(text):
+  return [(address, int(connections)) for address, connections in CLIENT_RE.findall(text)]
+
+
+# Throttle counters of the fair share classes, from the classes written by the CDK app next to the Squid settings
+class FairShareMetrics:
+  def __init__(self, path):
+    self.path = path
+
+  def load_classes(self):
+    with open(self.path) as fair_share_h:
+      classes = json.load(fair_share_h)['classes']
+    for fair_share_class in classes:
+      fair_share_class['networks'] = [ipaddress.ip_network(cidr) for cidr in fair_share_class['cidrs']]
+    return classes
+
+  # Return the class of a client: the first class of its CIDRs, or the class without CIDRs
+  @staticmethod
+  def client_class(classes, address):
+    try:
+      address = ipaddress.ip_address(address)
+    except ValueError:
+      return None
+    if address.is_loopback:
+      return None
+    for fair_share_class in classes:
+      if any(address in network for network in fair_share_class['networks']):
+        return fair_share_class
+    return next((fair_share_class for fair_share_class in classes if not fair_share_class['networks']), None)
+
+  # Return a list of (metric name, value, unit, dimensions) tuples
+  def metrics(self, delay_text, client_list_text):
+    classes = self.load_classes()
+    pools = parse_mgr_delay(delay_text)
+    connections = {fair_share_class['name']: 0 for fair_share_class in classes}
+    limited_clients = {fair_share_class['name']: set() for fair_share_class in classes}
+    for address, established in parse_mgr_client_list(client_list_text):
+      fair_share_class = self.client_class(classes, address)
+      if fair_share_class is None:
+        continue
+      connections[fair_share_class['name']] += established
+      # The cap applies to the connections of a client to each worker
+      if fair_share_class['max_connections'] and established >= fair_share_class['max_connections']:
+        limited_clients[fair_share_class['name']].add(address)
+
+    metrics = []
+    for fair_share_class in classes:
+      dimensions = {'FairShareClass': fair_share_class['name']}
+      pool = pools.get(fair_share_class['pool'], {'aggregate': [], 'clients': []})
+      metrics.append(('FairShareConnections', connections[fair_share_class['name']], 'Count', dimensions))
+      metrics.append(('FairShareConnectionLimitedClients', len(limited_clients[fair_share_class['name']]), 'Count',
+        dimensions))
+      # Clients that used up their bucket: their transfers only go at the restore rate
+      metrics.append(('FairShareThrottledClients', sum(level <= 0 for level in pool['clients']), 'Count', dimensions))
+      if pool['aggregate']:
+        metrics.append(('FairShareBucketLevel',
+          100.0 * sum(max(0, level) / maximum for level, maximum in pool['aggregate']) / len(pool['aggregate']),
+          'Percent', dimensions))
+    return metrics
+
+
+# Turn the squid counters into rates between two samples
+class SquidCounters:
+  def __init__(self, host='127.0.0.1', port=3128, timeout=2.0, cache_metrics=False, fair_share=None):
+    self.host = host
+    self.port = port
+    self.timeout = timeout
+    self.cache_metrics = cache_metrics
+    self.fair_share = fair_share
+    self._previous = None
+
+  # Return a list of (metric name, value, unit) tuples, and of (metric name, value, unit, dimensions) tuples
+  async def sample(self):
+    counters = parse_mgr_counters(await fetch_mgr_page(self.host, self.port, 'counters', self.timeout))
+    now = time.monotonic()
+    metrics = []
+    if self._previous:
+      previous, previous_time = self._previous
+      requests = counters.get('client_http.requests', 0) - previous.get('client_http.requests', 0)
+      # Counters start over when squid restarts
+      if requests >= 0:
+        metrics.append(('RequestRate', requests / (now - previous_time), 'Count/Second'))
+        if self.cache_metrics:
+          metrics.extend(self._cache_metrics(counters, previous, now - previous_time))
+    self._previous = (counters, now)
+    if self.cache_metrics:
+      service_times = parse_mgr_service_times(await fetch_mgr_page(self.host, self.port, 'info', self.timeout))
+      for name, metric_name in (('Cache Hits', 'CacheHitServiceTime'), ('Cache Misses', 'CacheMissServiceTime')):
+        if service_times.get(name):
+          metrics.append((metric_name, service_times[name] * 1000, 'Milliseconds'))
+    if self.fair_share:
+      try:
+        metrics.extend(self.fair_share.metrics(
+          await fetch_mgr_page(self.host, self.port, 'delay', self.timeout),
+          await fetch_mgr_page(self.host, self.port, 'client_list', self.timeout)))
+      except (OSError, ValueError, KeyError) as e:
+        print('Failed to read the fair share counters: %r' % e, flush=True)
+    return metrics
+
+  # Share of the requests and of the bytes served from the cache, and bandwidth that did not go upstream
+  def _cache_metrics(self, counters, previous, elapsed):
+    delta = {name: counters.get(name, 0) - previous.get(name, 0) for name in
+      ('client_http.requests', 'client_http.hits', 'client_http.kbytes_out', 'client_http.hit_kbytes_out')}
+    metrics = [('CacheHitBandwidth', delta['client_http.hit_kbytes_out'] * 1024 / elapsed, 'Bytes/Second')]
+    if delta['client_http.requests'] > 0:
+      metrics.append(('CacheHitRatio', 100.0 * delta['client_http.hits'] / delta['client_http.requests'], 'Percent'))
+    if delta['client_http.kbytes_out'] > 0:
+      metrics.append(('ByteHitRatio', 100.0 * delta['client_http.hit_kbytes_out'] / delta['client_http.kbytes_out'],
+        'Percent'))
+    return metrics
+
+
+# Publish the probe results as high resolution CloudWatch metrics
+class CloudWatchPublisher:
+  def __init__(self, cw_client, asg_name, namespace=PROBE_NAMESPACE):
+    self.cw_client = cw_client
+    self.asg_name = asg_name
+    self.namespace = namespace
+
+  # The ProbeSuccess of the ASG, read by the squid alarm, is 1 for a cycle where squid answered on all the probed
+  # ports. The success and the latency of each port are published with the Port dimension
+  def metric_data(self, cycles):
+    asg_dimension = {'Name': 'AutoScalingGroupName', 'Value': self.asg_name}
+    metric_data = []
+    for results in cycles:
+      timestamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(min(result.timestamp for result in results)))
+      metric_data.append({'MetricName': 'ProbeSuccess', 'Dimensions': [asg_dimension],
+        'Timestamp': timestamp, 'Value': 1 if all(result.success for result in results) else 0,
+        'StorageResolution': 1})
+      for result in results:
+        port_dimension = {'Name': 'Port', 'Value': str(result.port)}
+        metric_data.append({'MetricName': 'ProbeSuccess', 'Dimensions': [asg_dimension, port_dimension],
+          'Timestamp': timestamp, 'Value': 1 if result.success else 0, 'StorageResolution': 1})
+        metric_data.append({'MetricName': 'ProbeLatency', 'Dimensions': [asg_dimension, port_dimension],
+          'Timestamp': timestamp, 'Value': result.latency_ms, 'Unit': 'Milliseconds', 'StorageResolution': 1})
+    return metric_data
+
+  def publish(self, cycles, metrics=()):
+    metric_data = self.metric_data(cycles)
+    for name, value, unit, *dimensions in metrics:
+      metric_data.append({'MetricName': name, 'Value': value, 'Unit': unit,
+        'Dimensions': [{'Name': 'AutoScalingGroupName', 'Value': self.asg_name}] +
+          [{'Name': key, 'Value': dimension} for key, dimension in (dimensions[0] if dimensions else {}).items()]})
+    # PutMetricData accepts up to 1000 metrics per call
+    for start in range(0, len(metric_data), 1000):
+      self.cw_client.put_metric_data(Namespace=self.namespace, MetricData=metric_data[start:start + 1000])
+
+
+def instance_metadata(path):
+  token_request = urllib.request.Request(IMDS_URL + '/api/token', method='PUT',
+    headers={'X-aws-ec2-metadata-token-ttl-seconds': '300'})
+  token = urllib.request.urlopen(token_request, timeout=2).read().decode()
+  request = urllib.request.Request(IMDS_URL + '/' + path, headers={'X-aws-ec2-metadata-token': token})
+  return urllib.request.urlopen(request, timeout=2).read().decode()
+
+async def publish_loop(probe, counters, publisher, publish_interval):
+  while True:
+    await asyncio.sleep(publish_interval)
+    cycles = probe.drain()
+    try:
+      metrics = await counters.sample()
+    except (OSError, asyncio.TimeoutError) as e:
+      print('Failed to read the squid counters: %r' % e, flush=True)
+      metrics = []
+    if cycles or metrics:
+      try:
+        await asyncio.get_event_loop().run_in_executor(None, publisher.publish, cycles, metrics)
+      except Exception as e:
+        print('Failed to publish probe metrics: %r' % e, flush=True)
+
+def main():
+  parser = argparse.ArgumentParser(description='Squid data-plane health probe')
+  parser.add_argument('--probe-url', default='http://checkip.amazonaws.com/',
+    help='URL of an allowed domain fetched through the forward port')
+  parser.add_argument('--interval', type=float, default=0.5, help='Seconds between intercept port probes')
+  parser.add_argument('--forward-interval', type=float, default=5.0, help='Seconds between forward port probes')
+  parser.add_argument('--timeout', type=float, default=0.4, help='Seconds before a probe is considered failed')
+  parser.add_argument('--failure-threshold', type=int, default=3,
+    help='Consecutive failed probe cycles before the instance is set to Unhealthy')
+  parser.add_argument('--publish-interval', type=float, default=5.0, help='Seconds between metric publications')
+  parser.add_argument('--cache-metrics', action='store_true', help='Publish the cache hit ratios and service times')
+  parser.add_argument('--fair-share', help='Classes of the fair share policy, to publish their throttle counters')
+  args = parser.parse_args()
+
+  import boto3
+
+  identity = json.loads(instance_metadata('dynamic/instance-identity/document'))
+  as_client = boto3.client('autoscaling', region_name=identity['region'])
+  cw_client = boto3.client('cloudwatch', region_name=identity['region'])
+  asg_name = as_client.describe_auto_scaling_instances(
+    InstanceIds=[identity['instanceId']])['AutoScalingInstances'][0]['AutoScalingGroupName']
+
+  # Replace this instance right away instead of waiting for the EC2 health checks: only this instance
+  # is replaced, the other instances of the ASG keep serving their routes
+  def set_unhealthy(failed_results):
+    print('Squid probe failed: %s' % failed_results, flush=True)
+    try:
+      as_client.set_instance_health(InstanceId=identity['instanceId'], HealthStatus='Unhealthy',
+        ShouldRespectGracePeriod=False)
+    except Exception as e:
+      print('Failed to set the instance to Unhealthy: %r' % e, flush=True)
+
+  probe = SquidHealthProbe(
+    probe_url=args.probe_url,
+    probe_domain=urllib.parse.urlsplit(args.probe_url).hostname,
+    interval=args.interval,
+    forward_interval=args.forward_interval,
+    timeout=args.timeout,
+    failure_threshold=args.failure_threshold,
+    on_failure=set_unhealthy
+  )
+  publisher = CloudWatchPublisher(cw_client, asg_name)
+  print('Probing squid for %s every %.1fs' % (asg_name, args.interval), flush=True)
+
+  loop = asyncio.get_event_loop()
+  counters = SquidCounters(cache_metrics=args.cache_metrics,
+    fair_share=FairShareMetrics(args.fair_share) if args.fair_share else None)
+  loop.create_task(publish_loop(probe, counters, publisher, args.publish_interval))
+  loop.run_until_complete(probe.run())
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,225 @@
+import datetime
+import json
+import time
+import uuid
+from collections import namedtuple
+
+from botocore.exceptions import ClientError
+
+from inventory import asg_name_from_alarm
+
+# An alarm state change of a squid ASG, time is the StateChangeTime of the alarm in epoch milliseconds
+AlarmTransition = namedtuple('AlarmTransition', ['asg_name', 'state', 'time'])
+
+# A squid instance that went in service (LAUNCH) or that is held by the terminating lifecycle hook (TERMINATING),
+# hook_name and token identify the lifecycle action to complete
+InstanceEvent = namedtuple('InstanceEvent', ['asg_name', 'instance_id', 'transition', 'hook_name', 'token'])
+
+LEASE_ITEM = 'lease'
+
+def parse_time(value):
+  # CloudWatch uses 2021-03-24T12:34:56.789+0000, SNS uses 2021-03-24T12:34:56.789Z
+  parsed = datetime.datetime.strptime(value.replace('Z', '+0000'), '%Y-%m-%dT%H:%M:%S.%f%z')
+  return int(parsed.timestamp() * 1000)
+
+# Alarm transitions of the SNS records, in the order of their state change time
+def parse_transitions(records):
+  transitions = []
+  for record in records:
+    message = json.loads(record['Sns']['Message'])
+    if 'AlarmName' not in message:
+      continue
+    state_change_time = message.get('StateChangeTime') or record['Sns'].get('Timestamp')
+    transitions.append(AlarmTransition(
+      asg_name=asg_name_from_alarm(message['AlarmName']),
+      state=message['NewStateValue'],
+      time=parse_time(state_change_time) if state_change_time else int(time.time() * 1000)
+    ))
+  return sorted(transitions, key=lambda transition: transition.time)
+
+# Instance events of the SNS records of the lifecycle hook topic. The launching lifecycle actions are completed
+# by the instances themselves and the test notifications are ignored
+def parse_instance_events(records):
+  events = []
+  for record in records:
+    message = json.loads(record['Sns']['Message'])
+    if message.get('LifecycleTransition') == 'autoscaling:EC2_INSTANCE_TERMINATING':
+      events.append(InstanceEvent(message['AutoScalingGroupName'], message['EC2InstanceId'], 'TERMINATING',
+        message['LifecycleHookName'], message['LifecycleActionToken']))
+    elif message.get('Event') == 'autoscaling:EC2_INSTANCE_LAUNCH':
+      events.append(InstanceEvent(message['AutoScalingGroupName'], message['EC2InstanceId'], 'LAUNCH', None, None))
+  return events
+
+# The alarm changed state again after the transition, the notification of its current state follows
+def superseded(transition, alarm):
+  updated = alarm.get('StateUpdatedTimestamp')
+  if not updated or alarm.get('StateValue') not in ('ALARM', 'OK') or alarm['StateValue'] == transition.state:
+    return False
+  return int(updated.timestamp() * 1000) > transition.time
+
+
+# Failover state kept in a DynamoDB table:
+#  - the "lease" item serializes the invocations that change routes
+#  - an "asg#<name>" item per ASG holds the time and the state of its last processed transition
+class DynamoDbStateStore:
+  def __init__(self, ddb_client, table_name):
+    self.ddb_client = ddb_client
+    self.table_name = table_name
+
+  def acquire_lease(self, owner, now_ms, expires_ms):
+    try:
+      self.ddb_client.update_item(
+        TableName=self.table_name,
+        Key={'Id': {'S': LEASE_ITEM}},
+        UpdateExpression='SET LeaseOwner = :owner, LeaseExpires = :expires',
+        ConditionExpression='attribute_not_exists(LeaseOwner) OR LeaseExpires < :now OR LeaseOwner = :owner',
+        ExpressionAttributeValues={
+          ':owner': {'S': owner},
+          ':expires': {'N': str(expires_ms)},
+          ':now': {'N': str(now_ms)}
+        }
+      )
+      return True
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        raise
+      return False
+
+  # Extend the lease, only if no other invocation took it since it was acquired
+  def renew_lease(self, owner, expires_ms):
+    try:
+      self.ddb_client.update_item(
+        TableName=self.table_name,
+        Key={'Id': {'S': LEASE_ITEM}},
+        UpdateExpression='SET LeaseExpires = :expires',
+        ConditionExpression='LeaseOwner = :owner',
+        ExpressionAttributeValues={
+          ':owner': {'S': owner},
+          ':expires': {'N': str(expires_ms)}
+        }
+      )
+      return True
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        raise
+      return False
+
+  def release_lease(self, owner):
+    try:
+      self.ddb_client.update_item(
+        TableName=self.table_name,
+        Key={'Id': {'S': LEASE_ITEM}},
+        UpdateExpression='REMOVE LeaseOwner, LeaseExpires',
+        ConditionExpression='LeaseOwner = :owner',
+        ExpressionAttributeValues={':owner': {'S': owner}}
+      )
+    except ClientError as e:
+      # The lease expired and was taken by another invocation
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        raise
+
+  # Time of the last processed transition of each ASG
+  def last_transition_times(self, asg_names):
+    times = {}
+    keys = [{'Id': {'S': 'asg#%s' % asg_name}} for asg_name in sorted(set(asg_names))]
+    for start in range(0, len(keys), 100):
+      request = {self.table_name: {'Keys': keys[start:start + 100], 'ConsistentRead': True}}
+      while request:
+        response = self.ddb_client.batch_get_item(RequestItems=request)
+        for item in response['Responses'].get(self.table_name, []):
+          times[item['Id']['S'][len('asg#'):]] = int(item['StateChangeTime']['N'])
+        request = response.get('UnprocessedKeys')
+    return times
+
+  def record_transition(self, transition):
+    try:
+      self.ddb_client.update_item(
+        TableName=self.table_name,
+        Key={'Id': {'S': 'asg#%s' % transition.asg_name}},
+        UpdateExpression='SET StateChangeTime = :time, AlarmState = :state',
+        ConditionExpression='attribute_not_exists(StateChangeTime) OR StateChangeTime < :time',
+        ExpressionAttributeValues={
+          ':time': {'N': str(transition.time)},
+          ':state': {'S': transition.state}
+        }
+      )
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        raise
+
+
+class LeaseTimeout(Exception):
+  pass
+
+
+class LeaseLost(Exception):
+  pass
+
+
+# Makes sure that the transitions of each ASG are processed once, in order, by one invocation at a time.
+# lease_seconds should be at least the timeout of the function: the lease of an invocation that stops
+# without releasing it expires after lease_seconds
+class FailoverCoordinator:
+  def __init__(self, store, lease_seconds=30, poll_interval=0.1):
+    self.store = store
+    self.lease_seconds = lease_seconds
+    self.poll_interval = poll_interval
+
+  # Wait for the lease until the deadline (epoch seconds) and return its owner id
+  def acquire(self, deadline, owner=None):
+    owner = owner or str(uuid.uuid4())
+    delay = self.poll_interval
+    while True:
+      now_ms = int(time.time() * 1000)
+      if self.store.acquire_lease(owner, now_ms, now_ms + self.lease_seconds * 1000):
+        return owner
+      if time.time() + delay > deadline:
+        raise LeaseTimeout('Failover lease not acquired before the deadline')
+      time.sleep(delay)
+      delay = min(delay * 2, 1.0)
+
+  # Extend the lease before changing routes or committing transitions, and make sure that it is still held
+  def renew(self, owner):
+    if not self.store.renew_lease(owner, int(time.time() * 1000) + self.lease_seconds * 1000):
+      raise LeaseLost('Failover lease expired and taken by another invocation')
+
+  def release(self, owner):
+    self.store.release_lease(owner)
+
+  # Keep the latest transition of each ASG, and drop the ones already processed or older than the last processed one
+  def fresh_transitions(self, transitions):
+    latest = {}
+    for transition in transitions:
+      if transition.asg_name not in latest or transition.time >= latest[transition.asg_name].time:
+        latest[transition.asg_name] = transition
+    last_times = self.store.last_transition_times(latest.keys())
+    fresh = []
+    for transition in sorted(latest.values(), key=lambda transition: transition.time):
+      if transition.time <= last_times.get(transition.asg_name, -1):
+        print('Dropped %s transition of %s: a transition as recent was already processed' % (
+          transition.state, transition.asg_name))
+      else:
+        fresh.append(transition)
+    return fresh
+
+  def commit(self, transitions):
+    for transition in transitions:
+      self.store.record_transition(transition)
+
+
+# Used when no state table is configured: every transition is processed, without lease
+class NoCoordination:
+  def acquire(self, deadline, owner=None):
+    return owner
+
+  def renew(self, owner):
+    pass
+
+  def release(self, owner):
+    pass
+
+  def fresh_transitions(self, transitions):
+    return transitions
+
+  def commit(self, transitions):
+    pass
@@ -0,0 +1,143 @@
+import time
+
+ALARM_PREFIX = 'squid-alarm_'
+ROUTE_TABLE_TAG = 'RouteTableIds'
+
+# Count every API request made by a boto3 client, including each page fetched by a paginator
+class ApiCallCounter:
+  def __init__(self, *clients):
+    self.calls = {}
+    for client in clients:
+      client.meta.events.register('before-parameter-build', self._count)
+
+  def _count(self, model, **kwargs):
+    self.calls[model.name] = self.calls.get(model.name, 0) + 1
+
+  def reset(self):
+    self.calls = {}
+
+  @property
+  def total(self):
+    return sum(self.calls.values())
+
+  def summary(self):
+    return ', '.join('%s=%d' % (name, count) for name, count in sorted(self.calls.items()))
+
+
+# Snapshot of the squid fleet taken once per Lambda invocation.
+# Every SNS record in the batch is resolved against this snapshot instead of calling the APIs again.
+class Inventory:
+  def __init__(self, as_client, cw_client, ec2_client, topic_arn=None):
+    self.as_client = as_client
+    self.cw_client = cw_client
+    self.ec2_client = ec2_client
+    self.topic_arn = topic_arn
+    self.asgs = {}
+    self.alarms = {}
+    self.route_tables = {}
+    self._lifecycle_hooks = {}
+    self.started_at = time.time()
+
+  def load(self):
+    self._load_asgs()
+    self._load_alarms()
+    self._load_route_tables()
+    return self
+
+  # All squid ASGs are tagged with the route table ids they serve in their AZ: only the ASGs with the tag
+  # are listed, instead of every ASG of the account
+  def _load_asgs(self):
+    for page in self.as_client.get_paginator('describe_auto_scaling_groups').paginate(
+      Filters=[{'Name': 'tag-key', 'Values': [ROUTE_TABLE_TAG]}]
+    ):
+      for asg in page['AutoScalingGroups']:
+        tags = {tag['Key']: tag['Value'] for tag in asg.get('Tags', [])}
+        if ROUTE_TABLE_TAG in tags:
+          asg['RouteTableIds'] = [rt for rt in tags[ROUTE_TABLE_TAG].split(',') if rt]
+          self.asgs[asg['AutoScalingGroupName']] = asg
+
+  def _load_alarms(self):
+    parameters = {'AlarmNamePrefix': ALARM_PREFIX}
+    if self.topic_arn:
+      parameters['ActionPrefix'] = self.topic_arn
+    for page in self.cw_client.get_paginator('describe_alarms').paginate(**parameters):
+      for alarm in page['MetricAlarms']:
+        self.alarms[asg_name_from_alarm(alarm['AlarmName'])] = alarm
+
+  # Fetch every route table referenced by a squid ASG in a single paginated call
+  def _load_route_tables(self):
+    route_table_ids = sorted({rt for asg in self.asgs.values() for rt in asg['RouteTableIds']})
+    if not route_table_ids:
+      return
+    for page in self.ec2_client.get_paginator('describe_route_tables').paginate(
+      Filters=[{'Name': 'route-table-id', 'Values': route_table_ids}]
+    ):
+      for route_table in page['RouteTables']:
+        self.route_tables[route_table['RouteTableId']] = route_table
+
+  def asg(self, asg_name):
+    if asg_name not in self.asgs:
+      raise KeyError('Auto Scaling group %s is not a squid ASG' % asg_name)
+    return self.asgs[asg_name]
+
+  def healthy_instances(self, asg_name):
+    return [instance for instance in self.asg(asg_name)['Instances']
+      if instance['HealthStatus'] == 'Healthy' and instance['LifecycleState'] in ('Pending:Wait', 'Pending:Proceed', 'InService')]
+
+  # Instances that completed their launch lifecycle action: squid accepts connections
+  def in_service_instances(self, asg_name):
+    return [instance for instance in self.healthy_instances(asg_name)
+      if instance['LifecycleState'] in ('Pending:Proceed', 'InService')]
+
+  # ASGs whose alarm is currently OK, in the order the alarms were returned
+  def healthy_asg_names(self, exclude=None):
+    return [name for name, alarm in self.alarms.items()
+      if alarm['StateValue'] == 'OK' and name != exclude and name in self.asgs]
+
+  # Route tables currently tagged as served by the given ASG
+  def route_tables_served_by(self, asg_name):
+    return [route_table_id for route_table_id, route_table in self.route_tables.items()
+      if tag_value(route_table, 'AutoScalingGroupName') == asg_name]
+
+  # Launching lifecycle hooks of an ASG
+  # DescribeLifecycleHooks only accepts one ASG per call, so hooks are fetched lazily and cached
+  def launching_hook_names(self, asg_name):
+    if asg_name not in self._lifecycle_hooks:
+      self._lifecycle_hooks[asg_name] = [hook['LifecycleHookName'] for hook in
+        self.as_client.describe_lifecycle_hooks(AutoScalingGroupName=asg_name)['LifecycleHooks']
+        if hook['LifecycleTransition'] == 'autoscaling:EC2_INSTANCE_LAUNCHING']
+    return self._lifecycle_hooks[asg_name]
+
+  # Keep the snapshot in line with the changes made during this invocation
+  def record_alarm_state(self, asg_name, state):
+    if asg_name in self.alarms:
+      self.alarms[asg_name]['StateValue'] = state
+
+  def record_lifecycle_state(self, instance_id, lifecycle_state):
+    for asg in self.asgs.values():
+      for instance in asg['Instances']:
+        if instance['InstanceId'] == instance_id:
+          instance['LifecycleState'] = lifecycle_state
+
+  def record_route(self, route_table_id, instance_id, asg_name):
+    route_table = self.route_tables.setdefault(route_table_id,
+      {'RouteTableId': route_table_id, 'Routes': [], 'Tags': []})
+    route_table['Routes'] = [route for route in route_table['Routes']
+      if route.get('DestinationCidrBlock') != '0.0.0.0/0']
+    route_table['Routes'].append({'DestinationCidrBlock': '0.0.0.0/0', 'InstanceId': instance_id, 'State': 'active'})
+    route_table['Tags'] = [tag for tag in route_table.get('Tags', []) if tag['Key'] != 'AutoScalingGroupName']
+    route_table['Tags'].append({'Key': 'AutoScalingGroupName', 'Value': asg_name})
+
+  @property
+  def elapsed_ms(self):
+    return (time.time() - self.started_at) * 1000
+
+
+def asg_name_from_alarm(alarm_name):
+  return alarm_name[len(ALARM_PREFIX):] if alarm_name.startswith(ALARM_PREFIX) else alarm_name.split('_', 1)[1]
+
+def tag_value(resource, key):
+  for tag in resource.get('Tags', []):
+    if tag['Key'] == key:
+      return tag['Value']
+  return None
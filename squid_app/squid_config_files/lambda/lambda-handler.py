@@ -1,108 +1,249 @@
 import json
 import boto3
 import os
+import time
+
+from botocore.exceptions import ClientError
+
+from coordination import (DynamoDbStateStore, FailoverCoordinator, NoCoordination, parse_instance_events,
+  parse_transitions, superseded)
+from inventory import ApiCallCounter, Inventory
+from route_planner import RouteApplyError, RoutePlanner, plan_routes
+from target_selection import balance_route_tables, current_targets, target_strategy
 
 as_client = boto3.client('autoscaling')
 cw_client = boto3.client('cloudwatch')
 ec2_client = boto3.client('ec2')
+ddb_client = boto3.client('dynamodb')
 
-# Function to create or update the default route
-def update_route(route_table_id, instance_id, asg_name):
-  parameters = {
-    'DestinationCidrBlock': '0.0.0.0/0',
-    'RouteTableId': route_table_id,
-    'InstanceId': instance_id
-  }
-  try:
-    ec2_client.replace_route(**parameters)
-  except:
-    ec2_client.create_route(**parameters)
-  ec2_client.create_tags(
-    Resources=[route_table_id],
-    Tags=[{'Key': 'AutoScalingGroupName', 'Value': asg_name}]
-  )
-  print('Updated default route of %s to %s' % (route_table_id, instance_id))
+api_calls = ApiCallCounter(as_client, cw_client, ec2_client, ddb_client)
 
-def handler(event, context):
-  print(json.dumps(event))
-  for record in event['Records']:
-    message = json.loads(record['Sns']['Message'])
-    print('Alarm state: %s' % message['NewStateValue'])
+# When DRY_RUN is set, the route plan is printed but nothing is changed
+dry_run = os.environ.get('DRY_RUN', 'false').lower() == 'true'
 
-    # Auto Scaling group associated to the alarm
-    asg_name = message['AlarmName'].split('_')[1]
-    print('ASG Name: %s' % asg_name)
-    asg = as_client.describe_auto_scaling_groups(
-      AutoScalingGroupNames=[asg_name]
-    )['AutoScalingGroups'][0]
+route_planner = RoutePlanner(ec2_client,
+  max_workers=int(os.environ.get('ROUTE_UPDATE_CONCURRENCY', '8')),
+  dry_run=dry_run
+)
 
-    # If the NAT instance has failed
-    if message['NewStateValue'] == 'ALARM':
+# Strategy that selects the healthy instances taking over the route tables of a failed ASG
+strategy = target_strategy(os.environ.get('TARGET_STRATEGY', 'spread'))
 
-      # Set the NAT instance to Unhealthy
-      try:
-        for instance in asg['Instances']:
-          as_client.set_instance_health(
-            InstanceId=instance['InstanceId'],
-            HealthStatus='Unhealthy'
-          )
-          print('Set instance %s to Unhealthy' % instance['InstanceId'])
-      except:
-        pass
-
-      # Route traffic to the first health NAT instance
-      for healthy_alarm in cw_client.describe_alarms(
-        AlarmNamePrefix='squid-alarm_',
-        ActionPrefix=os.environ.get('TOPIC_ARN'),
-        StateValue='OK'
-      )['MetricAlarms']:
-
-        healthy_asg_name = healthy_alarm['AlarmName'].split('_')[1]
-        healthy_asg = as_client.describe_auto_scaling_groups(
-          AutoScalingGroupNames=[healthy_asg_name]
-        )['AutoScalingGroups'][0]
-        healthy_instance_id = healthy_asg['Instances'][0]['InstanceId']
-        print('Healthy NAT instance: %s' % healthy_instance_id)
-
-        # For each route table that currently routes traffic to the unhealthy NAT
-        # instance, update the default route
-        for route_table in ec2_client.describe_route_tables(
-          Filters=[{'Name': 'tag:AutoScalingGroupName', 'Values': [asg_name]}]
-        )['RouteTables']:
-          update_route(route_table['RouteTableId'], healthy_instance_id, healthy_asg_name)
+# Invocations take a lease in the state table before changing routes, and the transitions already processed are dropped
+# The lease lasts as long as the function timeout, so that it does not expire during the invocation
+if os.environ.get('STATE_TABLE'):
+  coordinator = FailoverCoordinator(DynamoDbStateStore(ddb_client, os.environ['STATE_TABLE']),
+    lease_seconds=int(os.environ.get('LEASE_SECONDS', '60')))
+else:
+  coordinator = NoCoordination()
 
-        break
+# Route tables that will be served by the given ASG once the pending route changes are applied
+def route_tables_served_by(inventory, desired, asg_name):
+  route_table_ids = [route_table_id for route_table_id in inventory.route_tables_served_by(asg_name)
+    if route_table_id not in desired]
+  return route_table_ids + [route_table_id for route_table_id, (_, target_asg_name) in desired.items()
+    if target_asg_name == asg_name]
 
-    # If the NAT instance has recovered
-    else:
+# Spread the route tables across the instances of an ASG, so that each instance serves a share of them.
+# The route tables stay on their instance when it is still part of the spread
+def spread_route_tables(inventory, desired, route_table_ids, instances, asg_name):
+  assignment = balance_route_tables(current_targets(inventory, desired), route_table_ids,
+    [instance['InstanceId'] for instance in instances])
+  for route_table_id, instance_id in assignment.items():
+    desired[route_table_id] = (instance_id, asg_name)
+
+# No squid instance of an ASG answers: route its traffic to the healthy squid instances chosen by the strategy.
+# The health probe of each failed instance sets it to Unhealthy, so the ASG replaces the failed instances only
+def handle_alarm(inventory, desired, targets, asg_name):
+  # For each route table that currently routes traffic to the failed squid
+  # instances, plan an update of the default route to a healthy squid instance
+  if not targets.assign(desired, asg_name, route_tables_served_by(inventory, desired, asg_name)):
+    print('No healthy squid instance, routes of %s left unchanged' % asg_name)
 
-      # ID of the NAT instance launched by the Auto Scaling group
-      for instance in asg['Instances']:
-        if instance['HealthStatus'] == 'Healthy':
-          asg_instance_id = instance['InstanceId']
-          break
-      print('Instance launched by the ASG: %s' % asg_instance_id)
-
-      # Complete the lifecycle action if the NAT instance was just launched
-      lc_name = as_client.describe_lifecycle_hooks(
-        AutoScalingGroupName=asg_name
-      )['LifecycleHooks'][0]['LifecycleHookName']
+# A squid instance went in service after a scale out or the replacement of an instance:
+# rebalance the route tables of its ASG across the instances in service
+def handle_instance_launched(inventory, desired, event):
+  if inventory.alarms.get(event.asg_name, {}).get('StateValue') == 'ALARM':
+    print('Alarm of %s in ALARM, the routes move back when it returns to OK' % event.asg_name)
+    return
+  instances = inventory.in_service_instances(event.asg_name)
+  if event.instance_id not in [instance['InstanceId'] for instance in instances]:
+    print('Instance %s is not in service, routes of %s left unchanged' % (event.instance_id, event.asg_name))
+    return
+  route_table_ids = set(inventory.asg(event.asg_name)['RouteTableIds'])
+  route_table_ids.update(route_tables_served_by(inventory, desired, event.asg_name))
+  spread_route_tables(inventory, desired, sorted(route_table_ids), instances, event.asg_name)
+
+# A squid instance is terminating after a scale in or because it is unhealthy: move its route tables
+# to the other instances of its ASG, or to the healthy squid instances chosen by the strategy
+def handle_instance_terminating(inventory, desired, targets, event):
+  inventory.record_lifecycle_state(event.instance_id, 'Terminating:Wait')
+  route_table_ids = [route_table_id for route_table_id, instance_id in current_targets(inventory, desired).items()
+    if instance_id == event.instance_id]
+  if not route_table_ids:
+    print('No route to the terminating instance %s' % event.instance_id)
+    return
+
+  instances = []
+  if inventory.alarms.get(event.asg_name, {}).get('StateValue') != 'ALARM':
+    instances = inventory.in_service_instances(event.asg_name)
+  if instances:
+    route_table_ids = set(route_table_ids)
+    route_table_ids.update(route_tables_served_by(inventory, desired, event.asg_name))
+    spread_route_tables(inventory, desired, sorted(route_table_ids), instances, event.asg_name)
+  elif not targets.assign(desired, event.asg_name, route_table_ids):
+    print('No healthy squid instance, routes to %s left unchanged' % event.instance_id)
+
+# Let the ASG terminate the instances once their routes moved
+def complete_terminating_actions(events):
+  for event in events:
+    if dry_run:
+      print('Dry run: terminating lifecycle action of %s left pending' % event.instance_id)
+      continue
+    try:
+      as_client.complete_lifecycle_action(
+        LifecycleHookName=event.hook_name,
+        AutoScalingGroupName=event.asg_name,
+        LifecycleActionResult='CONTINUE',
+        InstanceId=event.instance_id,
+        LifecycleActionToken=event.token
+      )
+      print('Terminating lifecycle action of %s completed' % event.instance_id)
+    except ClientError as e:
+      # The heartbeat timeout of the hook lets the instance terminate
+      print('Terminating lifecycle action of %s not completed: %s' % (event.instance_id, e))
+
+# The squid instances of an ASG have recovered: route the AZ traffic back to them
+def handle_ok(inventory, desired, asg_name):
+
+  # IDs of the squid instances launched by the Auto Scaling group
+  healthy_instances = inventory.healthy_instances(asg_name)
+  if not healthy_instances:
+    print('No healthy instance in %s, routes left unchanged' % asg_name)
+    return
+  print('Instances launched by the ASG: %s' % ', '.join(instance['InstanceId'] for instance in healthy_instances))
+
+  # Complete the lifecycle action of the squid instances that were just launched
+  for instance in healthy_instances:
+    if instance['LifecycleState'] != 'Pending:Wait':
+      continue
+    for lc_name in inventory.launching_hook_names(asg_name)[:1]:
+      if dry_run:
+        print('Dry run: lifecycle action of %s left pending' % instance['InstanceId'])
+        break
       try:
         as_client.complete_lifecycle_action(
           LifecycleHookName=lc_name,
           AutoScalingGroupName=asg_name,
           LifecycleActionResult='CONTINUE',
-          InstanceId=asg_instance_id
+          InstanceId=instance['InstanceId']
         )
         print('Lifecycle action completed')
-      except:
-        pass
+      except ClientError as e:
+        # The instance completed its own lifecycle action at the end of its user data
+        print('Lifecycle action of %s not completed: %s' % (instance['InstanceId'], e))
+
+  # Plan the default route for each route table that should route
+  # traffic to these squid instances in a nominal situation
+  spread_route_tables(inventory, desired, inventory.asg(asg_name)['RouteTableIds'], healthy_instances, asg_name)
 
-      # Create or update the default route for each route table that should route 
-      # traffic to this NAT instance in a nominal situation
+# Print the time from each alarm state change to the update of the routes in Embedded Metric Format:
+# the failover time for ALARM transitions and the failback time for OK transitions
+def print_failover_metrics(transitions):
+  now = int(time.time() * 1000)
+  for transition in transitions:
+    print(json.dumps({
+      '_aws': {
+        'Timestamp': now,
+        'CloudWatchMetrics': [{
+          'Namespace': 'Squid',
+          'Dimensions': [['AutoScalingGroupName', 'Transition']],
+          'Metrics': [{'Name': 'FailoverTime', 'Unit': 'Milliseconds'}]
+        }]
+      },
+      'AutoScalingGroupName': transition.asg_name,
+      'Transition': transition.state,
+      'FailoverTime': max(0, now - transition.time)
+    }))
+
+def handler(event, context):
+  print(json.dumps(event))
+  api_calls.reset()
+
+  # Process the alarm transitions and the instance events one invocation at a time, until 10 seconds before the Lambda timeout
+  remaining_seconds = context.get_remaining_time_in_millis() / 1000 if context else 60
+  lease_owner = coordinator.acquire(deadline=time.time() + remaining_seconds - 10,
+    owner=getattr(context, 'aws_request_id', None))
+  try:
+    process_transitions(parse_transitions(event['Records']), parse_instance_events(event['Records']), lease_owner)
+  finally:
+    coordinator.release(lease_owner)
+
+def process_transitions(transitions, instance_events=(), lease_owner=None):
+  # Drop the transitions that were already processed, or that are older than the last processed transition of their ASG
+  transitions = coordinator.fresh_transitions(transitions)
+  if not transitions and not instance_events:
+    print('No new alarm transition nor instance event to process')
+    return
+
+  # Take a single snapshot of the squid ASGs, alarms and route tables for the whole batch
+  inventory = Inventory(as_client, cw_client, ec2_client, topic_arn=os.environ.get('TOPIC_ARN')).load()
+  print('Inventory: %d ASGs, %d alarms, %d route tables loaded with %d API calls' % (
+    len(inventory.asgs), len(inventory.alarms), len(inventory.route_tables), api_calls.total))
+
+  # Desired default route target (instance id, ASG name) of each route table to update
+  desired = {}
+  targets = strategy(inventory, cw_client)
+  processed = []
+
+  for transition in transitions:
+    print('ASG Name: %s, alarm state: %s' % (transition.asg_name, transition.state))
+
+    alarm = inventory.alarms.get(transition.asg_name, {})
+    if superseded(transition, alarm):
+      print('Dropped %s transition of %s: the alarm is %s since then' % (
+        transition.state, transition.asg_name, alarm['StateValue']))
+      continue
+    inventory.record_alarm_state(transition.asg_name, transition.state)
+    processed.append(transition)
+
+    # If the squid instance has failed
+    if transition.state == 'ALARM':
+      handle_alarm(inventory, desired, targets, transition.asg_name)
+
+    # If the squid instance has recovered
+    else:
+      handle_ok(inventory, desired, transition.asg_name)
+
+  # Route tables follow the capacity of the ASGs
+  terminating = []
+  for event in instance_events:
+    if event.asg_name not in inventory.asgs:
+      print('Instance %s of %s ignored: not a squid ASG' % (event.instance_id, event.asg_name))
+      continue
+    print('ASG Name: %s, instance %s: %s' % (event.asg_name, event.instance_id, event.transition))
+    if event.transition == 'TERMINATING':
+      handle_instance_terminating(inventory, desired, targets, event)
+      terminating.append(event)
+    else:
+      handle_instance_launched(inventory, desired, event)
+
+  # Only apply the route changes that are needed, concurrently, while the lease is held
+  coordinator.renew(lease_owner)
+  try:
+    applied = route_planner.apply(plan_routes(inventory.route_tables, desired))
+  except RouteApplyError as e:
+    # The transitions are not committed: the retry of the notification plans the failed changes again
+    print('Route changes applied: %s' % (', '.join(change.route_table_id for change in e.applied) or 'none'))
+    raise
+  for change in applied:
+    inventory.record_route(change.route_table_id, change.instance_id, change.asg_name)
+  # A dry run leaves the transitions to process again
+  if not dry_run:
+    coordinator.renew(lease_owner)
+    coordinator.commit(processed)
+    print_failover_metrics(processed)
+  complete_terminating_actions(terminating)
 
-      for route_table_id in as_client.describe_tags(
-        Filters=[{'Name': 'auto-scaling-group', 'Values': [asg_name]},
-                {'Name': 'key', 'Values': ['RouteTableIds']}]
-        )['Tags'][0]['Value'].split(','):
-        update_route(route_table_id, asg_instance_id, asg_name)
\ No newline at end of file
+  print('Failover completed in %.0f ms with %d API calls (%s)' % (
+    inventory.elapsed_ms, api_calls.total, api_calls.summary()))
@@ -0,0 +1,126 @@
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from botocore.exceptions import ClientError
+
+DEFAULT_ROUTE = '0.0.0.0/0'
+THROTTLING_ERRORS = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'TooManyRequestsException')
+
+# A single change to apply to a route table.
+# action is one of 'create' (no default route), 'replace' (default route with another target)
+# or 'tag' (route is already correct, only the AutoScalingGroupName tag is stale)
+RouteChange = namedtuple('RouteChange', ['route_table_id', 'action', 'instance_id', 'asg_name'])
+
+# Some route changes failed: applied lists the changes that were applied, failed the (change, exception) of the others
+class RouteApplyError(Exception):
+  def __init__(self, applied, failed):
+    self.applied = applied
+    self.failed = failed
+    super().__init__('%d of %d route change(s) failed: %s' % (len(failed), len(applied) + len(failed),
+      ', '.join('%s %s (%s)' % (change.action, change.route_table_id, error) for change, error in failed)))
+
+def default_route(route_table):
+  for route in route_table.get('Routes', []):
+    if route.get('DestinationCidrBlock') == DEFAULT_ROUTE:
+      return route
+  return None
+
+def served_by(route_table):
+  for tag in route_table.get('Tags', []):
+    if tag['Key'] == 'AutoScalingGroupName':
+      return tag['Value']
+  return None
+
+# Diff the desired default route targets against the current route tables.
+# desired maps a route table id to an (instance_id, asg_name) tuple.
+def plan_routes(route_tables, desired):
+  changes = []
+  for route_table_id, (instance_id, asg_name) in sorted(desired.items()):
+    route_table = route_tables.get(route_table_id, {})
+    route = default_route(route_table)
+    if route is None:
+      changes.append(RouteChange(route_table_id, 'create', instance_id, asg_name))
+    elif route.get('InstanceId') != instance_id or route.get('State') == 'blackhole':
+      changes.append(RouteChange(route_table_id, 'replace', instance_id, asg_name))
+    elif served_by(route_table) != asg_name:
+      changes.append(RouteChange(route_table_id, 'tag', instance_id, asg_name))
+  return changes
+
+def format_plan(changes):
+  if not changes:
+    return 'Route plan: no changes'
+  return '\n'.join(['Route plan: %d change(s)' % len(changes)] + [
+    '  %-7s %s -> %s (%s)' % (change.action, change.route_table_id, change.instance_id, change.asg_name)
+    for change in changes])
+
+
+class RoutePlanner:
+  def __init__(self, ec2_client, max_workers=8, max_attempts=5, base_delay=0.1, dry_run=False):
+    self.ec2_client = ec2_client
+    self.max_workers = max_workers
+    self.max_attempts = max_attempts
+    self.base_delay = base_delay
+    self.dry_run = dry_run
+
+  # Apply the changes concurrently and return the ones that were applied
+  # When some changes fail, the other changes are still applied and a RouteApplyError lists both
+  def apply(self, changes):
+    print(format_plan(changes))
+    if self.dry_run or not changes:
+      return []
+    applied, failed = [], []
+    with ThreadPoolExecutor(max_workers=min(self.max_workers, len(changes))) as executor:
+      futures = {executor.submit(self._apply_change, change): change for change in changes}
+      for future in as_completed(futures):
+        try:
+          applied.append(future.result())
+        except Exception as e:
+          print('Failed to update the default route of %s: %r' % (futures[future].route_table_id, e))
+          failed.append((futures[future], e))
+    # Report the changes in the order of the plan
+    applied.sort(key=changes.index)
+    if failed:
+      failed.sort(key=lambda change_error: changes.index(change_error[0]))
+      raise RouteApplyError(applied, failed)
+    return applied
+
+  def _apply_change(self, change):
+    parameters = {
+      'DestinationCidrBlock': DEFAULT_ROUTE,
+      'RouteTableId': change.route_table_id,
+      'InstanceId': change.instance_id
+    }
+    if change.action == 'replace':
+      try:
+        self._call(self.ec2_client.replace_route, **parameters)
+      except ClientError as e:
+        # The route was removed since the inventory snapshot was taken
+        if e.response['Error']['Code'] != 'InvalidRoute.NotFound':
+          raise
+        self._call(self.ec2_client.create_route, **parameters)
+    elif change.action == 'create':
+      try:
+        self._call(self.ec2_client.create_route, **parameters)
+      except ClientError as e:
+        # The route was created since the inventory snapshot was taken
+        if e.response['Error']['Code'] != 'RouteAlreadyExists':
+          raise
+        self._call(self.ec2_client.replace_route, **parameters)
+    self._call(self.ec2_client.create_tags,
+      Resources=[change.route_table_id],
+      Tags=[{'Key': 'AutoScalingGroupName', 'Value': change.asg_name}]
+    )
+    print('Updated default route of %s to %s' % (change.route_table_id, change.instance_id))
+    return change
+
+  # Retry throttled calls with exponential backoff and full jitter
+  def _call(self, operation, **parameters):
+    for attempt in range(1, self.max_attempts + 1):
+      try:
+        return operation(**parameters)
+      except ClientError as e:
+        if e.response['Error']['Code'] not in THROTTLING_ERRORS or attempt == self.max_attempts:
+          raise
+        time.sleep(random.uniform(0, self.base_delay * 2 ** attempt))
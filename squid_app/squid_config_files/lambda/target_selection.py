@@ -0,0 +1,205 @@
+import datetime
+import statistics
+from collections import Counter
+
+from route_planner import default_route
+
+# Failover target selection: pick the healthy squid instances that take over the route tables of a failed ASG.
+# A strategy is created for each invocation, and assign() is called for each failed ASG of the batch.
+
+def candidate_instances(inventory, exclude):
+  return [(instance['InstanceId'], asg_name) for asg_name in inventory.healthy_asg_names(exclude=exclude)
+    for instance in inventory.healthy_instances(asg_name)]
+
+# Number of route tables served by each instance once the pending route changes are applied
+def route_table_counts(inventory, desired):
+  counts = Counter()
+  for route_table_id, route_table in inventory.route_tables.items():
+    route = default_route(route_table)
+    if route_table_id not in desired and route and route.get('InstanceId'):
+      counts[route['InstanceId']] += 1
+  for instance_id, _ in desired.values():
+    counts[instance_id] += 1
+  return counts
+
+# Default route target of each route table once the pending route changes are applied
+def current_targets(inventory, desired):
+  targets = {}
+  for route_table_id, route_table in inventory.route_tables.items():
+    route = default_route(route_table)
+    if route and route.get('InstanceId'):
+      targets[route_table_id] = route['InstanceId']
+  targets.update({route_table_id: instance_id for route_table_id, (instance_id, _) in desired.items()})
+  return targets
+
+# Spread the route tables evenly across the instances while moving as few of them as possible:
+# a route table stays on its current instance unless that instance is gone or serves more than its share.
+# Returns the instance id of each route table
+def balance_route_tables(current, route_table_ids, instance_ids):
+  instance_ids = sorted(instance_ids)
+  share, extra = divmod(len(route_table_ids), len(instance_ids))
+  counts = dict.fromkeys(instance_ids, 0)
+  assignment = {}
+  # Keep up to share route tables on each instance, then one more on extra instances
+  for limit in (share, share + 1):
+    for route_table_id in sorted(route_table_ids):
+      instance_id = current.get(route_table_id)
+      if route_table_id in assignment or instance_id not in counts or counts[instance_id] >= limit:
+        continue
+      if limit > share:
+        if not extra:
+          break
+        extra -= 1
+      assignment[route_table_id] = instance_id
+      counts[instance_id] += 1
+  # Move the other route tables to the instances serving the fewest
+  for route_table_id in sorted(route_table_ids):
+    if route_table_id not in assignment:
+      instance_id = min(instance_ids, key=lambda instance_id: (counts[instance_id], instance_id))
+      assignment[route_table_id] = instance_id
+      counts[instance_id] += 1
+  return assignment
+
+
+# Send all the route tables to the instances of the first healthy ASG
+class FirstHealthyStrategy:
+  def __init__(self, inventory, cw_client):
+    self.inventory = inventory
+
+  def assign(self, desired, failed_asg_name, route_table_ids):
+    for asg_name in self.inventory.healthy_asg_names(exclude=failed_asg_name):
+      instance_ids = sorted(instance['InstanceId'] for instance in self.inventory.healthy_instances(asg_name))
+      if not instance_ids:
+        continue
+      for index, route_table_id in enumerate(sorted(route_table_ids)):
+        desired[route_table_id] = (instance_ids[index % len(instance_ids)], asg_name)
+      return True
+    return False
+
+
+# Spread the route tables across all the healthy instances, to the ones serving the fewest route tables first
+class SpreadStrategy:
+  def __init__(self, inventory, cw_client):
+    self.inventory = inventory
+    self.cw_client = cw_client
+
+  def loads(self, desired, candidates, failed_asg_name, route_table_ids):
+    counts = route_table_counts(self.inventory, desired)
+    return {instance_id: float(counts[instance_id]) for instance_id, _ in candidates}, 1.0, {}
+
+  def assign(self, desired, failed_asg_name, route_table_ids):
+    candidates = candidate_instances(self.inventory, exclude=failed_asg_name)
+    if not candidates:
+      return False
+    loads, route_table_load, latency_factors = self.loads(desired, candidates, failed_asg_name, route_table_ids)
+    for route_table_id in sorted(route_table_ids):
+      instance_id, asg_name = min(candidates, key=lambda candidate: (
+        (loads[candidate[0]] + route_table_load) * latency_factors.get(candidate[1], 1.0), candidate[0]))
+      desired[route_table_id] = (instance_id, asg_name)
+      loads[instance_id] += route_table_load
+    return True
+
+
+# Spread the route tables according to the recent load of the instances, measured by their network
+# throughput (NetworkOut) or by the squid request rate, and prefer the ASGs where squid answers the fastest
+# (ProbeLatency published by the health probe). Without metrics, this is the spread strategy.
+class WeightedStrategy(SpreadStrategy):
+  metric = 'network'
+  period = 300
+  # Bounds of the latency factor: an ASG twice as slow as the median gets twice the projected load
+  min_latency_factor = 0.5
+  max_latency_factor = 2.0
+
+  def __init__(self, inventory, cw_client):
+    super().__init__(inventory, cw_client)
+    self._metrics = None
+
+  def _queries(self, candidates, failed_asg_name):
+    failed_instance_ids = [instance['InstanceId'] for instance in self.inventory.asg(failed_asg_name)['Instances']]
+    asg_names = sorted({asg_name for _, asg_name in candidates} | {failed_asg_name})
+    queries = []
+    if self.metric == 'requests':
+      for asg_name in asg_names:
+        queries.append((('load', asg_name), 'Squid', 'RequestRate', 'AutoScalingGroupName', asg_name, 'Average'))
+    else:
+      for instance_id in [instance_id for instance_id, _ in candidates] + failed_instance_ids:
+        queries.append((('load', instance_id), 'AWS/EC2', 'NetworkOut', 'InstanceId', instance_id, 'Average'))
+    for asg_name in asg_names:
+      queries.append((('latency', asg_name), 'Squid', 'ProbeLatency', 'AutoScalingGroupName', asg_name, 'Average'))
+    return queries
+
+  # Average of each metric over the last period, fetched with a single GetMetricData call
+  def _fetch(self, queries):
+    end = datetime.datetime.utcnow()
+    metric_queries = [{
+      'Id': 'm%d' % index,
+      'MetricStat': {
+        'Metric': {'Namespace': namespace, 'MetricName': name, 'Dimensions': [{'Name': dimension, 'Value': value}]},
+        'Period': 60,
+        'Stat': stat
+      }
+    } for index, (_, namespace, name, dimension, value, stat) in enumerate(queries)]
+    metrics = {}
+    for start in range(0, len(metric_queries), 500):
+      response = self.cw_client.get_metric_data(MetricDataQueries=metric_queries[start:start + 500],
+        StartTime=end - datetime.timedelta(seconds=self.period), EndTime=end)
+      for result in response['MetricDataResults']:
+        if result['Values']:
+          metrics[queries[int(result['Id'][1:])][0]] = statistics.mean(result['Values'])
+    return metrics
+
+  def loads(self, desired, candidates, failed_asg_name, route_table_ids):
+    try:
+      metrics = self._fetch(self._queries(candidates, failed_asg_name))
+    except Exception as e:
+      print('Metrics not available, spreading the route tables evenly: %s' % e)
+      metrics = {}
+    if not any(key[0] == 'load' for key in metrics):
+      return super().loads(desired, candidates, failed_asg_name, route_table_ids)
+
+    # Current load of each candidate, and load brought by each route table of the failed ASG
+    if self.metric == 'requests':
+      instance_counts = Counter(asg_name for _, asg_name in candidates)
+      loads = {instance_id: metrics.get(('load', asg_name), 0.0) / instance_counts[asg_name]
+        for instance_id, asg_name in candidates}
+      failed_load = metrics.get(('load', failed_asg_name), 0.0)
+    else:
+      loads = {instance_id: metrics.get(('load', instance_id), 0.0) for instance_id, _ in candidates}
+      failed_load = sum(metrics.get(('load', instance['InstanceId']), 0.0)
+        for instance in self.inventory.asg(failed_asg_name)['Instances'])
+    route_table_load = failed_load / len(route_table_ids) if failed_load and route_table_ids else \
+      max(statistics.mean(loads.values()), 1.0)
+
+    # Include the route tables assigned earlier in this invocation
+    for instance_id, _ in desired.values():
+      if instance_id in loads:
+        loads[instance_id] += route_table_load
+
+    latencies = {key[1]: value for key, value in metrics.items() if key[0] == 'latency' and value > 0}
+    latency_factors = {}
+    if latencies:
+      median = statistics.median(latencies.values())
+      latency_factors = {asg_name: min(self.max_latency_factor, max(self.min_latency_factor, latency / median))
+        for asg_name, latency in latencies.items()}
+
+    print('Failover loads: %s, %.0f per route table, latency factors: %s' % (
+      ', '.join('%s=%.0f' % item for item in sorted(loads.items())), route_table_load,
+      ', '.join('%s=%.2f' % item for item in sorted(latency_factors.items()))))
+    return loads, route_table_load, latency_factors
+
+
+class RequestWeightedStrategy(WeightedStrategy):
+  metric = 'requests'
+
+
+TARGET_STRATEGIES = {
+  'first': FirstHealthyStrategy,
+  'spread': SpreadStrategy,
+  'weighted': WeightedStrategy,
+  'weighted-requests': RequestWeightedStrategy
+}
+
+def target_strategy(name):
+  if name not in TARGET_STRATEGIES:
+    raise ValueError('Unknown target strategy %s, use one of: %s' % (name, ', '.join(sorted(TARGET_STRATEGIES))))
+  return TARGET_STRATEGIES[name]
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# Load driver for the squid fleet.
+#
+# Opens many concurrent HTTP and HTTPS connections to allowed and denied domains and reports the
+# requests per second, the p50/p99 latency and the p50/p99 TLS handshake time of each kind of target.
+# One connection is opened per request, like most clients going through the transparent proxy.
+#
+# Three ways to reach the targets:
+#  - transparent (default): the connections go to the targets, and the route tables of the subnet send
+#    them through the squid intercept ports. Run it from a load generator in a private subnet.
+#  - --proxy host:port: the requests go through the forward port of a squid, for example a local squid
+#  - --mock-upstream: the allowed targets are replaced by a local mock HTTP/HTTPS server, to benchmark
+#    without internet access. With --proxy, the requests go through the squid to the mock server.
+#
+# The results are printed, and published as CloudWatch metrics with --publish, with the dimensions
+# given by --dimension (the squid instance type and the configuration profile under test).
+#
+# Usage: python3 squid_load_driver.py --duration 30 --connections 200 [--proxy 127.0.0.1:3128] [--mock-upstream]
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import urllib.parse
+
+METRIC_NAMESPACE = 'Squid/LoadTest'
+DEFAULT_ALLOWED = ['http://checkip.amazonaws.com/', 'https://checkip.amazonaws.com/']
+DEFAULT_DENIED = ['http://www.example.com/', 'https://www.example.com/']
+
+
+class Target:
+  def __init__(self, url, expected, connect_address=None):
+    parsed = urllib.parse.urlsplit(url)
+    self.url = url
+    self.scheme = parsed.scheme
+    self.host = parsed.hostname
+    self.port = parsed.port or (443 if self.scheme == 'https' else 80)
+    self.path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+    # allowed or denied by squid
+    self.expected = expected
+    # Address connected to instead of the target host, for the mock upstream
+    self.connect_address = connect_address or (self.host, self.port)
+
+  @property
+  def kind(self):
+    return '%s-%s' % (self.scheme, self.expected)
+
+
+class RequestResult:
+  def __init__(self, target, outcome, latency, handshake=None, status=None, error=None):
+    self.target = target
+    # allowed (the upstream answered), denied (squid refused the request) or error
+    self.outcome = outcome
+    self.latency = latency
+    self.handshake = handshake
+    self.status = status
+    self.error = error
+
+  @property
+  def success(self):
+    return self.outcome == self.target.expected
+
+
+# Buffers the response of a connection, through a plain or a TLS transport
+class ResponseProtocol(asyncio.Protocol):
+  def __init__(self, loop):
+    self.loop = loop
+    self.buffer = bytearray()
+    self.closed = False
+    self._waiter = None
+
+  def data_received(self, data):
+    self.buffer += data
+    self._wake()
+
+  def eof_received(self):
+    self.closed = True
+    self._wake()
+
+  def connection_lost(self, exc):
+    self.closed = True
+    self._wake()
+
+  def _wake(self):
+    if self._waiter and not self._waiter.done():
+      self._waiter.set_result(None)
+
+  async def _wait(self):
+    self._waiter = self.loop.create_future()
+    await self._waiter
+
+  # Return the status code and the headers of the response, and leave the body in the buffer
+  async def read_head(self):
+    while b'\r\n\r\n' not in self.buffer:
+      if self.closed:
+        raise ConnectionError('connection closed before the response headers')
+      await self._wait()
+    head, _, body = bytes(self.buffer).partition(b'\r\n\r\n')
+    self.buffer = bytearray(body)
+    status_line, _, headers = head.decode('latin-1').partition('\r\n')
+    if not status_line.startswith('HTTP/'):
+      raise ConnectionError('invalid response: %s' % status_line[:80])
+    return int(status_line.split(' ', 2)[1]), headers.lower()
+
+  async def read_until_closed(self):
+    while not self.closed:
+      await self._wait()
+
+
+def tls_context():
+  # The load test measures the handshake, not the certificate chain of the targets or of the mock upstream
+  context = ssl.create_default_context()
+  context.check_hostname = False
+  context.verify_mode = ssl.CERT_NONE
+  return context
+
+
+# Send one request on a new connection and return its RequestResult
+async def run_request(target, proxy, timeout, context):
+  loop = asyncio.get_event_loop()
+  started = loop.time()
+  handshake = None
+  transport = None
+  try:
+    address = proxy or target.connect_address
+    transport, protocol = await asyncio.wait_for(
+      loop.create_connection(lambda: ResponseProtocol(loop), *address), timeout)
+
+    if target.scheme == 'https':
+      if proxy:
+        transport.write(('CONNECT %s:%d HTTP/1.1\r\nHost: %s:%d\r\n\r\n' % (
+          target.host, target.port, target.host, target.port)).encode())
+        status, headers = await asyncio.wait_for(protocol.read_head(), timeout)
+        if status != 200:
+          return RequestResult(target, 'denied' if status == 403 else 'error', loop.time() - started, status=status)
+      handshake_started = loop.time()
+      try:
+        transport = await asyncio.wait_for(loop.start_tls(transport, protocol, context,
+          server_hostname=target.host), timeout)
+      except (ssl.SSLError, ConnectionError):
+        # Squid terminates the TLS connections to the domains that are not allowed
+        return RequestResult(target, 'denied', loop.time() - started)
+      handshake = loop.time() - handshake_started
+
+    request_target = target.url if proxy and target.scheme == 'http' else target.path
+    transport.write(('GET %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: squid-load-driver\r\nConnection: close\r\n\r\n' % (
+      request_target, target.host)).encode())
+    status, headers = await asyncio.wait_for(protocol.read_head(), timeout)
+    await asyncio.wait_for(protocol.read_until_closed(), timeout)
+    if status == 403 or 'x-squid-error:' in headers:
+      outcome = 'denied'
+    else:
+      outcome = 'allowed'
+    return RequestResult(target, outcome, loop.time() - started, handshake, status)
+  except (OSError, asyncio.TimeoutError) as e:
+    return RequestResult(target, 'error', loop.time() - started, handshake, error=repr(e))
+  finally:
+    if transport:
+      transport.close()
+
+
+# Local HTTP and HTTPS upstream answering every request with a fixed body
+class MockUpstream:
+  def __init__(self, body_size=1024, latency=0.0):
+    self.body = b'x' * body_size
+    self.latency = latency
+    self.servers = []
+    self.http_port = None
+    self.https_port = None
+    self._cert_dir = None
+
+  async def _handle(self, reader, writer):
+    try:
+      await reader.readuntil(b'\r\n\r\n')
+      if self.latency:
+        await asyncio.sleep(self.latency)
+      writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\nContent-Length: %d\r\n'
+        b'Connection: close\r\n\r\n' % len(self.body) + self.body)
+      await writer.drain()
+    except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+      pass
+    finally:
+      writer.close()
+
+  # Self-signed certificate of the HTTPS server, created with openssl
+  def _server_context(self):
+    openssl = shutil.which('openssl')
+    if not openssl:
+      print('openssl not found: the mock upstream only serves HTTP', flush=True)
+      return None
+    self._cert_dir = tempfile.mkdtemp(prefix='squid-load-mock-')
+    cert = os.path.join(self._cert_dir, 'mock.pem')
+    subprocess.run([openssl, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=mock.upstream', '-keyout', cert, '-out', cert],
+      check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert)
+    return context
+
+  async def start(self, host='127.0.0.1'):
+    server = await asyncio.start_server(self._handle, host, 0, backlog=4096)
+    self.servers.append(server)
+    self.http_port = server.sockets[0].getsockname()[1]
+    context = self._server_context()
+    if context:
+      server = await asyncio.start_server(self._handle, host, 0, ssl=context, backlog=4096)
+      self.servers.append(server)
+      self.https_port = server.sockets[0].getsockname()[1]
+
+  def targets(self, host='127.0.0.1'):
+    targets = [Target('http://%s:%d/' % (host, self.http_port), 'allowed')]
+    if self.https_port:
+      targets.append(Target('https://%s:%d/' % (host, self.https_port), 'allowed'))
+    return targets
+
+  def stop(self):
+    for server in self.servers:
+      server.close()
+    if self._cert_dir:
+      shutil.rmtree(self._cert_dir, ignore_errors=True)
+
+
+class LoadTest:
+  def __init__(self, targets, connections=100, duration=30.0, requests=None, proxy=None, timeout=10.0):
+    self.targets = targets
+    self.connections = connections
+    self.duration = duration
+    self.requests = requests
+    self.proxy = proxy
+    self.timeout = timeout
+    self.results = []
+    self.elapsed = None
+    self._started = 0
+
+  async def _worker(self, index, deadline, context):
+    count = index
+    loop = asyncio.get_event_loop()
+    while loop.time() < deadline and (self.requests is None or self._started < self.requests):
+      # Every connection cycles through the targets, so that each kind of target gets the same load
+      target = self.targets[count % len(self.targets)]
+      self._started += 1
+      self.results.append(await run_request(target, self.proxy, self.timeout, context))
+      count += 1
+
+  async def run(self):
+    loop = asyncio.get_event_loop()
+    context = tls_context()
+    started = loop.time()
+    deadline = started + self.duration if self.requests is None else float('inf')
+    await asyncio.gather(*[self._worker(index, deadline, context) for index in range(self.connections)])
+    self.elapsed = loop.time() - started
+    return self.results
+
+
+def percentile(values, share):
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+# Statistics of the results of each kind of target: http-allowed, https-denied...
+def summarize(results, elapsed):
+  summary = {}
+  for kind in sorted({result.target.kind for result in results}):
+    kind_results = [result for result in results if result.target.kind == kind]
+    latencies = [result.latency * 1000 for result in kind_results if result.success]
+    handshakes = [result.handshake * 1000 for result in kind_results if result.success and result.handshake is not None]
+    summary[kind] = {
+      'requests': len(kind_results),
+      'errors': sum(1 for result in kind_results if not result.success),
+      'requests_per_second': len(kind_results) / elapsed,
+      'latency_p50_ms': percentile(latencies, 0.5),
+      'latency_p99_ms': percentile(latencies, 0.99),
+      'tls_handshake_p50_ms': percentile(handshakes, 0.5),
+      'tls_handshake_p99_ms': percentile(handshakes, 0.99)
+    }
+  return summary
+
+def format_summary(summary, elapsed):
+  lines = []
+  total = sum(stats['requests'] for stats in summary.values())
+  lines.append('%d requests in %.1f s: %.0f requests/s' % (total, elapsed, total / elapsed))
+  for kind, stats in summary.items():
+    line = '  %-15s %7d requests %6d errors %8.0f req/s' % (kind, stats['requests'], stats['errors'],
+      stats['requests_per_second'])
+    if stats['latency_p50_ms'] is not None:
+      line += '  latency p50 %.1f ms p99 %.1f ms' % (stats['latency_p50_ms'], stats['latency_p99_ms'])
+    if stats['tls_handshake_p50_ms'] is not None:
+      line += '  TLS handshake p50 %.1f ms p99 %.1f ms' % (stats['tls_handshake_p50_ms'], stats['tls_handshake_p99_ms'])
+    lines.append(line)
+  return '\n'.join(lines)
+
+
+# Publish the statistics of each kind of target, with the dimensions of the test
+def publish(summary, dimensions, region=None):
+  import boto3
+
+  cw_client = boto3.client('cloudwatch', region_name=region)
+  metric_data = []
+  for kind, stats in summary.items():
+    kind_dimensions = [{'Name': name, 'Value': value} for name, value in sorted(dimensions.items())] + \
+      [{'Name': 'Target', 'Value': kind}]
+    for name, key, unit in (
+        ('RequestRate', 'requests_per_second', 'Count/Second'),
+        ('Errors', 'errors', 'Count'),
+        ('LatencyP50', 'latency_p50_ms', 'Milliseconds'),
+        ('LatencyP99', 'latency_p99_ms', 'Milliseconds'),
+        ('TlsHandshakeP50', 'tls_handshake_p50_ms', 'Milliseconds'),
+        ('TlsHandshakeP99', 'tls_handshake_p99_ms', 'Milliseconds')):
+      if stats[key] is not None:
+        metric_data.append({'MetricName': name, 'Dimensions': kind_dimensions, 'Value': stats[key], 'Unit': unit})
+  for start in range(0, len(metric_data), 1000):
+    cw_client.put_metric_data(Namespace=METRIC_NAMESPACE, MetricData=metric_data[start:start + 1000])
+
+
+def parse_address(value):
+  host, _, port = value.rpartition(':')
+  return host, int(port)
+
+def parse_dimension(value):
+  name, separator, dimension_value = value.partition('=')
+  if not separator:
+    raise argparse.ArgumentTypeError('dimension must be Name=Value: %s' % value)
+  return name, dimension_value
+
+async def main_async(args):
+  mock = None
+  targets = [Target(url, 'allowed') for url in args.allowed] + [Target(url, 'denied') for url in args.denied]
+  if args.mock_upstream:
+    mock = MockUpstream(body_size=args.mock_body_size, latency=args.mock_latency / 1000)
+    await mock.start()
+    # Without squid in front of the mock upstream, nothing denies the denied targets
+    targets = mock.targets() + ([target for target in targets if target.expected == 'denied'] if args.proxy else [])
+  try:
+    load_test = LoadTest(targets, connections=args.connections, duration=args.duration, requests=args.requests,
+      proxy=args.proxy, timeout=args.timeout)
+    results = await load_test.run()
+  finally:
+    if mock:
+      mock.stop()
+  return results, load_test.elapsed
+
+def main():
+  parser = argparse.ArgumentParser(description='Load driver for the squid fleet')
+  parser.add_argument('--allowed', nargs='+', default=DEFAULT_ALLOWED, help='URLs of allowed domains')
+  parser.add_argument('--denied', nargs='+', default=DEFAULT_DENIED, help='URLs of denied domains')
+  parser.add_argument('--connections', type=int, default=100, help='concurrent connections')
+  parser.add_argument('--duration', type=float, default=30.0, help='seconds of load')
+  parser.add_argument('--requests', type=int, help='stop after this number of requests instead of --duration')
+  parser.add_argument('--timeout', type=float, default=10.0, help='seconds before a request fails')
+  parser.add_argument('--proxy', type=parse_address, help='host:port of a squid forward port')
+  parser.add_argument('--mock-upstream', action='store_true', help='replace the allowed targets by a local mock server')
+  parser.add_argument('--mock-body-size', type=int, default=1024, help='bytes of each mock response')
+  parser.add_argument('--mock-latency', type=float, default=0.0, help='milliseconds before each mock response')
+  parser.add_argument('--dimension', type=parse_dimension, action='append', default=[],
+    help='Name=Value dimension of the published metrics, such as InstanceType=c5.large')
+  parser.add_argument('--publish', action='store_true', help='publish the results as CloudWatch metrics')
+  parser.add_argument('--region', help='region of the CloudWatch metrics')
+  parser.add_argument('--json', action='store_true', help='print the results as JSON')
+  args = parser.parse_args()
+
+  results, elapsed = asyncio.get_event_loop().run_until_complete(main_async(args))
+  summary = summarize(results, elapsed)
+  dimensions = dict(args.dimension)
+  if args.json:
+    print(json.dumps({'dimensions': dimensions, 'elapsed': elapsed, 'targets': summary}, indent=2))
+  else:
+    if dimensions:
+      print(', '.join('%s=%s' % item for item in sorted(dimensions.items())))
+    print(format_summary(summary, elapsed))
+    errors = [result for result in results if not result.success and result.error]
+    for error in sorted({result.error for result in errors})[:5]:
+      print('  error: %s' % error)
+  if args.publish:
+    publish(summary, dimensions, args.region)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,64 @@
+# Install Squid, the CloudWatch Agent and the health probe runtime
+# This script runs from the user data of each instance, or once when the Squid image is built
+
+# Apply the latest security patches
+yum update -y --security
+
+# Install Squid
+yum install -y squid
+
+# Install and configure the CloudWatch Agent
+region=`curl -s http://169.254.169.254/latest/meta-data/placement/region`
+rpm -Uvh https://amazoncloudwatch-agent-$region.s3.$region.amazonaws.com/amazon_linux/amd64/latest/amazon-cloudwatch-agent.rpm
+cat > /opt/aws/amazon-cloudwatch-agent/etc/amazon-cloudwatch-agent.json << 'EOF'
+{
+  "agent": {
+    "metrics_collection_interval": 10,
+    "omit_hostname": true
+  },
+  "metrics": {
+    "metrics_collected": {
+      "procstat": [
+        {
+          "pid_file": "/var/run/squid.pid",
+          "measurement": [
+            "cpu_usage"
+          ]
+        }
+      ]
+    },
+    "append_dimensions": {
+      "AutoScalingGroupName": "${aws:AutoScalingGroupName}"
+    },
+    "force_flush_interval": 5
+  },
+  "logs": {
+    "logs_collected": {
+      "files": {
+        "collect_list": [
+          {
+            "file_path": "/var/log/squid/access.log*",
+            "log_group_name": "/filtering-squid-instance/squid-access.log",
+            "log_stream_name": "{instance_id}",
+            "timezone": "Local"
+          },
+          {
+            "file_path": "/var/log/squid/cache.log*",
+            "log_group_name": "/filtering-squid-instance/cache.log",
+            "log_stream_name": "{instance_id}",
+            "timezone": "Local"
+          }
+        ]
+      }
+
+    }
+  }
+}
+EOF
+
+# Install the runtime of the Squid health probe
+yum install -y python3
+pip3 install boto3
+
+# Update the CloudFormation helper scripts
+yum update -y aws-cfn-bootstrap
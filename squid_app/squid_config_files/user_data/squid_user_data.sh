@@ -2,95 +2,256 @@
 # Redirect the user-data output to the console logs
 exec > >(tee /var/log/user-data.log|logger -t user-data -s 2>/dev/console) 2>&1
 
-# Apply the latest security patches
-yum update -y --security
-
 # Disable source / destination check. It cannot be disabled from the launch configuration
 instanceid=`curl -s http://169.254.169.254/latest/meta-data/instance-id`
 aws ec2 modify-instance-attribute --no-source-dest-check --instance-id $instanceid --region ${AWS::Region}
 
-# Install and start Squid
-yum install -y squid
+${__INSTALL__}
+
+# Tune the kernel (conntrack table, TCP backlog, ephemeral ports) and the file descriptor limit of Squid for the instance type
+${__KERNEL_TUNING__}
+
+# Apply the kernel settings and redirect the intercepted traffic to Squid
+# The script runs again on each boot of an instance restarted from the warm pool
+cat > /usr/local/bin/squid-network-setup.sh << 'EOF'
+#!/bin/bash -x
+${__NETWORK_SETUP__}
+EOF
+chmod +x /usr/local/bin/squid-network-setup.sh
+/usr/local/bin/squid-network-setup.sh
+
+# Mount the volume of the response cache, when caching is enabled
+# The script also runs again on each boot of an instance restarted from the warm pool, an instance store volume is blank then
+cat > /usr/local/bin/squid-cache-setup.sh << 'EOF'
+#!/bin/bash -x
+${__CACHE_VOLUME_SETUP__}
+EOF
+chmod +x /usr/local/bin/squid-cache-setup.sh
+/usr/local/bin/squid-cache-setup.sh
+
+# Start Squid
 systemctl start squid || service squid start
-iptables -t nat -A PREROUTING -p tcp --dport 80 -j REDIRECT --to-port 3129
-iptables -t nat -A PREROUTING -p tcp --dport 443 -j REDIRECT --to-port 3130
 
-# Create a SSL certificate for the SslBump Squid module
-mkdir /etc/squid/ssl
+# Load the SSL Bump CA shared by the Squid instances from Secrets Manager
+# The first instance that finds no CA version creates it. If another instance created it in the meantime, the put fails and the CA is loaded
+mkdir -p /etc/squid/ssl
 cd /etc/squid/ssl
-openssl genrsa -out squid.key 4096
-openssl req -new -key squid.key -out squid.csr -subj "/C=XX/ST=XX/L=squid/O=squid/CN=squid"
-openssl x509 -req -days 3650 -in squid.csr -signkey squid.key -out squid.crt
-cat squid.key squid.crt >> squid.pem
+if ! aws secretsmanager get-secret-value --secret-id ${__CA_SECRET__} --version-id ${__CA_VERSION__} --query SecretString --output text --region ${AWS::Region} > squid.pem; then
+  ${__CA_KEY_COMMAND__}
+  openssl req -new -x509 -days 3650 -key squid.key -out squid.crt -subj "/C=XX/ST=XX/L=squid/O=squid/CN=squid"
+  cat squid.key squid.crt > squid.pem
+  rm -f squid.key squid.crt
+  aws secretsmanager put-secret-value --secret-id ${__CA_SECRET__} --client-request-token ${__CA_VERSION__} --secret-string file://squid.pem --region ${AWS::Region} || \
+    aws secretsmanager get-secret-value --secret-id ${__CA_SECRET__} --version-id ${__CA_VERSION__} --query SecretString --output text --region ${AWS::Region} > squid.pem
+fi
+chown root:squid squid.pem
+chmod 640 squid.pem
+
+# Initialize the database of the certificates generated by Squid
+# The certificate generator is named ssl_crtd up to Squid 3.5 and security_file_certgen from Squid 4
+mkdir -p /usr/local/libexec
+ln -sf `ls /usr/lib64/squid/security_file_certgen /usr/lib64/squid/ssl_crtd 2>/dev/null | head -1` /usr/local/libexec/squid-certgen
+rm -rf /var/lib/squid/ssl_db
+/usr/local/libexec/squid-certgen -c -s /var/lib/squid/ssl_db -M ${__CERT_CACHE_MB__}MB
+chown -R squid:squid /var/lib/squid/ssl_db
 
 # Refresh the Squid configuration files from S3
-mkdir /etc/squid/old
+# The script is run by SSM Run Command when a configuration release is promoted or tested on the instance,
+# and reconfigures Squid only when the content changed
+# It downloads the object versions of the release of the instance: the canary instance runs the release under test
+aws s3 cp ${__CONFIG_RELEASE_S3_URL__} /usr/local/bin/squid_config_release.py
+mkdir -p /etc/squid/old /var/lib/squid-config/staging
 cat > /etc/squid/squid-conf-refresh.sh << 'EOF'
-cp /etc/squid/* /etc/squid/old/
-aws s3 sync s3://"${__S3BUCKET__}" /etc/squid
-/usr/sbin/squid -k parse && /usr/sbin/squid -k reconfigure || (cp /etc/squid/old/* /etc/squid/; exit 1)
+#!/bin/bash
+exec 9> /var/lock/squid-conf-refresh.lock
+flock 9
+staging=/var/lib/squid-config/staging
+instanceid=`curl -s http://169.254.169.254/latest/meta-data/instance-id`
+release_id=`python3 /usr/local/bin/squid_config_release.py fetch --bucket "${__S3BUCKET__}" --release-parameter ${__RELEASE_PARAMETER__} --canary-parameter ${__CANARY_PARAMETER__} --instance-id $instanceid --region ${AWS::Region} --directory $staging` || exit 1
+config_hash=`cd $staging && find . -type f | sort | xargs sha256sum | sha256sum | cut -d ' ' -f 1`
+if [ "$config_hash" == "`cat /var/lib/squid-config/current.sha256 2>/dev/null`" ]; then
+  echo "Squid configuration unchanged, release $release_id"
+  exit 0
+fi
+rsync -a --delete --exclude old/ /etc/squid/ /etc/squid/old/
+rsync -a $staging/ /etc/squid/
+rsync -a --delete $staging/conf.d/ /etc/squid/conf.d/
+# A stopped Squid loads the new configuration when it starts
+if /usr/sbin/squid -k parse && { ! systemctl -q is-active squid || /usr/sbin/squid -k reconfigure; }; then
+  echo $config_hash > /var/lib/squid-config/current.sha256
+  echo "Squid reconfigured with configuration $config_hash, release $release_id"
+else
+  rsync -a --exclude old/ /etc/squid/old/ /etc/squid/
+  echo "Release $release_id does not parse, configuration restored"
+  exit 1
+fi
 EOF
 chmod +x /etc/squid/squid-conf-refresh.sh
 /etc/squid/squid-conf-refresh.sh
+# The number of workers only changes when Squid restarts
+systemctl restart squid
 
 # Schedule tasks
+# The configuration refresh only runs as a safety net in case a push from S3 is missed
 cat > ~/mycron << 'EOF'
-* * * * * /etc/squid/squid-conf-refresh.sh
+*/15 * * * * /etc/squid/squid-conf-refresh.sh
 0 0 * * * sleep $(($RANDOM % 3600)); yum -y update --security
 0 0 * * * /usr/sbin/squid -k rotate
 EOF
 crontab ~/mycron
 rm ~/mycron
 
-# Install and configure the CloudWatch Agent
-rpm -Uvh https://amazoncloudwatch-agent-${AWS::Region}.s3.${AWS::Region}.amazonaws.com/amazon_linux/amd64/latest/amazon-cloudwatch-agent.rpm
-cat > /opt/aws/amazon-cloudwatch-agent/etc/amazon-cloudwatch-agent.json << 'EOF'
-{
-  "agent": {
-    "metrics_collection_interval": 10,
-    "omit_hostname": true
-  },
-  "metrics": {
-    "metrics_collected": {
-      "procstat": [
-        {
-          "pid_file": "/var/run/squid.pid",
-          "measurement": [
-            "cpu_usage"
-          ]
-        }
-      ]
-    },
-    "append_dimensions": {
-      "AutoScalingGroupName": "${__CW_ASG__}"
-    },
-    "force_flush_interval": 5
-  },
-  "logs": {
-    "logs_collected": {
-      "files": {
-        "collect_list": [
-          {
-            "file_path": "/var/log/squid/access.log*",
-            "log_group_name": "/filtering-squid-instance/access.log",
-            "log_stream_name": "{instance_id}",
-            "timezone": "Local"
-          },
-          {
-            "file_path": "/var/log/squid/cache.log*",
-            "log_group_name": "/filtering-squid-instance/cache.log",
-            "log_stream_name": "{instance_id}",
-            "timezone": "Local"
-          }
-        ]
-      }
-
-    }
-  }
-}
+# With the s3 access log pipeline, the log shipper batches and compresses the access log to S3, and publishes
+# the access log metrics. Only the denied requests, the errors and a sample of the other requests are written
+# to access-sampled.log, which the CloudWatch Agent ships instead of the access log
+if [ "${__ACCESS_LOG_PIPELINE__}" == s3 ]; then
+  aws s3 cp ${__LOG_SHIPPER_S3_URL__} /tmp/squid-log-shipper.zip
+  mkdir -p /usr/local/lib/squid-log-shipper
+  unzip -o /tmp/squid-log-shipper.zip -d /usr/local/lib/squid-log-shipper
+  rm -f /tmp/squid-log-shipper.zip
+  cat > /etc/systemd/system/squid-log-shipper.service << 'EOF'
+[Unit]
+Description=Ship the Squid access log to S3
+After=squid.service
+
+[Service]
+ExecStart=/usr/bin/python3 /usr/local/lib/squid-log-shipper/squid_log_shipper.py --bucket ${__ACCESS_LOG_BUCKET__} --sample-rate ${__ACCESS_LOG_SAMPLE_RATE__} --max-domains ${__ACCESS_LOG_MAX_DOMAINS__}
+Restart=always
+RestartSec=5
+Nice=10
+
+[Install]
+WantedBy=multi-user.target
 EOF
+  systemctl daemon-reload
+  systemctl enable squid-log-shipper
+  systemctl start squid-log-shipper
+  sed -i 's|/var/log/squid/access.log\*|/var/log/squid/access-sampled.log*|' /opt/aws/amazon-cloudwatch-agent/etc/amazon-cloudwatch-agent.json
+fi
+
+# Ship the access log to the log group of the stack, also with the images built before it was renamed
+sed -i 's|"/filtering-squid-instance/access.log"|"/filtering-squid-instance/squid-access.log"|' /opt/aws/amazon-cloudwatch-agent/etc/amazon-cloudwatch-agent.json
+
+# Start the CloudWatch Agent
 /opt/aws/amazon-cloudwatch-agent/bin/amazon-cloudwatch-agent-ctl -a fetch-config -m ec2 -c file:/opt/aws/amazon-cloudwatch-agent/etc/amazon-cloudwatch-agent.json -s
 
-# CloudFormation signal
-yum update -y aws-cfn-bootstrap
-/opt/aws/bin/cfn-signal -e $? --stack ${AWS::StackName} --resource "${__ASG__}" --region ${AWS::Region}
\ No newline at end of file
+# Install the squid health probe, it is started once the instance goes in service
+aws s3 cp ${__HEALTH_PROBE_S3_URL__} /usr/local/bin/squid_health_probe.py
+cat > /etc/systemd/system/squid-health-probe.service << 'EOF'
+[Unit]
+Description=Squid data-plane health probe
+After=squid.service
+
+[Service]
+ExecStart=/usr/bin/python3 /usr/local/bin/squid_health_probe.py --probe-url ${__HEALTH_PROBE_URL__} ${__HEALTH_PROBE_OPTIONS__}
+Restart=always
+RestartSec=1
+EOF
+
+# Put the instance in service, on this boot and on the next ones
+# With a warm pool, this boot only prepares the instance in the pool: it is put in service later,
+# by the boot of the stopped instance or, in a running pool, as soon as the ASG moves it in service
+mkdir -p /var/lib/squid-instance
+cat /proc/sys/kernel/random/boot_id > /var/lib/squid-instance/bootstrap-boot-id
+cat > /usr/local/bin/squid-instance-ready.sh << 'EOF'
+#!/bin/bash -x
+instanceid=`curl -s http://169.254.169.254/latest/meta-data/instance-id`
+asg_name=`aws autoscaling describe-auto-scaling-instances --instance-ids $instanceid --region ${AWS::Region} --query 'AutoScalingInstances[0].AutoScalingGroupName' --output text`
+start_type=cold
+
+# Seconds since boot, and since a given time after boot
+uptime_seconds() {
+  cut -d ' ' -f 1 /proc/uptime
+}
+seconds_since() {
+  awk -v now=`uptime_seconds` -v start=$1 'BEGIN { print now - start }'
+}
+
+# Target lifecycle state of the instance: InService, or Warmed:Stopped / Warmed:Running in the warm pool
+target_state() {
+  for attempt in `seq 30`; do
+    curl -sf http://169.254.169.254/latest/meta-data/autoscaling/target-lifecycle-state && return
+    sleep 1
+  done
+  echo InService
+}
+
+# Time spent in each launch phase, by start type: cold (first boot) or warm (instance from the warm pool)
+phase_metric() {
+  echo "Launch phase $1 ($start_type start): $2 seconds"
+  aws cloudwatch put-metric-data --namespace Squid --metric-name LaunchPhaseTime --unit Seconds --value $2 --dimensions AutoScalingGroupName=$asg_name,Phase=$1,StartType=$start_type --region ${AWS::Region} || true
+}
+
+# Complete the launch lifecycle action: instances added by a scale out don't get an alarm state change
+complete_lifecycle_action() {
+  for hook in `aws autoscaling describe-lifecycle-hooks --auto-scaling-group-name $asg_name --region ${AWS::Region} --query "LifecycleHooks[?LifecycleTransition=='autoscaling:EC2_INSTANCE_LAUNCHING'].LifecycleHookName" --output text`; do
+    aws autoscaling complete-lifecycle-action --lifecycle-action-result CONTINUE --lifecycle-hook-name $hook --auto-scaling-group-name $asg_name --instance-id $instanceid --region ${AWS::Region} || true
+  done
+}
+
+if [[ `target_state` == Warmed:* ]]; then
+  # The instance is pre-initialized in the warm pool: it must not publish health metrics for the ASG
+  systemctl stop squid-health-probe
+  complete_lifecycle_action
+  phase_metric WarmPoolReady `uptime_seconds`
+  # A stopped pool stops the instance now, a running pool keeps it up until it goes in service
+  while [[ `target_state` == Warmed:* ]]; do
+    sleep 1
+  done
+  start_type=warm
+  phase_started=`uptime_seconds`
+else
+  phase_started=0
+fi
+
+if [ "`cat /proc/sys/kernel/random/boot_id`" != "`cat /var/lib/squid-instance/bootstrap-boot-id`" ]; then
+  # Boot of an instance restarted from the warm pool
+  start_type=warm
+  phase_metric Boot `uptime_seconds`
+  /usr/local/bin/squid-network-setup.sh
+  /usr/local/bin/squid-cache-setup.sh
+fi
+
+# Load the configuration changed while the instance was in the warm pool and wait for Squid to accept connections
+/etc/squid/squid-conf-refresh.sh
+systemctl start squid
+for attempt in `seq 300`; do
+  (exec 3<> /dev/tcp/127.0.0.1/3128) 2> /dev/null && break
+  sleep 0.2
+done
+phase_metric SquidStart `seconds_since $phase_started`
+
+systemctl start squid-health-probe
+complete_lifecycle_action
+phase_metric InService `seconds_since $phase_started`
+
+if [ $start_type == cold ]; then
+  # Measure the time from boot to signal, to compare the stock and the pre-built Squid images
+  bootstrap_seconds=`uptime_seconds`
+  echo "Squid instance ready $bootstrap_seconds seconds after boot (${__IMAGE_TYPE__} image)"
+  aws cloudwatch put-metric-data --namespace Squid --metric-name BootstrapTime --unit Seconds --value $bootstrap_seconds --dimensions AutoScalingGroupName=$asg_name,ImageType=${__IMAGE_TYPE__} --region ${AWS::Region} || true
+
+  # CloudFormation signal, to the ASG resource of the instance: the user data is shared by the ASGs of all the AZs
+  asg_logical_id=`aws autoscaling describe-auto-scaling-groups --auto-scaling-group-names $asg_name --region ${AWS::Region} --query "AutoScalingGroups[0].Tags[?Key=='aws:cloudformation:logical-id'].Value" --output text`
+  /opt/aws/bin/cfn-signal -e 0 --stack ${AWS::StackName} --resource "$asg_logical_id" --region ${AWS::Region} || true
+fi
+EOF
+chmod +x /usr/local/bin/squid-instance-ready.sh
+
+cat > /etc/systemd/system/squid-instance-ready.service << 'EOF'
+[Unit]
+Description=Put the Squid instance in service
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+Type=oneshot
+ExecStart=/usr/local/bin/squid-instance-ready.sh
+TimeoutStartSec=infinity
+
+[Install]
+WantedBy=multi-user.target
+EOF
+systemctl daemon-reload
+systemctl enable squid-instance-ready
+systemctl start --no-block squid-instance-ready
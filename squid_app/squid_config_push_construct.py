@@ -0,0 +1,172 @@
+from aws_cdk import (
+    core,
+    aws_iam as iam,
+    aws_lambda as _lambda,
+    aws_s3 as s3,
+    aws_s3_notifications as s3_notifications,
+    aws_ssm as ssm,
+    aws_stepfunctions as sfn,
+    aws_stepfunctions_tasks as tasks
+)
+
+
+class SquidConfigPushConstruct(core.Construct):
+    def __init__(self, scope: core.Construct, id: str, config_bucket: s3.Bucket, squid_asgs: list,
+        release_parameter: ssm.StringParameter, canary_parameter: ssm.StringParameter,
+        canary_minutes: int = 10) -> None:
+        super().__init__(scope, id)
+
+        stack = core.Stack.of(self)
+
+        # Create IAM role for the rollout Lambda
+        rollout_iam_role = iam.Role(self,"rollout-role",
+          assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+          managed_policies=[iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaBasicExecutionRole")]
+        )
+
+        # Allow Lambda to run the configuration refresh script on the squid instances
+        rollout_iam_role.add_to_policy(statement= iam.PolicyStatement(effect=iam.Effect.ALLOW,
+            actions=['ssm:SendCommand',],
+            resources=[stack.format_arn(service="ssm", resource="document", account="", resource_name="AWS-RunShellScript"),
+                stack.format_arn(service="ec2", resource="instance", resource_name="*")]
+            )
+        )
+
+        # Allow Lambda to pick the canary instance, follow its refresh command, compare its access log metrics
+        # with the other instances and find the rollouts in progress
+        # The state machine is not referenced: it depends on the function
+        rollout_iam_role.add_to_policy(statement= iam.PolicyStatement(effect=iam.Effect.ALLOW,
+            actions=['autoscaling:DescribeAutoScalingGroups',
+                'cloudwatch:GetMetricData',
+                'ssm:GetCommandInvocation',],
+            resources=['*']
+            )
+        )
+        rollout_iam_role.add_to_policy(statement= iam.PolicyStatement(effect=iam.Effect.ALLOW,
+            actions=['states:ListExecutions',],
+            resources=[stack.format_arn(service="states", resource="stateMachine", sep=":", resource_name="*")]
+            )
+        )
+
+        # Allow Lambda to list the object versions of the releases, and to restore the versions of the promoted release
+        # when a release is rolled back. It can't delete object versions: the failed releases stay in the bucket history
+        config_bucket.grant_read(rollout_iam_role)
+        rollout_iam_role.add_to_policy(statement= iam.PolicyStatement(effect=iam.Effect.ALLOW,
+            actions=['s3:ListBucketVersions',],
+            resources=[config_bucket.bucket_arn]
+            )
+        )
+        rollout_iam_role.add_to_policy(statement= iam.PolicyStatement(effect=iam.Effect.ALLOW,
+            actions=['s3:PutObject',
+                's3:DeleteObject',],
+            resources=[config_bucket.arn_for_objects("*")]
+            )
+        )
+        for parameter in (release_parameter, canary_parameter):
+            parameter.grant_read(rollout_iam_role)
+            parameter.grant_write(rollout_iam_role)
+
+        # Create a Lambda function that runs the steps of the configuration rollout
+        self.config_rollout_function = _lambda.Function(self, "config-rollout-function",
+                                    runtime=_lambda.Runtime.PYTHON_3_8,
+                                    handler="config-rollout-handler.handler",
+                                    code=_lambda.Code.asset("./squid_app/squid_config_files/config_push"),
+                                    role=rollout_iam_role,
+                                    timeout=core.Duration.seconds(60),
+                                    environment={
+                                        "ASG_NAMES": core.Fn.join(",", [asg.auto_scaling_group_name for asg in squid_asgs]),
+                                        "CONFIG_BUCKET": config_bucket.bucket_name,
+                                        # Release run by all the instances, and release under test on the canary instance
+                                        "RELEASE_PARAMETER": release_parameter.parameter_name,
+                                        "CANARY_PARAMETER": canary_parameter.parameter_name,
+                                        # Minutes during which the canary instance is compared with the other instances
+                                        "CANARY_MINUTES": str(canary_minutes),
+                                        # Thresholds of the comparison, above which the release is rolled back
+                                        "MIN_REQUESTS": "100",
+                                        "MAX_LATENCY_INCREASE": "25",
+                                        "LATENCY_MARGIN_MS": "20",
+                                        "MAX_ERROR_RATE_INCREASE": "1"
+                                    }
+                                )
+
+        # Rollout of a configuration change:
+        #  1. Wait for the other files of the change, only the latest rollout goes on and one rollout runs at a time
+        #  2. Load the release on a canary instance, the release is rolled back if the configuration does not parse
+        #  3. Compare the latency and the error rate of the canary instance with the baseline for canary_minutes
+        #  4. Promote the release to all the instances, or roll it back
+        def rollout_step(action):
+            return tasks.LambdaInvoke(self, action.replace("_", "-"),
+                lambda_function=self.config_rollout_function,
+                payload=sfn.TaskInput.from_object({
+                    "action": action,
+                    "rollout.$": "$",
+                    "execution.$": "$$.Execution.Id",
+                    "state_machine.$": "$$.StateMachine.Id"
+                }),
+                payload_response_only=True
+            )
+
+        prepare = rollout_step("prepare")
+        start_canary = rollout_step("start_canary")
+        check_canary = rollout_step("check_canary")
+        evaluate = rollout_step("evaluate")
+        promote = rollout_step("promote")
+        rollback = rollout_step("rollback")
+
+        done = sfn.Succeed(self, "done")
+        promote.next(done)
+        rollback.next(sfn.Fail(self, "rolled-back", error="ConfigRolledBack",
+            cause="The configuration release was rolled back"))
+
+        wait_for_rollouts = sfn.Wait(self, "wait-for-rollouts", time=sfn.WaitTime.duration(core.Duration.seconds(30)))
+        wait_for_rollouts.next(prepare)
+        wait_for_canary = sfn.Wait(self, "wait-for-canary", time=sfn.WaitTime.duration(core.Duration.seconds(10)))
+        wait_for_canary.next(check_canary)
+        wait_for_window = sfn.Wait(self, "wait-for-window", time=sfn.WaitTime.seconds_path("$.wait_seconds"))
+        wait_for_window.next(evaluate)
+
+        start_canary.next(sfn.Choice(self, "canary-started")
+            .when(sfn.Condition.string_equals("$.status", "promote"), promote)
+            .otherwise(wait_for_canary))
+        check_canary.next(sfn.Choice(self, "canary-checked")
+            .when(sfn.Condition.string_equals("$.status", "pending"), wait_for_canary)
+            .when(sfn.Condition.string_equals("$.status", "applied"), wait_for_window)
+            .otherwise(rollback))
+        evaluate.next(sfn.Choice(self, "canary-evaluated")
+            .when(sfn.Condition.string_equals("$.status", "promote"), promote)
+            .otherwise(rollback))
+        prepare.next(sfn.Choice(self, "prepared")
+            .when(sfn.Condition.string_equals("$.status", "busy"), wait_for_rollouts)
+            .when(sfn.Condition.string_equals("$.status", "canary"), start_canary)
+            .when(sfn.Condition.string_equals("$.status", "promote"), promote)
+            .otherwise(done))
+
+        self.config_rollout_state_machine = sfn.StateMachine(self, "config-rollout",
+            definition=sfn.Wait(self, "wait-for-change", time=sfn.WaitTime.duration(core.Duration.seconds(15)))
+                .next(prepare),
+            timeout=core.Duration.minutes(canary_minutes + 60)
+        )
+
+        # Create IAM role for the push Lambda
+        lambda_iam_role = iam.Role(self,"lambda-role",
+          assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+          managed_policies=[iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaBasicExecutionRole")]
+        )
+        self.config_rollout_state_machine.grant_start_execution(lambda_iam_role)
+
+        # Create a Lambda function that starts a rollout when the configuration changes in S3
+        self.config_push_function = _lambda.Function(self, "config-push-function",
+                                    runtime=_lambda.Runtime.PYTHON_3_8,
+                                    handler="config-push-handler.handler",
+                                    code=_lambda.Code.asset("./squid_app/squid_config_files/config_push"),
+                                    role=lambda_iam_role,
+                                    timeout=core.Duration.seconds(30),
+                                    environment={
+                                        "STATE_MACHINE_ARN": self.config_rollout_state_machine.state_machine_arn
+                                    }
+                                )
+
+        # Trigger the Lambda function when a configuration file is created, updated or deleted
+        for event_type in [s3.EventType.OBJECT_CREATED, s3.EventType.OBJECT_REMOVED]:
+            config_bucket.add_event_notification(event_type,
+                s3_notifications.LambdaDestination(self.config_push_function))
@@ -0,0 +1,50 @@
+import functools
+import os
+import shutil
+import tempfile
+
+from squid_app.allowlist_compiler import compile_allowlist_file
+
+
+# Return the content of a template file of the user data or of the image
+# The files are read once for all the constructs and stacks of the app
+@functools.lru_cache(maxsize=None)
+def read_template(path: str) -> str:
+    with open(path, 'r') as template_h:
+        return template_h.read()
+
+
+# Copy the Squid config files to a staging directory with a compiled allowlist, and return the directory
+# The staging directory is the source of the config files uploaded to the S3 bucket
+# conf_d maps file names to the content of the configuration files included from /etc/squid/conf.d
+# Stacks with the same config files share the staging directory: the allowlist is compiled once per app
+def stage_config_files(source_dir: str, conf_d: dict = None) -> str:
+    return _stage_config_files(source_dir, tuple(sorted((conf_d or {}).items())))
+
+@functools.lru_cache(maxsize=None)
+def _stage_config_files(source_dir: str, conf_d: tuple) -> str:
+    staging_dir = os.path.join(tempfile.mkdtemp(prefix="squid-config-"), "config")
+    shutil.copytree(source_dir, staging_dir)
+
+    allowlist = os.path.join(staging_dir, "allowed_domains.txt")
+    compile_allowlist_file(os.path.join(source_dir, "allowed_domains.txt"), allowlist)
+
+    os.makedirs(os.path.join(staging_dir, "conf.d"), exist_ok=True)
+    for file_name, content in conf_d:
+        with open(os.path.join(staging_dir, "conf.d", file_name), "w") as conf_h:
+            conf_h.write(content)
+
+    return staging_dir
+
+
+# SSL Bump port and certificate generator settings
+# Certificates are generated with the key of the bump CA, an ECDSA CA makes the handshakes cheaper than RSA
+def ssl_bump_conf(sslcrtd_children: int, ssl_cert_cache_mb: int) -> str:
+    return "\n".join([
+        "# Generated by the CDK app, see squid_config_staging.py",
+        "https_port 3130 cert=/etc/squid/ssl/squid.pem ssl-bump intercept generate-host-certificates=on "
+            f"dynamic_cert_mem_cache_size={ssl_cert_cache_mb}MB",
+        f"sslcrtd_program /usr/local/libexec/squid-certgen -s /var/lib/squid/ssl_db -M {ssl_cert_cache_mb}MB",
+        f"sslcrtd_children {sslcrtd_children} startup={max(1, sslcrtd_children // 4)} idle={max(1, sslcrtd_children // 4)}",
+        ""
+    ])
@@ -0,0 +1,189 @@
+# Fair sharing of a Squid instance between its clients: bandwidth pools, connection caps and priority classes
+#
+# This module does not depend on the CDK so that the policies can be checked on their own:
+#   python -c "from squid_app.squid_fair_share import *; from squid_app.squid_tuning_profile import *; print(render_fair_share_conf(fair_share_profile(tuning_profile('c5.2xlarge'), [{'name': 'batch', 'cidrs': ['10.0.2.0/24'], 'priority': 'bulk'}])))"
+#
+# A class groups the clients of source CIDRs. The clients that are in no class are in the "default" class,
+# of standard priority, unless a class without CIDRs sets its limits. A client in the CIDRs of several classes
+# is in the class of highest priority, then in the first class listed.
+
+import collections
+import ipaddress
+import json
+import math
+import re
+
+FairShareClass = collections.namedtuple('FairShareClass', [
+    'name',
+    'priority',
+    'cidrs',
+    # Bandwidth of all the clients of the class, and of each client, None when not limited
+    'bandwidth_mbps',
+    'client_bandwidth_mbps',
+    # Connections of each client, None when not limited
+    'max_connections'
+])
+
+FairShareProfile = collections.namedtuple('FairShareProfile', [
+    'classes',
+    'workers'
+])
+
+# Classes in priority order: the critical classes are never throttled, the bulk classes are throttled first
+PRIORITIES = ("critical", "standard", "bulk")
+
+# Limits of a class that does not set them: (bandwidth_mbps, client_bandwidth_mbps, max_connections)
+PRIORITY_LIMITS = {
+    "critical": (None, None, None),
+    "standard": (None, 200, 1000),
+    "bulk": (100, 20, 100)
+}
+
+DEFAULT_CLASS = "default"
+
+CLASS_NAME_RE = re.compile(r'^[a-z0-9][a-z0-9_-]*$')
+
+# Size of the token buckets, in seconds at the restore rate: the bursts a client gets after being idle
+BURST_SECONDS = 4
+
+# Timeouts that keep the stalled transfers from holding connection slots, while the long downloads
+# that keep receiving data run to the end
+TIMEOUTS = [
+    "connect_timeout 30 seconds",
+    "request_timeout 1 minute",
+    "read_timeout 5 minutes",
+    "client_idle_pconn_timeout 2 minutes",
+    "pconn_timeout 1 minute",
+    "client_lifetime 12 hours",
+    "half_closed_clients off"
+]
+
+# Written next to the Squid settings, read by the health probe to publish the metrics of each class
+FAIR_SHARE_FILE = "/etc/squid/conf.d/fair_share.json"
+
+
+# classes is a list of {"name", "cidrs", "priority", "bandwidth_mbps", "client_bandwidth_mbps", "max_connections"},
+# only the name is required. No classes disables fair sharing
+def fair_share_profile(tuning, classes: list = None) -> FairShareProfile:
+    if not classes:
+        return FairShareProfile(classes=[], workers=tuning.workers)
+
+    fair_share_classes = []
+    default_class = None
+    for options in classes:
+        name = options.get("name", "")
+        if not CLASS_NAME_RE.match(name):
+            raise ValueError(f"Invalid fair share class name: {name!r}")
+        if any(fair_share_class.name == name for fair_share_class in fair_share_classes):
+            raise ValueError(f"Duplicate fair share class: {name}")
+        priority = options.get("priority", "standard")
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown fair share priority: {priority}")
+        unknown = set(options) - {"name", "cidrs", "priority", "bandwidth_mbps", "client_bandwidth_mbps", "max_connections"}
+        if unknown:
+            raise ValueError(f"Unknown options of the fair share class {name}: {', '.join(sorted(unknown))}")
+
+        bandwidth_mbps, client_bandwidth_mbps, max_connections = PRIORITY_LIMITS[priority]
+        fair_share_class = FairShareClass(
+            name=name,
+            priority=priority,
+            # Raises a ValueError for an invalid CIDR
+            cidrs=[str(ipaddress.ip_network(cidr)) for cidr in options.get("cidrs") or []],
+            bandwidth_mbps=options.get("bandwidth_mbps", bandwidth_mbps),
+            client_bandwidth_mbps=options.get("client_bandwidth_mbps", client_bandwidth_mbps),
+            max_connections=options.get("max_connections", max_connections)
+        )
+        if not fair_share_class.cidrs:
+            if default_class:
+                raise ValueError(f"Fair share classes {default_class.name} and {name} have no CIDRs")
+            default_class = fair_share_class
+        elif name == DEFAULT_CLASS:
+            raise ValueError(f"The fair share class {DEFAULT_CLASS} can't have CIDRs")
+        else:
+            fair_share_classes.append(fair_share_class)
+
+    if default_class is None:
+        bandwidth_mbps, client_bandwidth_mbps, max_connections = PRIORITY_LIMITS["standard"]
+        default_class = FairShareClass(DEFAULT_CLASS, "standard", [], bandwidth_mbps, client_bandwidth_mbps,
+            max_connections)
+
+    # Stable sort: the classes of the same priority stay in the order they are listed
+    fair_share_classes.sort(key=lambda fair_share_class: PRIORITIES.index(fair_share_class.priority))
+    return FairShareProfile(classes=fair_share_classes + [default_class], workers=tuning.workers)
+
+
+def acl_name(fair_share_class: FairShareClass) -> str:
+    return f"fair_share_{fair_share_class.name}"
+
+
+# Token bucket of a delay pool: restore/max in bytes per second of each worker, -1/-1 when not limited
+# The Squid workers do not share their delay pools and the kernel spreads the connections across the workers,
+# so each worker gets its share of the limits
+def delay_bucket(mbps, workers: int) -> str:
+    if mbps is None:
+        return "-1/-1"
+    restore = max(1, int(mbps * 1000000 / 8 / workers))
+    return f"{restore}/{restore * BURST_SECONDS}"
+
+
+# Connections of a client to each worker
+def worker_connections(max_connections: int, workers: int) -> int:
+    return max(1, math.ceil(max_connections / workers))
+
+
+# Squid settings, included from conf.d
+# Every class has a class 3 delay pool, with an aggregate bucket and a bucket per client: Squid puts a request
+# in the first pool that allows it, the pools are in priority order. The connection caps are maxconn ACLs
+def render_fair_share_conf(profile: FairShareProfile) -> str:
+    if not profile.classes:
+        return "\n".join([
+            "# Generated by the CDK app, see squid_fair_share.py",
+            "# Fair sharing is disabled",
+            ""
+        ])
+
+    lines = ["# Generated by the CDK app, see squid_fair_share.py"] + TIMEOUTS
+    for fair_share_class in profile.classes:
+        if fair_share_class.cidrs:
+            lines.append(f"acl {acl_name(fair_share_class)} src {' '.join(fair_share_class.cidrs)}")
+        else:
+            # The clients that are in no other class, but not the health probe of the instance
+            lines.append(f"acl {acl_name(fair_share_class)} src all")
+
+    # Connection caps: a client is only held to the cap of its own class
+    higher_classes = ["!localhost"]
+    for fair_share_class in profile.classes:
+        if fair_share_class.max_connections is not None:
+            connections = worker_connections(fair_share_class.max_connections, profile.workers)
+            lines.append(f"acl {acl_name(fair_share_class)}_connections maxconn {connections}")
+            lines.append(" ".join(["http_access deny"] + higher_classes +
+                [acl_name(fair_share_class), f"{acl_name(fair_share_class)}_connections"]))
+        higher_classes.append(f"!{acl_name(fair_share_class)}")
+
+    lines.append(f"delay_pools {len(profile.classes)}")
+    for pool, fair_share_class in enumerate(profile.classes, start=1):
+        lines.extend([
+            f"delay_class {pool} 3",
+            "delay_parameters {} {} -1/-1 {}".format(pool,
+                delay_bucket(fair_share_class.bandwidth_mbps, profile.workers),
+                delay_bucket(fair_share_class.client_bandwidth_mbps, profile.workers)),
+            f"delay_access {pool} deny localhost",
+            f"delay_access {pool} allow {acl_name(fair_share_class)}",
+            f"delay_access {pool} deny all"
+        ])
+    return "\n".join(lines + [""])
+
+
+# Classes, delay pools and connection caps of each worker, for the health probe
+def render_fair_share_json(profile: FairShareProfile) -> str:
+    return json.dumps({
+        "workers": profile.workers,
+        "classes": [{
+            "name": fair_share_class.name,
+            "priority": fair_share_class.priority,
+            "pool": pool,
+            "cidrs": fair_share_class.cidrs,
+            "max_connections": worker_connections(fair_share_class.max_connections, profile.workers)
+                if fair_share_class.max_connections is not None else None
+        } for pool, fair_share_class in enumerate(profile.classes, start=1)]
+    }, indent=2) + "\n"
@@ -0,0 +1,90 @@
+import hashlib
+import json
+
+from aws_cdk import (
+    aws_ec2 as ec2,
+    aws_iam as iam,
+    aws_imagebuilder as imagebuilder,
+    core,
+)
+
+from squid_app.squid_config_staging import read_template
+
+class SquidImageStack(core.Stack):
+
+    def __init__(self, scope: core.Construct, id: str, vpc: ec2.Vpc, **kwargs) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        # The install script is shared with the user data of the stock Amazon Linux 2 instances
+        install_script = read_template("./squid_app/squid_config_files/user_data/squid_install.sh")
+
+        # Image Builder components and recipes can't be updated in place: derive their version from the install script
+        version = f"1.0.{int(hashlib.sha256(install_script.encode()).hexdigest()[:6], 16)}"
+
+        # Component that installs Squid, the CloudWatch Agent and its config and the health probe runtime
+        component = imagebuilder.CfnComponent(self, "squid-install-component",
+            name=f"{self.stack_name}-squid-install",
+            platform="Linux",
+            version=version,
+            data=json.dumps({
+                "name": "squid-install",
+                "schemaVersion": 1.0,
+                "phases": [{
+                    "name": "build",
+                    "steps": [{
+                        "name": "InstallSquid",
+                        "action": "ExecuteBash",
+                        "inputs": {"commands": [install_script]}
+                    }]
+                }]
+            })
+        )
+
+        # Recipe based on the latest Amazon Linux 2
+        amazon_linux_2_ami = ec2.MachineImage.latest_amazon_linux(
+            generation=ec2.AmazonLinuxGeneration.AMAZON_LINUX_2,
+            edition=ec2.AmazonLinuxEdition.STANDARD,
+            virtualization=ec2.AmazonLinuxVirt.HVM,
+            storage=ec2.AmazonLinuxStorage.GENERAL_PURPOSE
+        )
+        recipe = imagebuilder.CfnImageRecipe(self, "squid-recipe",
+            name=f"{self.stack_name}-squid",
+            version=version,
+            parent_image=amazon_linux_2_ami.get_image(self).image_id,
+            components=[imagebuilder.CfnImageRecipe.ComponentConfigurationProperty(
+                component_arn=component.attr_arn
+            )]
+        )
+
+        # The build instance runs in a public subnet of the VPC to download the packages
+        build_role = iam.Role(self, "image-builder-role",
+            assumed_by=iam.ServicePrincipal("ec2.amazonaws.com"),
+            managed_policies=[iam.ManagedPolicy.from_aws_managed_policy_name("EC2InstanceProfileForImageBuilder"),
+            iam.ManagedPolicy.from_aws_managed_policy_name("AmazonSSMManagedInstanceCore")]
+        )
+        build_instance_profile = iam.CfnInstanceProfile(self, "image-builder-instance-profile",
+            roles=[build_role.role_name]
+        )
+        build_security_group = ec2.SecurityGroup(self, "image-builder-sg",
+            vpc=vpc,
+            allow_all_outbound=True
+        )
+        infrastructure = imagebuilder.CfnInfrastructureConfiguration(self, "squid-build-infrastructure",
+            name=f"{self.stack_name}-squid-build",
+            instance_profile_name=build_instance_profile.ref,
+            instance_types=["t3.small"],
+            subnet_id=vpc.public_subnets[0].subnet_id,
+            security_group_ids=[build_security_group.security_group_id],
+            terminate_instance_on_failure=True
+        )
+
+        # Build the image during the deployment. A change to the install script builds a new image
+        image = imagebuilder.CfnImage(self, "squid-image",
+            image_recipe_arn=recipe.attr_arn,
+            infrastructure_configuration_arn=infrastructure.attr_arn
+        )
+
+        self.ami_id = image.attr_image_id
+
+        core.CfnOutput(self, "output-squid-ami-id",
+                       value=self.ami_id)
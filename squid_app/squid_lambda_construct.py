@@ -1,5 +1,6 @@
 from aws_cdk import (
     core,
+    aws_dynamodb as dynamodb,
     aws_iam as iam,
     aws_lambda as _lambda,
     aws_sns_subscriptions as sns_subscriptions,
@@ -8,7 +9,8 @@ from aws_cdk import (
 
 
 class SquidLambdaConstruct(core.Construct):
-    def __init__(self, scope: core.Construct, id: str) -> None:
+    def __init__(self, scope: core.Construct, id: str, dry_run: bool = False,
+        target_strategy: str = "weighted") -> None:
         super().__init__(scope, id)
         
         # Create IAM role for Lambda
@@ -22,8 +24,8 @@ class SquidLambdaConstruct(core.Construct):
             actions=['ec2:ModifyInstanceAttribute',
                 'autoscaling:Describe*',
                 'autoscaling:CompleteLifecycleAction',
-                'autoscaling:SetInstanceHealth',
                 'cloudwatch:Describe*',
+                'cloudwatch:GetMetricData',
                 'ec2:CreateRoute',
                 'ec2:CreateTags',
                 'ec2:ReplaceRoute',
@@ -33,13 +35,36 @@ class SquidLambdaConstruct(core.Construct):
             )
         )
     
+        # Failover state shared by the invocations of the function: the lease that serializes the route
+        # changes and the time of the last alarm transition processed for each ASG
+        failover_state_table = dynamodb.Table(self,"failover-state",
+            partition_key=dynamodb.Attribute(name="Id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=core.RemovalPolicy.DESTROY
+        )
+        failover_state_table.grant_read_write_data(lambda_iam_role)
+
         # Create a Lambda function that is triggered when the Squid Alarm state changes
+        timeout = core.Duration.seconds(60)
         self.squid_alarm_lambda_function = _lambda.Function(self, "alarm-function",
                                     runtime=_lambda.Runtime.PYTHON_3_8,
                                     handler="lambda-handler.handler",
                                     code=_lambda.Code.asset("./squid_app/squid_config_files/lambda"),
                                     role=lambda_iam_role,
-                                    timeout=core.Duration.seconds(60)
+                                    timeout=timeout,
+                                    environment={
+                                        # Print the route plan without changing any route table
+                                        "DRY_RUN": "true" if dry_run else "false",
+                                        # Number of route tables updated in parallel
+                                        "ROUTE_UPDATE_CONCURRENCY": "8",
+                                        # Selection of the instances that take over the route tables of a failed ASG:
+                                        # first, spread, weighted (network throughput) or weighted-requests
+                                        "TARGET_STRATEGY": target_strategy,
+                                        # Table used to serialize the invocations and drop the duplicate or stale alarm transitions
+                                        "STATE_TABLE": failover_state_table.table_name,
+                                        # Duration of the lease: an invocation that times out holds it until the end of the timeout
+                                        "LEASE_SECONDS": str(int(timeout.to_seconds()))
+                                    }
                                 )
 
     def add_sns_subscription (self,
@@ -52,4 +77,16 @@ class SquidLambdaConstruct(core.Construct):
             action='lambda:InvokeFunction',
             source_arn=squid_alarm_topic.topic_arn
         )
-        squid_alarm_topic.add_subscription(sns_subscriptions.LambdaSubscription(lambda_function))
\ No newline at end of file
+        squid_alarm_topic.add_subscription(sns_subscriptions.LambdaSubscription(lambda_function))
+
+    # Rebalance the routes when an instance goes in service or is terminating
+    def add_lifecycle_subscription (self,
+        lambda_function: _lambda.Function,
+        lifecycle_hook_topic: sns.Topic
+    ):
+        lambda_function.add_permission("squid-lifecycle-permission",
+            principal=iam.ServicePrincipal("sns.amazonaws.com"),
+            action='lambda:InvokeFunction',
+            source_arn=lifecycle_hook_topic.topic_arn
+        )
+        lifecycle_hook_topic.add_subscription(sns_subscriptions.LambdaSubscription(lambda_function))
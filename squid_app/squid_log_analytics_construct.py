@@ -0,0 +1,57 @@
+from aws_cdk import (
+    core,
+    aws_iam as iam,
+    aws_lambda as _lambda,
+    aws_logs as logs,
+    aws_logs_destinations as logs_destinations
+)
+
+
+class SquidLogAnalyticsConstruct(core.Construct):
+    def __init__(self, scope: core.Construct, id: str, squid_asgs: list, max_domains: int = 100,
+        access_log_pipeline: str = "cloudwatch") -> None:
+        super().__init__(scope, id)
+
+        # Log group of the Squid access logs shipped by the CloudWatch Agent
+        # The instances depend on it so that the agent does not create it first. The agent of the earlier
+        # deployments created /filtering-squid-instance/access.log, which is left as is: the stack can't create it
+        self.access_log_group = logs.LogGroup(self,"access-log",
+            log_group_name="/filtering-squid-instance/squid-access.log",
+            retention=logs.RetentionDays.INFINITE,
+            removal_policy=core.RemovalPolicy.RETAIN
+        )
+        for asg in squid_asgs:
+            asg.node.add_dependency(self.access_log_group)
+
+        # With the s3 pipeline, the log group only gets a sample of the access log:
+        # the log shipper of the instances publishes the access log metrics itself
+        if access_log_pipeline == "s3":
+            return
+
+        # Create IAM role for Lambda
+        lambda_iam_role = iam.Role(self,"lambda-role", 
+          assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+          managed_policies=[iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaBasicExecutionRole")]
+        )
+
+        # Create a Lambda function that rolls up the access logs per minute and prints them in Embedded Metric Format
+        self.log_analytics_function = _lambda.Function(self, "log-analytics-function",
+                                    runtime=_lambda.Runtime.PYTHON_3_8,
+                                    handler="log-analytics-handler.handler",
+                                    code=_lambda.Code.asset("./squid_app/squid_config_files/access_logs"),
+                                    role=lambda_iam_role,
+                                    timeout=core.Duration.seconds(60),
+                                    memory_size=512,
+                                    environment={
+                                        # Number of domains with their own metrics, the other domains are rolled up as "other"
+                                        "MAX_DOMAINS": str(max_domains),
+                                        "METRIC_NAMESPACE": "Squid/AccessLog"
+                                    }
+                                )
+
+        # Send all the access log events to the Lambda function
+        logs.SubscriptionFilter(self,"access-log-subscription",
+            log_group=self.access_log_group,
+            destination=logs_destinations.LambdaDestination(self.log_analytics_function),
+            filter_pattern=logs.FilterPattern.all_events()
+        )
@@ -7,20 +7,38 @@ from aws_cdk import (
 
 
 class SquidMonitoringConstruct(core.Construct):
-    def __init__(self, scope: core.Construct, id: str, squid_asgs: list) -> None:
+    def __init__(self, scope: core.Construct, id: str, squid_asgs: list, health_check: str = "probe") -> None:
         super().__init__(scope, id)
         
         # SNS Topic for alarm
         self.squid_alarm_topic = sns.Topic(self,"squid-asg-alarm-topic", display_name='Squid ASG Alarm topic')
+        squid_alarm_action = cw_actions.SnsAction(self.squid_alarm_topic)
 
-        # Create metric to use for triggering alarm when there is no CPU usage from the squid process
+        # One alarm per ASG: the state of the alarm of an AZ is the failover signal of the AZ
+        # A failed instance is replaced on its own, the alarm only goes to ALARM when no instance of the AZ is healthy
         for count, asg in enumerate(squid_asgs, start=1):
-            squid_metric = cloudwatch.Metric(metric_name="procstat_cpu_usage",
-                namespace='CWAgent',
-                dimensions=dict(AutoScalingGroupName=asg.auto_scaling_group_name,
-                    pidfile="/var/run/squid.pid",
-                    process_name="squid")
-            )
+            if health_check == "probe":
+                # High resolution metric published by the squid health probe of each instance: 1 for a probe
+                # cycle where squid answered on all its ports, 0 when any port failed. The per-port results have
+                # a Port dimension and are not read here. The maximum is 1 as long as one instance of the ASG answers
+                squid_metric = cloudwatch.Metric(metric_name="ProbeSuccess",
+                    namespace='Squid',
+                    dimensions=dict(AutoScalingGroupName=asg.auto_scaling_group_name)
+                )
+                statistic = 'Maximum'
+                threshold = 1.0
+            elif health_check == "procstat":
+                # Create metric to use for triggering alarm when there is no CPU usage from the squid process
+                squid_metric = cloudwatch.Metric(metric_name="procstat_cpu_usage",
+                    namespace='CWAgent',
+                    dimensions=dict(AutoScalingGroupName=asg.auto_scaling_group_name,
+                        pidfile="/var/run/squid.pid",
+                        process_name="squid")
+                )
+                statistic = 'Average'
+                threshold = 0.0
+            else:
+                raise ValueError(f"Unknown health check: {health_check}")
 
             # CloudWatch alarms to alert on Squid ASG issue
             squid_alarm = cloudwatch.Alarm(self,f"squid-alarm-{count}",
@@ -30,9 +48,9 @@ class SquidMonitoringConstruct(core.Construct):
                 metric=squid_metric,
                 period=core.Duration.seconds(10),
                 evaluation_periods=1,
-                threshold=0.0,
-                statistic='Average',
+                threshold=threshold,
+                statistic=statistic,
                 treat_missing_data=cloudwatch.TreatMissingData.BREACHING
             )
-            squid_alarm.add_alarm_action(cw_actions.SnsAction(self.squid_alarm_topic))
-            squid_alarm.add_ok_action(cw_actions.SnsAction(self.squid_alarm_topic))
+            squid_alarm.add_alarm_action(squid_alarm_action)
+            squid_alarm.add_ok_action(squid_alarm_action)
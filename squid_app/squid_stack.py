@@ -9,33 +9,79 @@ from aws_cdk import (
 from squid_app.squid_asg_construct import SquidAsgConstruct
 from squid_app.squid_monitoring_construct import SquidMonitoringConstruct
 from squid_app.squid_lambda_construct import SquidLambdaConstruct
+from squid_app.squid_config_push_construct import SquidConfigPushConstruct
+from squid_app.squid_log_analytics_construct import SquidLogAnalyticsConstruct
 
 class SquidStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, vpc: ec2.Vpc, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, vpc: ec2.Vpc, failover_dry_run: bool = False,
+        health_check: str = "probe", health_probe_url: str = "http://checkip.amazonaws.com/",
+        instance_type: str = "t3.nano", min_capacity: int = 1, max_capacity: int = 1,
+        scaling_metric: str = None, scaling_target: float = None, ami_id: str = None,
+        bump_ca_key_type: str = "ecdsa", sslcrtd_children: int = 8, ssl_cert_cache_mb: int = 16,
+        log_analytics_max_domains: int = 100, firewall: str = "iptables",
+        failover_target_strategy: str = "weighted", warm_pool: str = "none",
+        cache_volume: str = "none", cache_volume_gb: int = 50, config_canary_minutes: int = 10,
+        access_log_pipeline: str = "cloudwatch", access_log_sample_rate: float = 0.01,
+        fair_share_classes: list = None, client_cidrs: list = None, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
         #  Create the core Squid components: 
         #  1. IAM instance profile to be used by the Squid instances
         #  2. S3 bucket to host Squid config and whitelist files
         #  3. Launch configuration with user data 
-        #  4. Auto-Scaling Groups in each AZ with a Squid instance in the public subnet
+        #  4. Auto-Scaling Groups in each AZ with Squid instances in the public subnet
         #  5. CloudWatch Log Groups to collect access and access logs from each instance in the ASGs
         
-        asgs = SquidAsgConstruct(self,"squid-asgs", vpc=vpc, region=self.region)
+        asgs = SquidAsgConstruct(self,"squid-asgs", vpc=vpc, region=self.region,
+            health_probe_url=health_probe_url,
+            instance_type=instance_type,
+            min_capacity=min_capacity,
+            max_capacity=max_capacity,
+            scaling_metric=scaling_metric,
+            scaling_target=scaling_target,
+            ami_id=ami_id,
+            bump_ca_key_type=bump_ca_key_type,
+            sslcrtd_children=sslcrtd_children,
+            ssl_cert_cache_mb=ssl_cert_cache_mb,
+            firewall=firewall,
+            warm_pool=warm_pool,
+            cache_volume=cache_volume,
+            cache_volume_gb=cache_volume_gb,
+            access_log_pipeline=access_log_pipeline,
+            access_log_sample_rate=access_log_sample_rate,
+            access_log_max_domains=log_analytics_max_domains,
+            fair_share_classes=fair_share_classes,
+            client_cidrs=client_cidrs)
 
         # Create the Lambda components
         #  1. IAM role for Lambda to assume
         #  2. Lambda function that is triggered when the alarm state changes 
 
-        lambda_function = SquidLambdaConstruct(self,"squid-lambda")
+        lambda_function = SquidLambdaConstruct(self,"squid-lambda", dry_run=failover_dry_run,
+            target_strategy=failover_target_strategy)
 
         # Create the mmonitoring components
         #  1. Metrics and alarms for each ASG
         #  2. SNS topic where change in alarm state is published 
 
-        monitoring = SquidMonitoringConstruct(self,"squid-monitoring", squid_asgs=asgs.squid_asgs)
+        monitoring = SquidMonitoringConstruct(self,"squid-monitoring", squid_asgs=asgs.squid_asgs,
+            health_check=health_check)
         monitoring.node.add_dependency(lambda_function)
 
         # Add SNS subscription to tie the Lambda and CloudWatch alarm 
-        lambda_function.add_sns_subscription(lambda_function=lambda_function.squid_alarm_lambda_function, squid_alarm_topic=monitoring.squid_alarm_topic)
\ No newline at end of file
+        lambda_function.add_sns_subscription(lambda_function=lambda_function.squid_alarm_lambda_function, squid_alarm_topic=monitoring.squid_alarm_topic)
+        lambda_function.add_lifecycle_subscription(lambda_function=lambda_function.squid_alarm_lambda_function,
+            lifecycle_hook_topic=asgs.lifecycle_hook_topic)
+
+        # Roll out the Squid config to the instances when it changes in the S3 bucket: a canary instance first,
+        # then all the instances if its latency and error rate stay in line with the other instances
+        SquidConfigPushConstruct(self,"squid-config-push", config_bucket=asgs.squid_config_bucket, squid_asgs=asgs.squid_asgs,
+            release_parameter=asgs.config_release_parameter,
+            canary_parameter=asgs.config_canary_parameter,
+            canary_minutes=config_canary_minutes)
+
+        # Roll up the access logs per minute, per domain, per status and per instance into metrics
+        SquidLogAnalyticsConstruct(self,"squid-log-analytics", squid_asgs=asgs.squid_asgs,
+            max_domains=log_analytics_max_domains,
+            access_log_pipeline=access_log_pipeline)
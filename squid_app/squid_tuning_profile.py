@@ -0,0 +1,159 @@
+# Squid and kernel tuning profile of a Squid instance, generated from its instance type
+#
+# This module does not depend on the CDK so that the profiles can be checked on their own:
+#   python -c "from squid_app.squid_tuning_profile import *; print(render_squid_conf(tuning_profile('c5.2xlarge')))"
+
+import collections
+import re
+
+SquidTuningProfile = collections.namedtuple('SquidTuningProfile', [
+    'instance_type',
+    'vcpus',
+    'memory_mib',
+    'workers',
+    'cpu_affinity_map',
+    'max_filedescriptors',
+    'conntrack_max',
+    'sysctl',
+    'firewall'
+])
+
+# vCPUs of the burstable sizes, the other sizes have 2 vCPUs per "large"
+BURSTABLE_VCPUS = {"nano": 2, "micro": 2, "small": 2, "medium": 2}
+T2_VCPUS = {"nano": 1, "micro": 1, "small": 1, "medium": 2}
+T_MEMORY_MIB = {"nano": 512, "micro": 1024, "small": 2048, "medium": 4096, "large": 8192}
+# Memory per vCPU of the instance families, by the first letter of the family
+MEMORY_MIB_PER_VCPU = {"c": 2048, "m": 4096, "r": 8192, "x": 16384, "z": 8192}
+
+FIREWALLS = ("iptables", "nftables")
+
+# Forward and intercept ports of Squid, kept out of the ephemeral ports so that an outgoing connection
+# never takes one of them before Squid binds it
+SQUID_PORTS = "3128-3130"
+
+INSTANCE_TYPE_RE = re.compile(r'^(?P<family>[a-z][a-z0-9-]*)\.(?P<size>nano|micro|small|medium|large|(?P<multiple>\d*)xlarge)$')
+
+
+# Return the vCPUs and the memory in MiB of an instance type
+def instance_resources(instance_type: str):
+    match = INSTANCE_TYPE_RE.match(instance_type)
+    if not match:
+        raise ValueError(f"Unknown instance type: {instance_type}")
+    family, size = match.group("family"), match.group("size")
+
+    if family == "t2" and size in T2_VCPUS:
+        vcpus = T2_VCPUS[size]
+    elif size in BURSTABLE_VCPUS:
+        vcpus = BURSTABLE_VCPUS[size]
+    elif size == "large":
+        vcpus = 2
+    else:
+        vcpus = 4 * int(match.group("multiple") or 1)
+
+    if family.startswith("t"):
+        memory_mib = T_MEMORY_MIB.get(size, vcpus * 4096)
+    else:
+        memory_mib = vcpus * MEMORY_MIB_PER_VCPU.get(family[0], 4096)
+    return vcpus, memory_mib
+
+
+def tuning_profile(instance_type: str, firewall: str = "iptables") -> SquidTuningProfile:
+    if firewall not in FIREWALLS:
+        raise ValueError(f"Unknown firewall: {firewall}")
+    vcpus, memory_mib = instance_resources(instance_type)
+
+    # One Squid worker per vCPU, but the first vCPU is left to the kernel (NAT, conntrack and
+    # network interrupts) and to the Squid coordinator process
+    workers = 1 if vcpus <= 2 else vcpus - 1
+    cpu_affinity_map = None
+    if workers > 1:
+        cpu_affinity_map = (list(range(1, workers + 1)), list(range(2, workers + 2)))
+
+    # 16k file descriptors per GiB of memory, for each Squid process
+    max_filedescriptors = min(1048576, max(16384, memory_mib * 16))
+    # Each connection through Squid uses 2 conntrack entries of about 320 bytes: 64k entries per GiB
+    conntrack_max = min(4194304, max(65536, memory_mib * 64))
+
+    sysctl = collections.OrderedDict([
+        ("net.core.somaxconn", 8192),
+        ("net.core.netdev_max_backlog", 16384),
+        ("net.ipv4.tcp_max_syn_backlog", 16384),
+        ("net.ipv4.ip_local_port_range", "1024 65535"),
+        ("net.ipv4.ip_local_reserved_ports", SQUID_PORTS),
+        ("net.ipv4.tcp_tw_reuse", 1),
+        ("net.ipv4.tcp_fin_timeout", 15),
+        ("net.netfilter.nf_conntrack_max", conntrack_max),
+        ("net.netfilter.nf_conntrack_tcp_timeout_established", 3600),
+        ("net.netfilter.nf_conntrack_tcp_timeout_time_wait", 30)
+    ])
+
+    return SquidTuningProfile(
+        instance_type=instance_type,
+        vcpus=vcpus,
+        memory_mib=memory_mib,
+        workers=workers,
+        cpu_affinity_map=cpu_affinity_map,
+        max_filedescriptors=max_filedescriptors,
+        conntrack_max=conntrack_max,
+        sysctl=sysctl,
+        firewall=firewall
+    )
+
+
+# Squid settings, included from conf.d
+def render_squid_conf(profile: SquidTuningProfile) -> str:
+    lines = [
+        f"# Generated by the CDK app for {profile.instance_type}, see squid_tuning_profile.py",
+        f"workers {profile.workers}",
+        f"max_filedescriptors {profile.max_filedescriptors}"
+    ]
+    if profile.cpu_affinity_map:
+        process_numbers, cores = profile.cpu_affinity_map
+        lines.append("cpu_affinity_map process_numbers={} cores={}".format(
+            ",".join(map(str, process_numbers)), ",".join(map(str, cores))))
+    return "\n".join(lines + [""])
+
+
+# Content of /etc/sysctl.d/90-squid.conf
+def render_sysctl_conf(profile: SquidTuningProfile) -> str:
+    return "\n".join(f"{key} = {value}" for key, value in profile.sysctl.items()) + "\n"
+
+
+# Commands that redirect the intercepted HTTP and HTTPS traffic to Squid
+def render_firewall_rules(profile: SquidTuningProfile) -> str:
+    if profile.firewall == "nftables":
+        return "\n".join([
+            "rpm -q nftables || yum install -y nftables",
+            "nft add table ip squid",
+            "nft add chain ip squid prerouting '{ type nat hook prerouting priority -100; }'",
+            "nft add rule ip squid prerouting tcp dport 80 redirect to :3129",
+            "nft add rule ip squid prerouting tcp dport 443 redirect to :3130"
+        ])
+    return "\n".join([
+        "iptables -t nat -A PREROUTING -p tcp --dport 80 -j REDIRECT --to-port 3129",
+        "iptables -t nat -A PREROUTING -p tcp --dport 443 -j REDIRECT --to-port 3130"
+    ])
+
+
+# User data commands that write the kernel settings and the file descriptor limit of Squid
+def render_kernel_tuning(profile: SquidTuningProfile) -> str:
+    return "\n".join([
+        "cat > /etc/sysctl.d/90-squid.conf << 'EOF'",
+        render_sysctl_conf(profile) + "EOF",
+        "mkdir -p /etc/systemd/system/squid.service.d",
+        "cat > /etc/systemd/system/squid.service.d/limits.conf << 'EOF'",
+        "[Service]",
+        f"LimitNOFILE={profile.max_filedescriptors}",
+        "EOF",
+        "systemctl daemon-reload"
+    ])
+
+
+# Commands run on every boot: the conntrack settings and the redirection rules are lost when the instance stops
+def render_network_setup(profile: SquidTuningProfile) -> str:
+    return "\n".join([
+        "modprobe nf_conntrack",
+        f"echo {profile.conntrack_max // 4} > /sys/module/nf_conntrack/parameters/hashsize",
+        "sysctl -p /etc/sysctl.d/90-squid.conf",
+        render_firewall_rules(profile)
+    ])
@@ -1,12 +1,15 @@
 from aws_cdk import (
+    aws_autoscaling as autoscaling,
     aws_ec2 as ec2,
     aws_iam as iam,
+    aws_s3_assets as s3_assets,
     core,
 )
 
 class TestInstanceStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, vpc: ec2.Vpc, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, vpc: ec2.Vpc, load_generators: int = 0,
+        load_generator_instance_type: str = "c5.large", load_test_dimensions: dict = None, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
         
         # Set the AMI to the latest Amazon Linux 2
@@ -37,4 +40,58 @@ class TestInstanceStack(core.Stack):
             )
 
         core.CfnOutput(self, "output-instance-id",
-                       value=instance.instance_id)
\ No newline at end of file
+                       value=instance.instance_id)
+
+        if load_generators:
+            self.add_load_generators(vpc, amazon_linux_2_ami, load_generators, load_generator_instance_type,
+                load_test_dimensions or {})
+
+    # Fleet of load generators spread across the AZs, in the subnets routed through the squid instances
+    # The load test is started on all of them with SSM Run Command, see the README
+    def add_load_generators(self, vpc, machine_image, count, instance_type, dimensions):
+        load_generator_role = iam.Role(self, "load-generator-role",
+            assumed_by=iam.ServicePrincipal("ec2.amazonaws.com"),
+            managed_policies=[iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AmazonEC2RoleforSSM")]
+        )
+        # Allow the load driver to publish its results
+        load_generator_role.add_to_policy(statement= iam.PolicyStatement(effect=iam.Effect.ALLOW,
+            actions=['cloudwatch:PutMetricData',],
+            resources=['*']
+            )
+        )
+
+        load_driver_asset = s3_assets.Asset(self, "load-driver",
+            path='./squid_app/squid_config_files/load_test/squid_load_driver.py'
+        )
+        load_driver_asset.grant_read(load_generator_role)
+
+        load_generators = autoscaling.AutoScalingGroup(self, "load-generators", vpc=vpc,
+            instance_type=ec2.InstanceType(instance_type),
+            machine_image=machine_image,
+            role=load_generator_role,
+            desired_capacity=count,
+            min_capacity=count,
+            max_capacity=count,
+            vpc_subnets=ec2.SubnetSelection(
+                subnet_type=ec2.SubnetType.ISOLATED
+            )
+        )
+
+        # squid-load-test runs the load driver with the dimensions of the test and the AZ of the load generator,
+        # which is also the AZ of the squid instance under load
+        dimension_options = " ".join(f"--dimension {name}={value}" for name, value in sorted(dimensions.items()))
+        load_generators.add_user_data(
+            "yum install -y python3",
+            "pip3 install boto3",
+            f"aws s3 cp {load_driver_asset.s3_object_url} /usr/local/bin/squid_load_driver.py --region {core.Aws.REGION}",
+            "cat > /usr/local/bin/squid-load-test << 'EOF'",
+            "#!/bin/bash",
+            "az=`curl -s http://169.254.169.254/latest/meta-data/placement/availability-zone`",
+            "ulimit -n 65536",
+            f"exec python3 /usr/local/bin/squid_load_driver.py --publish --region {core.Aws.REGION} {dimension_options} --dimension AvailabilityZone=$az \"$@\"",
+            "EOF",
+            "chmod +x /usr/local/bin/squid-load-test"
+        )
+
+        core.CfnOutput(self, "output-load-generators",
+                       value=load_generators.auto_scaling_group_name)
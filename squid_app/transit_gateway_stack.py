@@ -0,0 +1,121 @@
+from aws_cdk import (
+    aws_ec2 as ec2,
+    core,
+)
+
+class TransitGatewayStack(core.Stack):
+
+    def __init__(self, scope: core.Construct, id: str, inspection_vpc: ec2.Vpc, spoke_vpcs: list, **kwargs) -> None:
+        super().__init__(scope, id, **kwargs)
+
+        # Centralized egress: the spoke VPCs send their Internet traffic through the Transit Gateway to the
+        # inspection VPC, where the Squid instances run. The isolated subnets of the inspection VPC hold the
+        # Transit Gateway attachment: their route tables are the ones the failover Lambda points to a Squid
+        # instance of the AZ, so a failover updates one route per AZ whatever the number of spoke VPCs.
+        #
+        # Each spoke VPC is either the CIDR of a VPC created by this stack, with isolated subnets in 2 AZs,
+        # or an existing VPC: {"vpc_id": ..., "cidr": ..., "subnet_ids": [...], "route_table_ids": [...]}
+        # The route tables of an existing VPC must not have a default route already.
+
+        if not inspection_vpc.isolated_subnets:
+            raise ValueError("No isolated subnets in the inspection VPC for the Transit Gateway attachment")
+
+        self.transit_gateway = ec2.CfnTransitGateway(self, "tgw",
+            description="Centralized egress through the Squid instances",
+            default_route_table_association="disable",
+            default_route_table_propagation="disable",
+            dns_support="enable"
+        )
+        tgw_id = self.transit_gateway.ref
+
+        # Appliance mode keeps both directions of a flow in the same AZ, on the Squid instance that intercepted it
+        inspection_attachment = ec2.CfnTransitGatewayAttachment(self, "inspection-attachment",
+            transit_gateway_id=tgw_id,
+            vpc_id=inspection_vpc.vpc_id,
+            subnet_ids=[subnet.subnet_id for subnet in inspection_vpc.isolated_subnets],
+            options={"ApplianceModeSupport": "enable"},
+            tags=[core.CfnTag(key="Name", value="inspection")]
+        )
+
+        # Route table of the spoke attachments: all the traffic goes to the inspection VPC
+        spoke_route_table = ec2.CfnTransitGatewayRouteTable(self, "spoke-route-table",
+            transit_gateway_id=tgw_id,
+            tags=[core.CfnTag(key="Name", value="spokes")]
+        )
+        ec2.CfnTransitGatewayRoute(self, "spoke-default-route",
+            transit_gateway_route_table_id=spoke_route_table.ref,
+            destination_cidr_block="0.0.0.0/0",
+            transit_gateway_attachment_id=inspection_attachment.ref
+        )
+
+        # Route table of the inspection attachment: the spoke VPCs propagate their CIDR, for the return traffic
+        inspection_route_table = ec2.CfnTransitGatewayRouteTable(self, "inspection-route-table",
+            transit_gateway_id=tgw_id,
+            tags=[core.CfnTag(key="Name", value="inspection")]
+        )
+        ec2.CfnTransitGatewayRouteTableAssociation(self, "inspection-association",
+            transit_gateway_attachment_id=inspection_attachment.ref,
+            transit_gateway_route_table_id=inspection_route_table.ref
+        )
+
+        self.spoke_vpcs = []
+        self.spoke_cidrs = []
+        for count, spoke in enumerate(spoke_vpcs, start=1):
+            if isinstance(spoke, str):
+                # Create a spoke VPC with 2 isolated subnets across 2 availability zones
+                vpc = ec2.Vpc(self, f"spoke-{count}",
+                    max_azs=2,
+                    cidr=spoke,
+                    subnet_configuration=[ec2.SubnetConfiguration(
+                        subnet_type=ec2.SubnetType.ISOLATED,
+                        name="Isolated",
+                        cidr_mask=24
+                        )
+                    ]
+                )
+                self.spoke_vpcs.append(vpc)
+                vpc_id, cidr = vpc.vpc_id, spoke
+                subnet_ids = [subnet.subnet_id for subnet in vpc.isolated_subnets]
+                route_table_ids = [subnet.route_table.route_table_id for subnet in vpc.isolated_subnets]
+            elif isinstance(spoke, dict):
+                vpc_id, cidr = spoke["vpc_id"], spoke["cidr"]
+                subnet_ids, route_table_ids = spoke["subnet_ids"], spoke["route_table_ids"]
+            else:
+                raise ValueError(f"Unknown spoke VPC: {spoke}")
+            self.spoke_cidrs.append(cidr)
+
+            spoke_attachment = ec2.CfnTransitGatewayAttachment(self, f"spoke-{count}-attachment",
+                transit_gateway_id=tgw_id,
+                vpc_id=vpc_id,
+                subnet_ids=subnet_ids,
+                tags=[core.CfnTag(key="Name", value=f"spoke-{count}")]
+            )
+            ec2.CfnTransitGatewayRouteTableAssociation(self, f"spoke-{count}-association",
+                transit_gateway_attachment_id=spoke_attachment.ref,
+                transit_gateway_route_table_id=spoke_route_table.ref
+            )
+            ec2.CfnTransitGatewayRouteTablePropagation(self, f"spoke-{count}-propagation",
+                transit_gateway_attachment_id=spoke_attachment.ref,
+                transit_gateway_route_table_id=inspection_route_table.ref
+            )
+
+            # Default route of the spoke subnets to the Transit Gateway
+            for index, route_table_id in enumerate(route_table_ids, start=1):
+                route = ec2.CfnRoute(self, f"spoke-{count}-default-route-{index}",
+                    route_table_id=route_table_id,
+                    destination_cidr_block="0.0.0.0/0",
+                    transit_gateway_id=tgw_id
+                )
+                route.add_depends_on(spoke_attachment)
+
+            # Return route from the Squid instances to the spoke VPC
+            for index, subnet in enumerate(inspection_vpc.public_subnets, start=1):
+                route = ec2.CfnRoute(self, f"spoke-{count}-return-route-{index}",
+                    route_table_id=subnet.route_table.route_table_id,
+                    destination_cidr_block=cidr,
+                    transit_gateway_id=tgw_id
+                )
+                route.add_depends_on(inspection_attachment)
+
+        core.CfnOutput(self, "output-transit-gateway-id",
+                       value=tgw_id)
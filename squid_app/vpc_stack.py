@@ -5,12 +5,13 @@ from aws_cdk import (
 
 class VPCStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, vpc_cidr: str, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, vpc_cidr: str, max_azs: int = 2, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
-        # Create a VPC with 2 public and 2 isolated subnets across 2 availiability zones. 
+        # Create a VPC with a public and an isolated subnet in each of max_azs availiability zones.
+        # Squid runs an ASG per AZ
         self.vpc = ec2.Vpc(self, "vpc",
-            max_azs=2,
+            max_azs=max_azs,
             cidr=vpc_cidr,
             subnet_configuration=[ec2.SubnetConfiguration(
                 subnet_type=ec2.SubnetType.PUBLIC,
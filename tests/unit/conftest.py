@@ -0,0 +1,13 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+CONFIG_FILES = os.path.join(ROOT, 'squid_app', 'squid_config_files')
+
+# The Lambda functions and the instance scripts import their modules from their own directory
+sys.path.insert(0, ROOT)
+for directory in ('lambda', 'access_logs', 'config_push', 'health_probe'):
+    sys.path.insert(0, os.path.join(CONFIG_FILES, directory))
+
+# The Lambda handlers create their boto3 clients when they are imported
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
@@ -0,0 +1,240 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from access_log_batcher import AccessLogBatcher, CloudWatchSampler
+from access_log_parser import parse_line
+from squid_log_shipper import LogShipper, LogTail
+
+# 2024-01-31T10:00:00Z
+TIMESTAMP = 1706695200
+
+
+def log_line(offset=0, status=200, result='TCP_TUNNEL', sni='example.com', method='CONNECT', url='example.com:443',
+        hierarchy='HIER_DIRECT/93.184.216.34'):
+    return '%d.123 %5d 10.0.0.5 %s/%03d 5120 %s %s %s %s -' % (
+        TIMESTAMP + offset, 45, result, status, method, url, sni, hierarchy)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+        self.failing = False
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        if self.failing:
+            raise ConnectionError('S3 unavailable')
+        self.objects[Key] = gzip.decompress(Body).decode().splitlines()
+
+
+class FakeCloudWatchClient:
+    def put_metric_data(self, **kwargs):
+        pass
+
+
+def append(path, *lines):
+    with open(path, 'a') as log_h:
+        log_h.write(''.join(line + '\n' for line in lines))
+
+
+def test_parse_a_tunnel():
+    record = parse_line(log_line())
+    assert (record.timestamp, record.elapsed_ms, record.status, record.bytes) == (TIMESTAMP + 0.123, 45, 200, 5120)
+    assert (record.method, record.domain, record.denied) == ('CONNECT', 'example.com', False)
+
+
+def test_parse_the_domain_without_sni():
+    assert parse_line(log_line(sni='-', url='Example.COM:8443')).domain == 'example.com'
+    assert parse_line(log_line(sni='-', method='GET', url='http://example.org/index.html')).domain == 'example.org'
+
+
+def test_parse_denied_requests():
+    assert parse_line(log_line(status=403, result='TCP_DENIED', hierarchy='HIER_NONE/-')).denied
+    # Refused by Squid without contacting a server
+    assert parse_line(log_line(status=403, result='TCP_MISS', hierarchy='HIER_NONE/-')).denied
+    assert not parse_line(log_line(status=403, result='TCP_MISS')).denied
+
+
+def test_parse_skips_other_lines():
+    assert parse_line('2024/01/31 10:00:00| Starting Squid Cache') is None
+    assert parse_line('') is None
+
+
+def test_tail_keeps_the_partial_line(tmp_path):
+    path = str(tmp_path / 'access.log')
+    append(path, 'line 1')
+    with open(path, 'a') as log_h:
+        log_h.write('line')
+    tail = LogTail(path)
+    assert tail.read_lines() == ['line 1']
+    assert tail.position() == {'inode': os.stat(path).st_ino, 'offset': len('line 1\n')}
+    append(path, ' 2')
+    assert tail.read_lines() == ['line 2']
+    assert tail.read_lines() == []
+
+
+def test_tail_reads_the_rotated_file_to_the_end(tmp_path):
+    path = str(tmp_path / 'access.log')
+    append(path, 'line 1')
+    tail = LogTail(path)
+    assert tail.read_lines() == ['line 1']
+    os.rename(path, path + '.1')
+    # Written by Squid before it reopens its log
+    append(path + '.1', 'line 2')
+    assert tail.read_lines() == ['line 2']
+    # The new file is not there yet
+    assert tail.read_lines() == []
+    append(path, 'line 3')
+    assert tail.read_lines() == ['line 3']
+    assert tail.position() == {'inode': os.stat(path).st_ino, 'offset': len('line 3\n')}
+
+
+def test_tail_resumes_from_the_saved_position_of_the_same_file(tmp_path):
+    path = str(tmp_path / 'access.log')
+    append(path, 'line 1', 'line 2')
+    position = {'inode': os.stat(path).st_ino, 'offset': len('line 1\n')}
+    assert LogTail(path, position).read_lines() == ['line 2']
+    # The file was rotated since
+    assert LogTail(path, dict(position, inode=position['inode'] + 1)).read_lines() == ['line 1', 'line 2']
+
+
+def test_tail_reads_a_truncated_file_from_the_start(tmp_path):
+    path = str(tmp_path / 'access.log')
+    append(path, 'line 1', 'line 2')
+    tail = LogTail(path)
+    assert tail.read_lines() == ['line 1', 'line 2']
+    with open(path, 'w') as log_h:
+        log_h.write('line 3\n')
+    assert tail.read_lines() == ['line 3']
+
+
+def test_batch_is_full_after_max_records():
+    batcher = AccessLogBatcher('i-1', 'us-east-1a', max_records=2, max_age=None)
+    batcher.add(parse_line(log_line()))
+    assert not batcher.full()
+    batcher.add(parse_line(log_line(1)))
+    assert batcher.full()
+    assert len(batcher.drain({'inode': 12, 'offset': 0})) == 1
+    assert len(batcher) == 0 and not batcher.full()
+
+
+def test_batch_is_full_max_age_after_its_first_record():
+    clock = FakeClock()
+    batcher = AccessLogBatcher('i-1', 'us-east-1a', max_age=60.0, clock=clock)
+    clock.now = 100.0
+    assert not batcher.full()
+    batcher.add(parse_line(log_line()))
+    clock.now = 159.0
+    batcher.add(parse_line(log_line(1)))
+    assert not batcher.full()
+    clock.now = 160.0
+    assert batcher.full()
+
+
+def test_batch_keys_are_named_after_the_source():
+    batcher = AccessLogBatcher('i-1', 'us-east-1a')
+    batcher.add(parse_line(log_line()))
+    # The next day
+    batcher.add(parse_line(log_line(86400)))
+    objects = batcher.drain({'inode': 12, 'offset': 4096})
+    assert [key for key, _ in objects] == [
+        'access-logs/date=2024-01-31/az=us-east-1a/i-1-20240131T100000-12-4096.json.gz',
+        'access-logs/date=2024-02-01/az=us-east-1a/i-1-20240201T100000-12-4096.json.gz']
+    document = json.loads(gzip.decompress(objects[0][1]))
+    assert (document['domain'], document['instance_id']) == ('example.com', 'i-1')
+    # A new batcher, as after a restart, names the same batch the same way
+    batcher = AccessLogBatcher('i-1', 'us-east-1a')
+    batcher.add(parse_line(log_line()))
+    assert batcher.drain({'inode': 12, 'offset': 4096})[0][0] == objects[0][0]
+
+
+def test_sampler_keeps_the_denied_requests_and_the_errors():
+    sampler = CloudWatchSampler(sample_rate=0.01, rng=lambda: 0.5)
+    assert sampler.keep(parse_line(log_line(status=403, result='TCP_DENIED', hierarchy='HIER_NONE/-')))
+    assert sampler.keep(parse_line(log_line(status=503)))
+    assert not sampler.keep(parse_line(log_line()))
+
+
+def test_sampler_keeps_a_share_of_the_other_requests():
+    values = iter([0.005, 0.5, 0.009, 0.01])
+    sampler = CloudWatchSampler(sample_rate=0.01, rng=lambda: next(values))
+    assert [sampler.keep(parse_line(log_line())) for _ in range(4)] == [True, False, True, False]
+
+
+@pytest.fixture
+def shipper_factory(tmp_path):
+    path = str(tmp_path / 'access.log')
+    state_file = str(tmp_path / 'position.json')
+
+    def shipper(s3_client, max_records=2):
+        try:
+            with open(state_file) as state_h:
+                position = json.load(state_h)
+        except OSError:
+            position = None
+        return LogShipper(LogTail(path, position),
+            AccessLogBatcher('i-1', 'us-east-1a', max_records=max_records, max_age=None),
+            CloudWatchSampler(sample_rate=0.0), s3_client, 'bucket', FakeCloudWatchClient(),
+            sampled_log=str(tmp_path / 'access-sampled.log'), state_file=state_file)
+    return path, shipper
+
+
+def test_restart_overwrites_the_objects_of_the_batch_read_again(shipper_factory, tmp_path):
+    path, shipper = shipper_factory
+    s3_client = FakeS3Client()
+    log_shipper = shipper(s3_client)
+    append(path, log_line(0), log_line(1))
+    log_shipper.poll()
+    saved_position = (tmp_path / 'position.json').read_text()
+    append(path, log_line(2), log_line(3))
+    log_shipper.poll()
+    # Stopped once the second batch was uploaded, before its position was saved
+    (tmp_path / 'position.json').write_text(saved_position)
+    keys = sorted(s3_client.objects)
+    assert len(keys) == 2
+
+    # Started again, with the lines written since in the same batch
+    append(path, log_line(4))
+    shipper(s3_client, max_records=3).poll()
+    assert sorted(s3_client.objects) == keys
+    assert [len(s3_client.objects[key]) for key in keys] == [2, 3]
+
+
+def test_position_is_saved_once_the_batch_is_uploaded(shipper_factory, tmp_path):
+    path, shipper = shipper_factory
+    s3_client = FakeS3Client()
+    s3_client.failing = True
+    log_shipper = shipper(s3_client)
+    append(path, log_line(0), log_line(1))
+    log_shipper.poll()
+    assert not (tmp_path / 'position.json').exists()
+    s3_client.failing = False
+    log_shipper.flush()
+    assert json.loads((tmp_path / 'position.json').read_text()) == log_shipper.tail.position()
+    assert log_shipper.pending_objects == []
+
+
+def test_batch_ends_with_the_rotated_file(shipper_factory):
+    path, shipper = shipper_factory
+    s3_client = FakeS3Client()
+    log_shipper = shipper(s3_client, max_records=10)
+    append(path, log_line(0))
+    log_shipper.poll()
+    old_inode = os.stat(path).st_ino
+    os.rename(path, path + '.1')
+    append(path, log_line(1))
+    log_shipper.poll()
+    log_shipper.flush()
+    assert sorted(s3_client.objects) == sorted([
+        'access-logs/date=2024-01-31/az=us-east-1a/i-1-20240131T100000-%d-0.json.gz' % old_inode,
+        'access-logs/date=2024-01-31/az=us-east-1a/i-1-20240131T100001-%d-0.json.gz' % os.stat(path).st_ino])
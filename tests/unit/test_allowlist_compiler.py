@@ -0,0 +1,83 @@
+import pytest
+
+from squid_app.allowlist_compiler import (
+    AllowlistError,
+    compile_allowlist,
+    compile_allowlist_file,
+    normalize_domain
+)
+
+
+@pytest.mark.parametrize('entry, domain', [
+    ('example.com', 'example.com'),
+    ('  Example.COM.  ', 'example.com'),
+    ('.example.com', '.example.com'),
+    ('*.Example.com', '.example.com'),
+    ('bücher.example', 'xn--bcher-kva.example'),
+    ('_dmarc.example.com', '_dmarc.example.com'),
+])
+def test_normalize_domain(entry, domain):
+    assert normalize_domain(entry) == domain
+
+
+@pytest.mark.parametrize('entry, reason', [
+    ('.', 'empty domain'),
+    ('https://example.com/', 'not a domain'),
+    ('example.com:443', 'not a domain'),
+    ('-example.com', "invalid label '-example'"),
+    ('exa mple.com', 'invalid label'),
+    # Caught by the IDNA encoding
+    ('example..com', 'label empty'),
+    ('%s.com' % ('a' * 64), 'too long'),
+    ('.'.join(['a' * 63] * 4) + '.com', 'longer than 253'),
+])
+def test_invalid_entries_are_rejected(entry, reason):
+    with pytest.raises(ValueError, match=reason):
+        normalize_domain(entry)
+
+
+def test_parent_wildcard_covers_its_subdomains():
+    compiled, stats = compile_allowlist([
+        '.example.com\n',
+        'example.com\n',
+        'api.example.com\n',
+        '.cdn.example.com\n',
+        # Not a subdomain
+        'myexample.com\n',
+        # An exact parent does not cover its subdomains
+        'aws.amazon.com\n',
+        's3.aws.amazon.com\n',
+    ])
+    assert compiled == ['aws.amazon.com', 's3.aws.amazon.com', '.example.com', 'myexample.com']
+    assert stats == {'entries': 7, 'duplicates': 0, 'covered': 3, 'compiled': 4}
+
+
+def test_duplicates_and_case_variants_are_merged():
+    compiled, stats = compile_allowlist([
+        'Example.com\n',
+        'example.com.\n',
+        'EXAMPLE.COM  # the same domain\n',
+        '*.github.com\n',
+        '.GitHub.com\n',
+        '# a comment\n',
+        '\n',
+    ])
+    assert compiled == ['example.com', '.github.com']
+    assert stats == {'entries': 5, 'duplicates': 3, 'covered': 0, 'compiled': 2}
+
+
+def test_every_invalid_entry_is_reported_with_its_line():
+    with pytest.raises(AllowlistError) as error:
+        compile_allowlist(['example.com\n', 'http://example.org\n', '\n', 'bad!.example.net\n'])
+    assert [(line_number, entry) for line_number, entry, _ in error.value.errors] == [
+        (2, 'http://example.org'), (4, 'bad!.example.net')]
+    assert 'line 4' in str(error.value)
+
+
+def test_compiled_allowlist_is_split_in_numbered_files(tmp_path):
+    source = tmp_path / 'allowed_domains.txt'
+    source.write_text(''.join('host%d.example.com\n' % index for index in range(5)))
+    paths, stats = compile_allowlist_file(str(source), str(tmp_path / 'compiled.txt'), split=2)
+    assert [path.rsplit('/', 1)[1] for path in paths] == ['compiled.1.txt', 'compiled.2.txt', 'compiled.3.txt']
+    assert [len(open(path).read().splitlines()) for path in paths] == [2, 2, 1]
+    assert stats['compiled'] == 5
@@ -0,0 +1,107 @@
+import datetime
+import importlib
+import json
+import os
+
+import pytest
+from botocore.stub import ANY, Stubber
+
+# The rollout handler reads its settings when it is imported
+os.environ.setdefault('CONFIG_BUCKET', 'config')
+os.environ.setdefault('RELEASE_PARAMETER', 'release')
+os.environ.setdefault('CANARY_PARAMETER', 'canary')
+os.environ.setdefault('ASG_NAMES', 'asg-1,asg-2')
+
+from config_release import make_release
+
+rollout_handler = importlib.import_module('config-rollout-handler')
+
+PREVIOUS_RELEASE = make_release({'squid.conf': 'v1', 'allowlist.txt': 'v1', 'conf.d/cache.conf': 'v1'})
+# Changes squid.conf, adds conf.d/tuning.conf and deletes conf.d/cache.conf
+FAILED_RELEASE = make_release({'squid.conf': 'v2', 'allowlist.txt': 'v1', 'conf.d/tuning.conf': 'v1'},
+    {'conf.d/cache.conf': 'marker-1'})
+
+
+@pytest.fixture
+def stubs():
+    with Stubber(rollout_handler.s3_client) as s3_stub, Stubber(rollout_handler.ssm_client) as ssm_stub:
+        yield s3_stub, ssm_stub
+        s3_stub.assert_no_pending_responses()
+        ssm_stub.assert_no_pending_responses()
+
+
+def rollout():
+    return {'release': FAILED_RELEASE, 'previous_release': PREVIOUS_RELEASE, 'canary_instance_id': 'i-1',
+        'execution': 'execution', 'state_machine': 'state-machine'}
+
+
+def expect_canary_reset(ssm_stub):
+    ssm_stub.add_response('put_parameter', {'Version': 2}, {'Name': 'canary', 'Value': '{}', 'Type': 'String',
+        'Overwrite': True, 'Tier': 'Intelligent-Tiering'})
+    ssm_stub.add_response('send_command', {'Command': {'CommandId': '00000000-0000-0000-0000-000000000001'}}, {
+        'DocumentName': 'AWS-RunShellScript', 'Comment': ANY, 'Parameters': ANY, 'MaxConcurrency': '100%',
+        'MaxErrors': '100%', 'TimeoutSeconds': 120, 'InstanceIds': ['i-1']})
+
+
+def copy_parameters(key, version_id):
+    return {'Bucket': 'config', 'Key': key, 'CopySource': {'Bucket': 'config', 'Key': key, 'VersionId': version_id}}
+
+
+def test_rollback_restores_the_promoted_versions_without_deleting_any(stubs):
+    s3_stub, ssm_stub = stubs
+    expect_canary_reset(ssm_stub)
+    s3_stub.add_response('copy_object', {'VersionId': 'v3'}, copy_parameters('conf.d/cache.conf', 'v1'))
+    # Deleted without a version id: a delete marker hides the added file
+    s3_stub.add_response('delete_object', {'DeleteMarker': True, 'VersionId': 'marker-2'},
+        {'Bucket': 'config', 'Key': 'conf.d/tuning.conf'})
+    s3_stub.add_response('copy_object', {'VersionId': 'v4'}, copy_parameters('squid.conf', 'v1'))
+    ssm_stub.add_response('put_parameter', {'Version': 3}, {'Name': 'release', 'Value': ANY, 'Type': 'String',
+        'Overwrite': True, 'Tier': 'Intelligent-Tiering'})
+
+    result = rollout_handler.rollback(rollout())
+    assert result['status'] == 'rolled-back'
+    assert result['restored_release']['objects'] == {
+        'squid.conf': 'v4', 'allowlist.txt': 'v1', 'conf.d/cache.conf': 'v3'}
+    assert result['restored_release']['delete_markers'] == {'conf.d/tuning.conf': 'marker-2'}
+    assert result['failed_versions'] == {'squid.conf': 'v2', 'conf.d/tuning.conf': 'v1'}
+
+
+def test_rollback_keeps_the_promoted_release_when_a_file_is_not_restored(stubs):
+    s3_stub, ssm_stub = stubs
+    expect_canary_reset(ssm_stub)
+    s3_stub.add_response('copy_object', {'VersionId': 'v3'}, copy_parameters('conf.d/cache.conf', 'v1'))
+    s3_stub.add_response('delete_object', {'DeleteMarker': True, 'VersionId': 'marker-2'},
+        {'Bucket': 'config', 'Key': 'conf.d/tuning.conf'})
+    s3_stub.add_client_error('copy_object', service_error_code='AccessDenied')
+
+    with pytest.raises(rollout_handler.RollbackError, match='squid.conf'):
+        rollout_handler.rollback(rollout())
+
+
+def test_rollout_started_by_the_rollback_finds_nothing_to_roll_out(stubs):
+    s3_stub, ssm_stub = stubs
+    restored = make_release({'squid.conf': 'v4', 'allowlist.txt': 'v1', 'conf.d/cache.conf': 'v3'},
+        {'conf.d/tuning.conf': 'marker-2'})
+    started = datetime.datetime(2021, 1, 1)
+    with Stubber(rollout_handler.sfn_client) as sfn_stub:
+        sfn_stub.add_response('list_executions', {'executions': [{'executionArn': 'execution', 'stateMachineArn':
+            'state-machine', 'name': 'execution', 'status': 'RUNNING', 'startDate': started}]},
+            {'stateMachineArn': 'state-machine', 'statusFilter': 'RUNNING'})
+        ssm_stub.add_response('get_parameter', {'Parameter': {'Value': json.dumps(restored)}}, {'Name': 'release'})
+        s3_stub.add_response('list_object_versions', {
+            'Versions': [
+                {'Key': 'squid.conf', 'VersionId': 'v4', 'IsLatest': True},
+                {'Key': 'squid.conf', 'VersionId': 'v2', 'IsLatest': False},
+                {'Key': 'squid.conf', 'VersionId': 'v1', 'IsLatest': False},
+                {'Key': 'allowlist.txt', 'VersionId': 'v1', 'IsLatest': True},
+                {'Key': 'conf.d/cache.conf', 'VersionId': 'v3', 'IsLatest': True},
+                {'Key': 'conf.d/cache.conf', 'VersionId': 'v1', 'IsLatest': False},
+                {'Key': 'conf.d/tuning.conf', 'VersionId': 'v1', 'IsLatest': False}],
+            'DeleteMarkers': [
+                {'Key': 'conf.d/tuning.conf', 'VersionId': 'marker-2', 'IsLatest': True},
+                {'Key': 'conf.d/cache.conf', 'VersionId': 'marker-1', 'IsLatest': False}]
+        }, {'Bucket': 'config'})
+
+        result = rollout_handler.prepare({'execution': 'execution', 'state_machine': 'state-machine'})
+        sfn_stub.assert_no_pending_responses()
+    assert result['status'] == 'unchanged'
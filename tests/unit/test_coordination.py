@@ -0,0 +1,100 @@
+import importlib
+import time
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from coordination import AlarmTransition, DynamoDbStateStore, FailoverCoordinator, LeaseLost
+from inventory import Inventory
+from route_planner import RoutePlanner
+
+handler_module = importlib.import_module('lambda-handler')
+
+
+# In-memory state table, with the conditional writes of the DynamoDB state store
+class MemoryStateStore:
+    def __init__(self):
+        self.lease = None
+        self.transition_times = {}
+
+    def acquire_lease(self, owner, now_ms, expires_ms):
+        if self.lease is None or self.lease[1] < now_ms or self.lease[0] == owner:
+            self.lease = (owner, expires_ms)
+            return True
+        return False
+
+    def renew_lease(self, owner, expires_ms):
+        if self.lease and self.lease[0] == owner:
+            self.lease = (owner, expires_ms)
+            return True
+        return False
+
+    def release_lease(self, owner):
+        if self.lease and self.lease[0] == owner:
+            self.lease = None
+
+    def last_transition_times(self, asg_names):
+        return {asg_name: self.transition_times[asg_name] for asg_name in asg_names
+            if asg_name in self.transition_times}
+
+    def record_transition(self, transition):
+        self.transition_times[transition.asg_name] = transition.time
+
+
+@pytest.fixture
+def ddb_client():
+    return boto3.client('dynamodb', region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test')
+
+
+def test_renew_the_lease_of_its_owner(ddb_client):
+    store = DynamoDbStateStore(ddb_client, 'state')
+    with Stubber(ddb_client) as stubber:
+        stubber.add_response('update_item', {}, {
+            'TableName': 'state',
+            'Key': {'Id': {'S': 'lease'}},
+            'UpdateExpression': 'SET LeaseExpires = :expires',
+            'ConditionExpression': 'LeaseOwner = :owner',
+            'ExpressionAttributeValues': {':owner': {'S': 'owner-1'}, ':expires': {'N': '5000'}}
+        })
+        stubber.add_client_error('update_item', service_error_code='ConditionalCheckFailedException')
+        assert store.renew_lease('owner-1', 5000)
+        assert not store.renew_lease('owner-1', 5000)
+        stubber.assert_no_pending_responses()
+
+
+def test_lease_lasts_lease_seconds():
+    store = MemoryStateStore()
+    coordinator = FailoverCoordinator(store, lease_seconds=60)
+    before = int(time.time() * 1000)
+    owner = coordinator.acquire(deadline=time.time() + 1)
+    assert store.lease[0] == owner
+    assert before + 60000 <= store.lease[1] <= int(time.time() * 1000) + 60000
+
+
+def test_renew_fails_once_the_lease_is_taken():
+    store = MemoryStateStore()
+    coordinator = FailoverCoordinator(store, lease_seconds=60)
+    owner = coordinator.acquire(deadline=time.time() + 1, owner='owner-1')
+    coordinator.renew(owner)
+    # The lease expired and another invocation took it
+    store.lease = ('owner-1', 0)
+    assert store.acquire_lease('owner-2', int(time.time() * 1000), int(time.time() * 1000) + 60000)
+    with pytest.raises(LeaseLost):
+        coordinator.renew(owner)
+
+
+def test_dry_run_does_not_commit(monkeypatch):
+    inventory = Inventory(None, None, None)
+    inventory.asgs = {'asg-1': {'Instances': [], 'RouteTableIds': []}}
+    inventory.alarms = {'asg-1': {'StateValue': 'ALARM'}}
+    monkeypatch.setattr(inventory, 'load', lambda: inventory)
+    monkeypatch.setattr(handler_module, 'Inventory', lambda *args, **kwargs: inventory)
+    monkeypatch.setattr(handler_module, 'dry_run', True)
+    monkeypatch.setattr(handler_module, 'route_planner', RoutePlanner(None, dry_run=True))
+    store = MemoryStateStore()
+    monkeypatch.setattr(handler_module, 'coordinator', FailoverCoordinator(store, lease_seconds=60))
+
+    owner = handler_module.coordinator.acquire(deadline=time.time() + 1)
+    handler_module.process_transitions([AlarmTransition('asg-1', 'ALARM', 1000)], lease_owner=owner)
+    assert store.transition_times == {}
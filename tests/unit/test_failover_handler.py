@@ -0,0 +1,117 @@
+import importlib
+import json
+
+import pytest
+
+from coordination import InstanceEvent, parse_instance_events, parse_transitions
+from inventory import Inventory
+from target_selection import SpreadStrategy, balance_route_tables
+
+handler_module = importlib.import_module('lambda-handler')
+
+
+def instance(instance_id, lifecycle_state='InService', health_status='Healthy'):
+    return {'InstanceId': instance_id, 'LifecycleState': lifecycle_state, 'HealthStatus': health_status}
+
+
+def route_table(instance_id, asg_name):
+    return {'Routes': [{'DestinationCidrBlock': '0.0.0.0/0', 'InstanceId': instance_id, 'State': 'active'}],
+        'Tags': [{'Key': 'AutoScalingGroupName', 'Value': asg_name}]}
+
+
+# Two AZs: asg-1 with two instances and three route tables, asg-2 with one instance and one route table
+@pytest.fixture
+def inventory():
+    inventory = Inventory(None, None, None)
+    inventory.asgs = {
+        'asg-1': {'Instances': [instance('i-1a'), instance('i-1b')], 'RouteTableIds': ['rtb-1a', 'rtb-1b', 'rtb-1c']},
+        'asg-2': {'Instances': [instance('i-2a')], 'RouteTableIds': ['rtb-2a']}
+    }
+    inventory.alarms = {asg_name: {'StateValue': 'OK'} for asg_name in inventory.asgs}
+    inventory.route_tables = {
+        'rtb-1a': route_table('i-1a', 'asg-1'),
+        'rtb-1b': route_table('i-1b', 'asg-1'),
+        'rtb-1c': route_table('i-1a', 'asg-1'),
+        'rtb-2a': route_table('i-2a', 'asg-2')
+    }
+    return inventory
+
+
+def sns_record(message):
+    return {'Sns': {'Message': json.dumps(message), 'Timestamp': '2021-03-24T12:34:56.789Z'}}
+
+
+def test_parse_the_records_of_both_topics():
+    records = [
+        sns_record({'AlarmName': 'squid-alarm_asg-1', 'NewStateValue': 'ALARM',
+            'StateChangeTime': '2021-03-24T12:34:56.789+0000'}),
+        sns_record({'LifecycleTransition': 'autoscaling:EC2_INSTANCE_TERMINATING', 'AutoScalingGroupName': 'asg-1',
+            'EC2InstanceId': 'i-1a', 'LifecycleHookName': 'hook', 'LifecycleActionToken': 'token'}),
+        sns_record({'Event': 'autoscaling:EC2_INSTANCE_LAUNCH', 'AutoScalingGroupName': 'asg-2',
+            'EC2InstanceId': 'i-2b'}),
+        # Completed by the instance itself
+        sns_record({'LifecycleTransition': 'autoscaling:EC2_INSTANCE_LAUNCHING', 'AutoScalingGroupName': 'asg-2',
+            'EC2InstanceId': 'i-2b', 'LifecycleHookName': 'hook', 'LifecycleActionToken': 'token'}),
+        sns_record({'Event': 'autoscaling:TEST_NOTIFICATION', 'AutoScalingGroupName': 'asg-2'})
+    ]
+    assert [(transition.asg_name, transition.state) for transition in parse_transitions(records)] == [
+        ('asg-1', 'ALARM')]
+    assert parse_instance_events(records) == [
+        InstanceEvent('asg-1', 'i-1a', 'TERMINATING', 'hook', 'token'),
+        InstanceEvent('asg-2', 'i-2b', 'LAUNCH', None, None)]
+
+
+def test_balance_keeps_the_route_tables_in_place():
+    current = {'rtb-a': 'i-1', 'rtb-b': 'i-2', 'rtb-c': 'i-1'}
+    assert balance_route_tables(current, list(current), ['i-1', 'i-2']) == current
+
+
+def test_balance_moves_the_fewest_route_tables_to_a_new_instance():
+    current = {'rtb-a': 'i-1', 'rtb-b': 'i-1', 'rtb-c': 'i-2', 'rtb-d': 'i-2'}
+    assert balance_route_tables(current, list(current), ['i-1', 'i-2', 'i-3']) == {
+        'rtb-a': 'i-1', 'rtb-b': 'i-1', 'rtb-c': 'i-2', 'rtb-d': 'i-3'}
+
+
+def test_balance_leaves_the_instances_over_the_route_tables_on_standby():
+    current = {'rtb-a': 'i-1'}
+    assert balance_route_tables(current, list(current), ['i-1', 'i-2']) == current
+    # The standby takes over the route table of a removed instance
+    assert balance_route_tables(current, list(current), ['i-2']) == {'rtb-a': 'i-2'}
+
+
+def test_balance_moves_the_route_tables_of_a_removed_instance():
+    current = {'rtb-a': 'i-1', 'rtb-b': 'i-2', 'rtb-c': 'i-3', 'rtb-d': 'i-3'}
+    assert balance_route_tables(current, list(current), ['i-1', 'i-2']) == {
+        'rtb-a': 'i-1', 'rtb-b': 'i-2', 'rtb-c': 'i-1', 'rtb-d': 'i-2'}
+
+
+def test_launched_instance_takes_a_share_of_the_route_tables(inventory):
+    inventory.asgs['asg-1']['Instances'].append(instance('i-1c'))
+    desired = {}
+    handler_module.handle_instance_launched(inventory, desired, InstanceEvent('asg-1', 'i-1c', 'LAUNCH', None, None))
+    assert desired == {'rtb-1a': ('i-1a', 'asg-1'), 'rtb-1b': ('i-1b', 'asg-1'), 'rtb-1c': ('i-1c', 'asg-1')}
+
+
+def test_launched_instance_waits_for_the_failback(inventory):
+    inventory.asgs['asg-1']['Instances'].append(instance('i-1c'))
+    inventory.alarms['asg-1']['StateValue'] = 'ALARM'
+    desired = {}
+    handler_module.handle_instance_launched(inventory, desired, InstanceEvent('asg-1', 'i-1c', 'LAUNCH', None, None))
+    assert desired == {}
+
+
+def test_terminating_instance_hands_its_route_tables_to_its_asg(inventory):
+    desired = {}
+    handler_module.handle_instance_terminating(inventory, desired, SpreadStrategy(inventory, None),
+        InstanceEvent('asg-1', 'i-1a', 'TERMINATING', 'hook', 'token'))
+    assert {route_table_id: target[0] for route_table_id, target in desired.items()} == {
+        'rtb-1a': 'i-1b', 'rtb-1b': 'i-1b', 'rtb-1c': 'i-1b'}
+
+
+def test_last_terminating_instance_fails_over_to_another_asg(inventory):
+    desired = {}
+    handler_module.handle_instance_terminating(inventory, desired, SpreadStrategy(inventory, None),
+        InstanceEvent('asg-2', 'i-2a', 'TERMINATING', 'hook', 'token'))
+    assert list(desired) == ['rtb-2a']
+    assert desired['rtb-2a'][1] == 'asg-1'
+    assert inventory.asgs['asg-2']['Instances'][0]['LifecycleState'] == 'Terminating:Wait'
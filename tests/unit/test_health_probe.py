@@ -0,0 +1,40 @@
+import asyncio
+
+from squid_health_probe import CloudWatchPublisher, ProbeResult, SquidHealthProbe
+
+
+def success_values(metric_data, port=None):
+    return [datum['Value'] for datum in metric_data if datum['MetricName'] == 'ProbeSuccess' and
+        {dimension['Name']: dimension['Value'] for dimension in datum['Dimensions']}.get('Port') == port]
+
+
+def test_one_failed_port_fails_the_cycle():
+    publisher = CloudWatchPublisher(None, 'asg-1')
+    metric_data = publisher.metric_data([
+        [ProbeResult(3129, True, 1.0, 100.0), ProbeResult(3130, True, 2.0, 100.0)],
+        [ProbeResult(3129, True, 1.0, 101.0), ProbeResult(3130, False, 400.0, 101.0),
+            ProbeResult(3128, True, 30.0, 101.0)]])
+    # A single datapoint per cycle for the alarm, with the AutoScalingGroupName dimension only
+    assert success_values(metric_data) == [1, 0]
+    assert success_values(metric_data, '3129') == [1, 1]
+    assert success_values(metric_data, '3130') == [1, 0]
+    assert success_values(metric_data, '3128') == [1]
+    assert len([datum for datum in metric_data if datum['MetricName'] == 'ProbeLatency']) == 5
+
+
+def test_probe_keeps_the_results_of_each_cycle(monkeypatch):
+    probe = SquidHealthProbe(forward_interval=0.0, failure_threshold=2)
+    failed = []
+    probe.on_failure = failed.append
+    answers = {3128: True, 3129: True, 3130: False}
+
+    async def timed(port, probe_function, *args):
+        return ProbeResult(port, answers[port], 1.0)
+    monkeypatch.setattr(probe, '_timed', timed)
+
+    asyncio.run(probe.probe_once())
+    assert not failed
+    asyncio.run(probe.probe_once())
+    assert [result.port for result in failed[0]] == [3130]
+    assert [[result.port for result in results] for results in probe.drain()] == [[3129, 3130, 3128]] * 2
+    assert probe.drain() == []
@@ -0,0 +1,44 @@
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from inventory import ApiCallCounter, Inventory
+
+
+@pytest.fixture
+def clients():
+    parameters = dict(region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test')
+    return boto3.client('autoscaling', **parameters), boto3.client('cloudwatch', **parameters), \
+        boto3.client('ec2', **parameters)
+
+
+def asg(name, route_table_ids):
+    return {'AutoScalingGroupName': name, 'MinSize': 1, 'MaxSize': 1, 'DesiredCapacity': 1,
+        'DefaultCooldown': 300, 'AvailabilityZones': ['us-east-1a'], 'HealthCheckType': 'EC2',
+        'CreatedTime': '2021-01-01T00:00:00Z', 'Instances': [],
+        'Tags': [{'Key': 'RouteTableIds', 'Value': route_table_ids}]}
+
+
+def test_snapshot_lists_only_the_tagged_asgs(clients):
+    as_client, cw_client, ec2_client = clients
+    api_calls = ApiCallCounter(as_client, cw_client, ec2_client)
+    with Stubber(as_client) as as_stub, Stubber(cw_client) as cw_stub, Stubber(ec2_client) as ec2_stub:
+        # The ASGs without the route table tag are filtered out by the API, not paged through
+        as_stub.add_response('describe_auto_scaling_groups',
+            {'AutoScalingGroups': [asg('asg-1', 'rtb-1a,rtb-1b'), asg('asg-2', 'rtb-2a')]},
+            {'Filters': [{'Name': 'tag-key', 'Values': ['RouteTableIds']}]})
+        cw_stub.add_response('describe_alarms', {'MetricAlarms': [
+            {'AlarmName': 'squid-alarm_asg-1', 'StateValue': 'OK'},
+            {'AlarmName': 'squid-alarm_asg-2', 'StateValue': 'ALARM'}]},
+            {'AlarmNamePrefix': 'squid-alarm_', 'ActionPrefix': 'topic'})
+        ec2_stub.add_response('describe_route_tables', {'RouteTables': [
+            {'RouteTableId': route_table_id, 'Routes': []} for route_table_id in ('rtb-1a', 'rtb-1b', 'rtb-2a')]},
+            {'Filters': [{'Name': 'route-table-id', 'Values': ['rtb-1a', 'rtb-1b', 'rtb-2a']}]})
+
+        inventory = Inventory(as_client, cw_client, ec2_client, topic_arn='topic').load()
+
+    assert {name: asg['RouteTableIds'] for name, asg in inventory.asgs.items()} == {
+        'asg-1': ['rtb-1a', 'rtb-1b'], 'asg-2': ['rtb-2a']}
+    assert inventory.healthy_asg_names() == ['asg-1']
+    assert sorted(inventory.route_tables) == ['rtb-1a', 'rtb-1b', 'rtb-2a']
+    assert api_calls.calls == {'DescribeAutoScalingGroups': 1, 'DescribeAlarms': 1, 'DescribeRouteTables': 1}
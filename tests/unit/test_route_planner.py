@@ -0,0 +1,113 @@
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+import route_planner
+from route_planner import RouteApplyError, RouteChange, RoutePlanner, plan_routes
+
+
+def route_table(instance_id=None, asg_name=None, state='active'):
+    routes = [{'DestinationCidrBlock': '10.0.0.0/16', 'GatewayId': 'local'}]
+    if instance_id:
+        routes.append({'DestinationCidrBlock': '0.0.0.0/0', 'InstanceId': instance_id, 'State': state})
+    tags = [{'Key': 'AutoScalingGroupName', 'Value': asg_name}] if asg_name else []
+    return {'Routes': routes, 'Tags': tags}
+
+
+@pytest.fixture
+def ec2_client():
+    return boto3.client('ec2', region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test')
+
+
+def route_parameters(route_table_id, instance_id):
+    return {'DestinationCidrBlock': '0.0.0.0/0', 'RouteTableId': route_table_id, 'InstanceId': instance_id}
+
+
+def tag_parameters(route_table_id, asg_name):
+    return {'Resources': [route_table_id], 'Tags': [{'Key': 'AutoScalingGroupName', 'Value': asg_name}]}
+
+
+def test_plan_only_holds_the_changes_needed():
+    route_tables = {
+        'rtb-ok': route_table('i-1', 'asg-1'),
+        'rtb-tag': route_table('i-1'),
+        'rtb-blackhole': route_table('i-9', 'asg-1', state='blackhole'),
+        'rtb-other': route_table('i-2', 'asg-2'),
+        'rtb-none': route_table()
+    }
+    desired = {route_table_id: ('i-1', 'asg-1') for route_table_id in route_tables}
+
+    assert plan_routes(route_tables, desired) == [
+        RouteChange('rtb-blackhole', 'replace', 'i-1', 'asg-1'),
+        RouteChange('rtb-none', 'create', 'i-1', 'asg-1'),
+        RouteChange('rtb-other', 'replace', 'i-1', 'asg-1'),
+        RouteChange('rtb-tag', 'tag', 'i-1', 'asg-1')
+    ]
+
+
+def test_apply_makes_only_the_calls_of_the_plan(ec2_client):
+    changes = plan_routes({'rtb-1': route_table('i-2', 'asg-2'), 'rtb-2': route_table('i-1')},
+        {'rtb-1': ('i-1', 'asg-1'), 'rtb-2': ('i-1', 'asg-1')})
+    with Stubber(ec2_client) as stubber:
+        stubber.add_response('replace_route', {}, route_parameters('rtb-1', 'i-1'))
+        stubber.add_response('create_tags', {}, tag_parameters('rtb-1', 'asg-1'))
+        stubber.add_response('create_tags', {}, tag_parameters('rtb-2', 'asg-1'))
+        assert RoutePlanner(ec2_client, max_workers=1).apply(changes) == changes
+        stubber.assert_no_pending_responses()
+
+
+def test_no_change_makes_no_call(ec2_client):
+    route_tables = {'rtb-1': route_table('i-1', 'asg-1')}
+    changes = plan_routes(route_tables, {'rtb-1': ('i-1', 'asg-1')})
+    assert changes == []
+    # The stubber fails on any call
+    with Stubber(ec2_client):
+        assert RoutePlanner(ec2_client).apply(changes) == []
+
+
+def test_dry_run_prints_the_plan_without_calls(ec2_client, capsys):
+    changes = plan_routes({'rtb-1': route_table()}, {'rtb-1': ('i-1', 'asg-1')})
+    with Stubber(ec2_client):
+        assert RoutePlanner(ec2_client, dry_run=True).apply(changes) == []
+    assert 'create  rtb-1 -> i-1 (asg-1)' in capsys.readouterr().out
+
+
+def test_throttled_calls_are_retried_with_backoff(ec2_client, monkeypatch):
+    delays = []
+    monkeypatch.setattr(route_planner.time, 'sleep', delays.append)
+    changes = [RouteChange('rtb-1', 'replace', 'i-1', 'asg-1')]
+    with Stubber(ec2_client) as stubber:
+        stubber.add_client_error('replace_route', 'RequestLimitExceeded', expected_params=route_parameters('rtb-1', 'i-1'))
+        stubber.add_client_error('replace_route', 'RequestLimitExceeded', expected_params=route_parameters('rtb-1', 'i-1'))
+        stubber.add_response('replace_route', {}, route_parameters('rtb-1', 'i-1'))
+        stubber.add_response('create_tags', {}, tag_parameters('rtb-1', 'asg-1'))
+        assert RoutePlanner(ec2_client, base_delay=0.1).apply(changes) == changes
+        stubber.assert_no_pending_responses()
+    # Full jitter: each delay is at most the exponential backoff of its attempt
+    assert len(delays) == 2
+    assert 0 <= delays[0] <= 0.2 and 0 <= delays[1] <= 0.4
+
+
+def test_throttling_gives_up_after_max_attempts(ec2_client, monkeypatch):
+    monkeypatch.setattr(route_planner.time, 'sleep', lambda delay: None)
+    change = RouteChange('rtb-1', 'create', 'i-1', 'asg-1')
+    with Stubber(ec2_client) as stubber:
+        for _ in range(3):
+            stubber.add_client_error('create_route', 'RequestLimitExceeded')
+        with pytest.raises(RouteApplyError) as error:
+            RoutePlanner(ec2_client, max_attempts=3).apply([change])
+    assert error.value.applied == []
+    assert [failed_change for failed_change, _ in error.value.failed] == [change]
+
+
+def test_partial_apply_reports_the_applied_and_failed_changes(ec2_client):
+    changes = [RouteChange('rtb-1', 'replace', 'i-1', 'asg-1'), RouteChange('rtb-2', 'replace', 'i-1', 'asg-1')]
+    with Stubber(ec2_client) as stubber:
+        stubber.add_response('replace_route', {}, route_parameters('rtb-1', 'i-1'))
+        stubber.add_response('create_tags', {}, tag_parameters('rtb-1', 'asg-1'))
+        stubber.add_client_error('replace_route', 'UnauthorizedOperation', expected_params=route_parameters('rtb-2', 'i-1'))
+        with pytest.raises(RouteApplyError) as error:
+            RoutePlanner(ec2_client, max_workers=1).apply(changes)
+    assert error.value.applied == [changes[0]]
+    assert [change for change, _ in error.value.failed] == [changes[1]]
+    assert 'replace rtb-2' in str(error.value)
@@ -0,0 +1,59 @@
+import pytest
+
+from squid_app.squid_cache_profile import cache_profile, render_cache_conf, render_cache_volume_setup
+from squid_app.squid_tuning_profile import tuning_profile
+
+
+def cache_dir_line(profile):
+    return [line for line in render_cache_volume_setup(profile).splitlines() if 'cache_dir' in line][0]
+
+
+def test_caching_is_disabled_by_default():
+    profile = cache_profile(tuning_profile('c5.large'))
+    assert profile.volume == 'none'
+    assert 'cache deny all' in render_cache_conf(profile).splitlines()
+    assert render_cache_volume_setup(profile) == '# Response caching is disabled'
+
+
+def test_aufs_store_for_a_single_worker():
+    profile = cache_profile(tuning_profile('c5.large'), 'ebs', 100)
+    assert (profile.store_type, profile.volume_gb, profile.cache_mem_mb) == ('aufs', 100, 1024)
+    assert cache_dir_line(profile) == 'echo "cache_dir aufs /var/spool/squid $cache_size_mb 16 256" > ' \
+        '/etc/squid/cache_dir.conf'
+
+
+def test_rock_store_shared_by_the_workers():
+    profile = cache_profile(tuning_profile('c5d.2xlarge'), 'instance-store')
+    assert (profile.store_type, profile.volume_gb, profile.cache_mem_mb) == ('rock', None, 4096)
+    # The rock store takes the objects up to maximum_object_size, 4096 MB
+    assert cache_dir_line(profile) == 'echo "cache_dir rock /var/spool/squid $cache_size_mb max-size=4294967296" > ' \
+        '/etc/squid/cache_dir.conf'
+
+
+@pytest.mark.parametrize('instance_type, volume', [('c5.large', 'ebs'), ('c5d.2xlarge', 'instance-store')])
+def test_only_plain_http_is_cached(instance_type, volume):
+    lines = render_cache_conf(cache_profile(tuning_profile(instance_type), volume)).splitlines()
+    assert lines[1:3] == ['acl cache_plain_http proto HTTP', 'cache deny !cache_plain_http']
+    # No other cache rule allows the CONNECT tunnels or the HTTPS requests
+    assert [line for line in lines if line.startswith('cache ')] == ['cache deny !cache_plain_http']
+    assert 'include /etc/squid/cache_dir.conf' in lines
+
+
+@pytest.mark.parametrize('volume_gb', [0, -50, 16385, 50.5, '50', True, None])
+def test_invalid_cache_volume_size(volume_gb):
+    with pytest.raises(ValueError, match='Invalid cache volume size'):
+        cache_profile(tuning_profile('c5.large'), 'ebs', volume_gb)
+
+
+def test_volume_size_is_ignored_without_ebs():
+    assert cache_profile(tuning_profile('c5d.large'), 'instance-store', 0).volume_gb is None
+
+
+def test_instance_store_needs_an_instance_store_volume():
+    with pytest.raises(ValueError, match='c5.large has no instance store volume'):
+        cache_profile(tuning_profile('c5.large'), 'instance-store')
+
+
+def test_unknown_cache_volume():
+    with pytest.raises(ValueError, match='Unknown cache volume'):
+        cache_profile(tuning_profile('c5.large'), 'efs')
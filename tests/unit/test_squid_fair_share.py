@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from squid_app.squid_fair_share import (
+    TIMEOUTS,
+    delay_bucket,
+    fair_share_profile,
+    render_fair_share_conf,
+    render_fair_share_json
+)
+from squid_app.squid_tuning_profile import tuning_profile
+
+CLASSES = [
+    {'name': 'batch', 'cidrs': ['10.0.2.0/24'], 'priority': 'bulk'},
+    {'name': 'build', 'cidrs': ['10.0.3.0/24'], 'client_bandwidth_mbps': 48, 'max_connections': 10},
+    {'name': 'ops', 'cidrs': ['10.0.1.0/24', '10.0.9.9/32'], 'priority': 'critical'},
+]
+
+
+def rendered_lines(profile):
+    lines = render_fair_share_conf(profile).splitlines()
+    assert lines[1:len(TIMEOUTS) + 1] == TIMEOUTS
+    return lines[len(TIMEOUTS) + 1:]
+
+
+def test_fair_sharing_is_disabled_by_default():
+    profile = fair_share_profile(tuning_profile('c5.large'))
+    assert profile.classes == []
+    assert render_fair_share_conf(profile).splitlines() == [
+        '# Generated by the CDK app, see squid_fair_share.py',
+        '# Fair sharing is disabled']
+
+
+def test_default_class_with_a_single_worker():
+    # c5.large runs a single worker: the limits are not divided
+    profile = fair_share_profile(tuning_profile('c5.large'), [{'name': 'default'}])
+    assert rendered_lines(profile) == [
+        'acl fair_share_default src all',
+        'acl fair_share_default_connections maxconn 1000',
+        'http_access deny !localhost fair_share_default fair_share_default_connections',
+        'delay_pools 1',
+        'delay_class 1 3',
+        # 200 Mbps per client: 25,000,000 bytes per second, with 4 seconds of burst
+        'delay_parameters 1 -1/-1 -1/-1 25000000/100000000',
+        'delay_access 1 deny localhost',
+        'delay_access 1 allow fair_share_default',
+        'delay_access 1 deny all']
+
+
+def test_classes_in_priority_order_with_the_limits_of_each_worker():
+    # c5.xlarge runs 3 workers: each one gets a third of the limits
+    profile = fair_share_profile(tuning_profile('c5.xlarge'), CLASSES)
+    assert [fair_share_class.name for fair_share_class in profile.classes] == ['ops', 'build', 'batch', 'default']
+    lines = rendered_lines(profile)
+    assert lines[:4] == [
+        'acl fair_share_ops src 10.0.1.0/24 10.0.9.9/32',
+        'acl fair_share_build src 10.0.3.0/24',
+        'acl fair_share_batch src 10.0.2.0/24',
+        'acl fair_share_default src all']
+    # A client is only held to the connection cap of its own class, the critical class has none
+    assert lines[4:10] == [
+        'acl fair_share_build_connections maxconn 4',
+        'http_access deny !localhost !fair_share_ops fair_share_build fair_share_build_connections',
+        'acl fair_share_batch_connections maxconn 34',
+        'http_access deny !localhost !fair_share_ops !fair_share_build fair_share_batch fair_share_batch_connections',
+        'acl fair_share_default_connections maxconn 334',
+        'http_access deny !localhost !fair_share_ops !fair_share_build !fair_share_batch fair_share_default '
+        'fair_share_default_connections']
+    # One pool per class, numbered from 1 in priority order
+    assert lines[10] == 'delay_pools 4'
+    assert [line for line in lines if line.startswith('delay_class')] == [
+        'delay_class 1 3', 'delay_class 2 3', 'delay_class 3 3', 'delay_class 4 3']
+    assert [line for line in lines if line.startswith('delay_parameters')] == [
+        'delay_parameters 1 -1/-1 -1/-1 -1/-1',
+        'delay_parameters 2 -1/-1 -1/-1 2000000/8000000',
+        'delay_parameters 3 4166666/16666664 -1/-1 833333/3333332',
+        'delay_parameters 4 -1/-1 -1/-1 8333333/33333332']
+    assert [line for line in lines if line.startswith('delay_access 3')] == [
+        'delay_access 3 deny localhost', 'delay_access 3 allow fair_share_batch', 'delay_access 3 deny all']
+
+
+def test_delay_bucket_in_bytes_per_second():
+    assert delay_bucket(None, 2) == '-1/-1'
+    assert delay_bucket(8, 1) == '1000000/4000000'
+    assert delay_bucket(8, 2) == '500000/2000000'
+    # Never below a byte per second
+    assert delay_bucket(0.000001, 4) == '1/4'
+
+
+def test_classes_of_the_health_probe():
+    document = json.loads(render_fair_share_json(fair_share_profile(tuning_profile('c5.xlarge'), CLASSES)))
+    assert document['workers'] == 3
+    assert [(fair_share_class['name'], fair_share_class['pool'], fair_share_class['max_connections'])
+        for fair_share_class in document['classes']] == [
+        ('ops', 1, None), ('build', 2, 4), ('batch', 3, 34), ('default', 4, 334)]
+
+
+@pytest.mark.parametrize('classes, error', [
+    ([{'name': 'Batch'}], 'Invalid fair share class name'),
+    ([{'name': 'batch', 'cidrs': ['10.0.0.0/24']}, {'name': 'batch', 'cidrs': ['10.0.1.0/24']}],
+        'Duplicate fair share class'),
+    ([{'name': 'batch', 'priority': 'low'}], 'Unknown fair share priority'),
+    ([{'name': 'batch', 'bandwidth': 10}], 'Unknown options of the fair share class batch: bandwidth'),
+    ([{'name': 'batch'}, {'name': 'other'}], 'Fair share classes batch and other have no CIDRs'),
+    ([{'name': 'default', 'cidrs': ['10.0.0.0/24']}], "can't have CIDRs"),
+    ([{'name': 'batch', 'cidrs': ['10.0.0.1/24']}], 'host bits set'),
+])
+def test_invalid_classes(classes, error):
+    with pytest.raises(ValueError, match=error):
+        fair_share_profile(tuning_profile('c5.large'), classes)
@@ -0,0 +1,124 @@
+import os
+
+import pytest
+from aws_cdk import aws_ec2 as ec2, core
+
+from squid_app.squid_stack import SquidStack
+from squid_app.vpc_stack import VPCStack
+
+# The asset paths of the app are relative to the repository root
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+ACCOUNT = '123456789012'
+REGION = 'us-east-1'
+AVAILABILITY_ZONES = ['us-east-1a', 'us-east-1b']
+
+
+def build_stack(route_tables_per_az=2, **options):
+    app = core.App(context={
+        f'availability-zones:account={ACCOUNT}:region={REGION}': AVAILABILITY_ZONES,
+    })
+    env = core.Environment(account=ACCOUNT, region=REGION)
+    vpc_stack = core.Stack(app, 'vpc', env=env)
+    # A public subnet and route_tables_per_az isolated subnets, each with its own route table, per AZ
+    vpc = ec2.Vpc(vpc_stack, 'vpc', max_azs=len(AVAILABILITY_ZONES), subnet_configuration=[
+        ec2.SubnetConfiguration(subnet_type=ec2.SubnetType.PUBLIC, name='Public', cidr_mask=24)] + [
+        ec2.SubnetConfiguration(subnet_type=ec2.SubnetType.ISOLATED, name=f'Isolated{index}', cidr_mask=24)
+        for index in range(route_tables_per_az)])
+    stack = SquidStack(app, 'squid', env=env, vpc=vpc, **options)
+    return app.synth().get_stack_by_name(stack.stack_name).template
+
+
+def resources(template, resource_type):
+    return [resource['Properties'] for resource in template['Resources'].values()
+        if resource['Type'] == resource_type]
+
+
+@pytest.fixture(autouse=True)
+def in_root(monkeypatch):
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.fixture(scope='module')
+def template():
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        yield build_stack(instance_type='c5.xlarge', min_capacity=1, max_capacity=2,
+            scaling_metric='requests', scaling_target=800)
+    finally:
+        os.chdir(cwd)
+
+
+def test_launch_template_uses_the_instance_type(template):
+    launch_templates = resources(template, 'AWS::EC2::LaunchTemplate')
+    assert len(launch_templates) == 1
+    assert launch_templates[0]['LaunchTemplateData']['InstanceType'] == 'c5.xlarge'
+
+
+def test_an_asg_per_az_with_the_capacity(template):
+    asgs = resources(template, 'AWS::AutoScaling::AutoScalingGroup')
+    assert len(asgs) == len(AVAILABILITY_ZONES)
+    for asg in asgs:
+        assert (asg['MinSize'], asg['DesiredCapacity'], asg['MaxSize']) == ('1', '1', '2')
+        # Each ASG is tagged with the two route tables of its AZ
+        route_table_tag = [tag for tag in asg['Tags'] if tag['Key'] == 'RouteTableIds'][0]
+        assert len(route_table_tag['Value']['Fn::Join'][1]) == 3
+
+
+def test_target_tracking_on_the_request_rate(template):
+    policies = resources(template, 'AWS::AutoScaling::ScalingPolicy')
+    assert len(policies) == len(AVAILABILITY_ZONES)
+    for policy in policies:
+        assert policy['PolicyType'] == 'TargetTrackingScaling'
+        configuration = policy['TargetTrackingConfiguration']
+        assert configuration['TargetValue'] == 800
+        assert configuration['CustomizedMetricSpecification']['MetricName'] == 'RequestRate'
+        assert configuration['CustomizedMetricSpecification']['Namespace'] == 'Squid'
+
+
+def test_launching_and_terminating_lifecycle_hooks(template):
+    hooks = resources(template, 'AWS::AutoScaling::LifecycleHook')
+    transitions = sorted((hook['LifecycleTransition'], hook['DefaultResult'], hook['HeartbeatTimeout'])
+        for hook in hooks)
+    assert transitions == [
+        ('autoscaling:EC2_INSTANCE_LAUNCHING', 'ABANDON', 300)] * 2 + [
+        ('autoscaling:EC2_INSTANCE_TERMINATING', 'CONTINUE', 120)] * 2
+    # All the hooks notify the topic the failover function is subscribed to
+    topics = {str(hook['NotificationTargetARN']) for hook in hooks}
+    assert len(topics) == 1
+    subscribed = {str(subscription['TopicArn']) for subscription in resources(template, 'AWS::SNS::Subscription')
+        if subscription['Protocol'] == 'lambda'}
+    assert topics <= subscribed
+
+
+def test_asgs_notify_the_instances_in_service(template):
+    for asg in resources(template, 'AWS::AutoScaling::AutoScalingGroup'):
+        assert [configuration['NotificationTypes'] for configuration in asg['NotificationConfigurations']] == [
+            ['autoscaling:EC2_INSTANCE_LAUNCH']]
+
+
+def test_no_scaling_without_spare_capacity():
+    template = build_stack(route_tables_per_az=1)
+    assert resources(template, 'AWS::AutoScaling::ScalingPolicy') == []
+
+
+def test_standby_instances_on_the_default_vpc():
+    app = core.App(context={
+        f'availability-zones:account={ACCOUNT}:region={REGION}': AVAILABILITY_ZONES,
+    })
+    env = core.Environment(account=ACCOUNT, region=REGION)
+    vpc_stack = VPCStack(app, 'vpc', env=env, vpc_cidr='10.0.0.0/16')
+    stack = SquidStack(app, 'squid', env=env, vpc=vpc_stack.vpc, max_capacity=2, scaling_metric='network')
+    template = app.synth().get_stack_by_name(stack.stack_name).template
+    # A single route table per AZ: the second instance of each ASG is a standby
+    for asg in resources(template, 'AWS::AutoScaling::AutoScalingGroup'):
+        assert (asg['MinSize'], asg['MaxSize']) == ('1', '2')
+        route_table_tag = [tag for tag in asg['Tags'] if tag['Key'] == 'RouteTableIds'][0]
+        assert list(route_table_tag['Value']) == ['Fn::ImportValue']
+    assert len(resources(template, 'AWS::AutoScaling::ScalingPolicy')) == len(AVAILABILITY_ZONES)
+
+
+def test_access_log_group_is_not_the_one_of_the_agent(template):
+    log_groups = resources(template, 'AWS::Logs::LogGroup')
+    assert [log_group['LogGroupName'] for log_group in log_groups] == ['/filtering-squid-instance/squid-access.log']
+    assert len(resources(template, 'AWS::Logs::SubscriptionFilter')) == 1
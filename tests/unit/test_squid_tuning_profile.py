@@ -0,0 +1,68 @@
+import pytest
+
+from squid_app.squid_tuning_profile import (
+    instance_resources,
+    render_squid_conf,
+    render_sysctl_conf,
+    tuning_profile
+)
+
+
+@pytest.mark.parametrize('instance_type, vcpus, memory_mib', [
+    ('t2.micro', 1, 1024),
+    ('t3.nano', 2, 512),
+    ('t3.large', 2, 8192),
+    ('c5.large', 2, 4096),
+    ('c5.2xlarge', 8, 16384),
+    ('r5.xlarge', 4, 32768),
+    ('m5.24xlarge', 96, 393216),
+])
+def test_instance_resources(instance_type, vcpus, memory_mib):
+    assert instance_resources(instance_type) == (vcpus, memory_mib)
+
+
+@pytest.mark.parametrize('instance_type, workers, max_filedescriptors, conntrack_max', [
+    # The smallest sizes get the floors
+    ('t2.micro', 1, 16384, 65536),
+    ('t3.nano', 1, 16384, 65536),
+    # A single worker up to 2 vCPUs
+    ('c5.large', 1, 65536, 262144),
+    # A worker per vCPU but the first one, the limits grow with the memory
+    ('r5.xlarge', 3, 524288, 2097152),
+    ('c5.2xlarge', 7, 262144, 1048576),
+    # The largest sizes get the caps
+    ('m5.24xlarge', 95, 1048576, 4194304),
+])
+def test_profile_of_the_instance_size(instance_type, workers, max_filedescriptors, conntrack_max):
+    profile = tuning_profile(instance_type)
+    assert profile.workers == workers
+    assert profile.max_filedescriptors == max_filedescriptors
+    assert profile.conntrack_max == conntrack_max
+    assert profile.sysctl['net.netfilter.nf_conntrack_max'] == conntrack_max
+
+
+def test_workers_are_pinned_past_the_first_vcpu():
+    assert tuning_profile('c5.large').cpu_affinity_map is None
+    conf = render_squid_conf(tuning_profile('c5.xlarge'))
+    assert 'workers 3' in conf.splitlines()
+    assert 'cpu_affinity_map process_numbers=1,2,3 cores=2,3,4' in conf.splitlines()
+
+
+def test_squid_ports_are_not_ephemeral():
+    sysctl = tuning_profile('c5.large').sysctl
+    low, high = map(int, sysctl['net.ipv4.ip_local_port_range'].split())
+    reserved_low, reserved_high = map(int, sysctl['net.ipv4.ip_local_reserved_ports'].split('-'))
+    assert (reserved_low, reserved_high) == (3128, 3130)
+    assert low <= reserved_low and reserved_high <= high
+    assert 'net.ipv4.ip_local_reserved_ports = 3128-3130' in render_sysctl_conf(tuning_profile('c5.large'))
+
+
+@pytest.mark.parametrize('instance_type', ['c5', 'c5.huge', 'C5.large'])
+def test_unknown_instance_type(instance_type):
+    with pytest.raises(ValueError, match='Unknown instance type'):
+        tuning_profile(instance_type)
+
+
+def test_unknown_firewall():
+    with pytest.raises(ValueError, match='Unknown firewall'):
+        tuning_profile('c5.large', firewall='pf')
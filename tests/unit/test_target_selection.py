@@ -0,0 +1,154 @@
+import pytest
+
+from inventory import Inventory
+from target_selection import (FirstHealthyStrategy, RequestWeightedStrategy, SpreadStrategy, WeightedStrategy,
+    target_strategy)
+
+
+def instance(instance_id, health_status='Healthy'):
+    return {'InstanceId': instance_id, 'LifecycleState': 'InService', 'HealthStatus': health_status}
+
+
+def route_table(instance_id):
+    return {'Routes': [{'DestinationCidrBlock': '0.0.0.0/0', 'InstanceId': instance_id, 'State': 'active'}]}
+
+
+# asg-1 failed with two route tables, asg-2 serves one route table with two instances, asg-3 one with one instance
+@pytest.fixture
+def inventory():
+    inventory = Inventory(None, None, None)
+    inventory.asgs = {
+        'asg-1': {'Instances': [instance('i-1a'), instance('i-1b')], 'RouteTableIds': ['rtb-1a', 'rtb-1b']},
+        'asg-2': {'Instances': [instance('i-2a'), instance('i-2b')], 'RouteTableIds': ['rtb-2a']},
+        'asg-3': {'Instances': [instance('i-3a')], 'RouteTableIds': ['rtb-3a']}
+    }
+    inventory.alarms = {'asg-1': {'StateValue': 'ALARM'}, 'asg-2': {'StateValue': 'OK'}, 'asg-3': {'StateValue': 'OK'}}
+    inventory.route_tables = {
+        'rtb-1a': route_table('i-1a'),
+        'rtb-1b': route_table('i-1b'),
+        'rtb-2a': route_table('i-2a'),
+        'rtb-3a': route_table('i-3a')
+    }
+    return inventory
+
+
+# GetMetricData answering with the values of each (metric name, dimension value)
+class FakeCloudWatchClient:
+    def __init__(self, values=None, error=None):
+        self.values = values or {}
+        self.error = error
+        self.calls = 0
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        results = []
+        for query in MetricDataQueries:
+            metric = query['MetricStat']['Metric']
+            key = (metric['MetricName'], metric['Dimensions'][0]['Value'])
+            results.append({'Id': query['Id'], 'Values': self.values.get(key, [])})
+        return {'MetricDataResults': results}
+
+
+def targets(desired):
+    return {route_table_id: instance_id for route_table_id, (instance_id, _) in desired.items()}
+
+
+def test_first_healthy_sends_all_the_route_tables_to_the_first_healthy_asg(inventory):
+    desired = {}
+    assert FirstHealthyStrategy(inventory, None).assign(desired, 'asg-1', ['rtb-1b', 'rtb-1a'])
+    assert desired == {'rtb-1a': ('i-2a', 'asg-2'), 'rtb-1b': ('i-2b', 'asg-2')}
+
+
+def test_first_healthy_skips_the_asgs_without_healthy_instances(inventory):
+    for asg_instance in inventory.asgs['asg-2']['Instances']:
+        asg_instance['HealthStatus'] = 'Unhealthy'
+    desired = {}
+    assert FirstHealthyStrategy(inventory, None).assign(desired, 'asg-1', ['rtb-1a', 'rtb-1b'])
+    assert desired == {'rtb-1a': ('i-3a', 'asg-3'), 'rtb-1b': ('i-3a', 'asg-3')}
+
+
+def test_no_target_without_another_healthy_asg(inventory):
+    inventory.alarms['asg-2']['StateValue'] = inventory.alarms['asg-3']['StateValue'] = 'ALARM'
+    for strategy in (FirstHealthyStrategy, SpreadStrategy, WeightedStrategy):
+        desired = {}
+        assert not strategy(inventory, FakeCloudWatchClient()).assign(desired, 'asg-1', ['rtb-1a', 'rtb-1b'])
+        assert desired == {}
+
+
+def test_spread_goes_to_the_instances_serving_the_fewest_route_tables(inventory):
+    desired = {}
+    assert SpreadStrategy(inventory, None).assign(desired, 'asg-1', ['rtb-1a', 'rtb-1b'])
+    # i-2b serves none, then all the instances serve one
+    assert targets(desired) == {'rtb-1a': 'i-2b', 'rtb-1b': 'i-2a'}
+
+
+def test_spread_counts_the_route_tables_assigned_earlier_in_the_invocation(inventory):
+    # The route tables of asg-1 went to i-2b for a previous record of the batch
+    desired = {'rtb-1a': ('i-2b', 'asg-2'), 'rtb-1b': ('i-2b', 'asg-2')}
+    assert SpreadStrategy(inventory, None).assign(desired, 'asg-3', ['rtb-3a'])
+    assert desired['rtb-3a'] == ('i-2a', 'asg-2')
+
+
+def test_weighted_goes_to_the_least_loaded_instances(inventory):
+    cw_client = FakeCloudWatchClient({
+        ('NetworkOut', 'i-1a'): [200.0], ('NetworkOut', 'i-1b'): [100.0, 300.0],
+        ('NetworkOut', 'i-2a'): [100.0], ('NetworkOut', 'i-2b'): [300.0], ('NetworkOut', 'i-3a'): [50.0]})
+    desired = {}
+    assert WeightedStrategy(inventory, cw_client).assign(desired, 'asg-1', ['rtb-1a', 'rtb-1b'])
+    # Each route table of asg-1 brings 200: i-3a goes to 250, then i-2a to 300
+    assert targets(desired) == {'rtb-1a': 'i-3a', 'rtb-1b': 'i-2a'}
+    assert cw_client.calls == 1
+
+
+def test_weighted_counts_the_route_tables_assigned_earlier_in_the_invocation(inventory):
+    cw_client = FakeCloudWatchClient({('NetworkOut', 'i-1a'): [200.0], ('NetworkOut', 'i-1b'): [200.0],
+        ('NetworkOut', 'i-2a'): [100.0], ('NetworkOut', 'i-2b'): [300.0], ('NetworkOut', 'i-3a'): [50.0]})
+    strategy = WeightedStrategy(inventory, cw_client)
+    loads, route_table_load, _ = strategy.loads({'rtb-x': ('i-3a', 'asg-3')},
+        [('i-2a', 'asg-2'), ('i-2b', 'asg-2'), ('i-3a', 'asg-3')], 'asg-1', ['rtb-1a', 'rtb-1b'])
+    assert route_table_load == 200.0
+    assert loads == {'i-2a': 100.0, 'i-2b': 300.0, 'i-3a': 250.0}
+
+
+def test_weighted_requests_splits_the_request_rate_of_an_asg_across_its_instances(inventory):
+    cw_client = FakeCloudWatchClient({('RequestRate', 'asg-1'): [400.0], ('RequestRate', 'asg-2'): [600.0],
+        ('RequestRate', 'asg-3'): [100.0]})
+    loads, route_table_load, latency_factors = RequestWeightedStrategy(inventory, cw_client).loads(
+        {}, [('i-2a', 'asg-2'), ('i-2b', 'asg-2'), ('i-3a', 'asg-3')], 'asg-1', ['rtb-1a', 'rtb-1b'])
+    assert loads == {'i-2a': 300.0, 'i-2b': 300.0, 'i-3a': 100.0}
+    assert route_table_load == 200.0
+    assert latency_factors == {}
+
+
+def test_weighted_clamps_the_latency_factors(inventory):
+    cw_client = FakeCloudWatchClient({('NetworkOut', 'i-2a'): [100.0], ('ProbeLatency', 'asg-1'): [1000.0],
+        ('ProbeLatency', 'asg-2'): [10.0], ('ProbeLatency', 'asg-3'): [100.0]})
+    _, _, latency_factors = WeightedStrategy(inventory, cw_client).loads(
+        {}, [('i-2a', 'asg-2'), ('i-2b', 'asg-2'), ('i-3a', 'asg-3')], 'asg-1', ['rtb-1a', 'rtb-1b'])
+    # The median latency is 100
+    assert latency_factors == {'asg-1': 2.0, 'asg-2': 0.5, 'asg-3': 1.0}
+
+
+def test_weighted_prefers_the_fastest_asg(inventory):
+    cw_client = FakeCloudWatchClient({('NetworkOut', 'i-2a'): [100.0], ('NetworkOut', 'i-2b'): [100.0],
+        ('NetworkOut', 'i-3a'): [100.0], ('ProbeLatency', 'asg-2'): [40.0], ('ProbeLatency', 'asg-3'): [10.0]})
+    desired = {}
+    assert WeightedStrategy(inventory, cw_client).assign(desired, 'asg-1', ['rtb-1a'])
+    assert desired == {'rtb-1a': ('i-3a', 'asg-3')}
+
+
+@pytest.mark.parametrize('cw_client', [FakeCloudWatchClient(error=ConnectionError('throttled')),
+    FakeCloudWatchClient()], ids=['error', 'no-datapoints'])
+def test_weighted_spreads_evenly_without_metrics(inventory, cw_client):
+    weighted, spread = {}, {}
+    assert WeightedStrategy(inventory, cw_client).assign(weighted, 'asg-1', ['rtb-1a', 'rtb-1b'])
+    assert SpreadStrategy(inventory, None).assign(spread, 'asg-1', ['rtb-1a', 'rtb-1b'])
+    assert weighted == spread
+
+
+def test_unknown_strategy_is_rejected():
+    assert target_strategy('weighted-requests') is RequestWeightedStrategy
+    with pytest.raises(ValueError, match='Unknown target strategy nearest'):
+        target_strategy('nearest')